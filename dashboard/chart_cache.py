@@ -0,0 +1,65 @@
+"""
+Process-wide cache of the dashboard's charts, shared by every session.
+Each chart is kept as its serialised Vega-Lite spec, keyed by the chart, the version
+of the frames it was drawn from and the products selected, so a repeated view skips
+both the pandas work and the Altair work. The least recently used charts are dropped.
+"""
+
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Callable
+
+import altair as alt
+
+MAX_CHARTS = 256
+# Charts continued to now are rebuilt at least this often, even if the data has not changed.
+NOW_BUCKET_SECONDS = 60
+
+# Specs hold their data inline, and price charts can pass Altair's default row limit.
+alt.data_transformers.disable_max_rows()
+
+
+def get_chart_key(chart_name: str, version: int, selected_names: list,
+                  continues_to_now: bool = False) -> tuple:
+    """
+    Returns the key of a chart drawn from a version of the frames with the given
+    products selected. Charts continued to now also carry the current time bucket,
+    so their last point does not stay where it was when the chart was first built.
+    """
+    key = (chart_name, version, tuple(sorted(selected_names)))
+    if continues_to_now:
+        key += (int(time() // NOW_BUCKET_SECONDS),)
+    return key
+
+
+class ChartCache:
+    """
+    The Vega-Lite specs of the most recently used charts.
+    """
+
+    def __init__(self, max_charts: int = MAX_CHARTS):
+        self.max_charts = max_charts
+        self.specs = OrderedDict()
+        self.lock = Lock()
+
+    def get_spec(self, key: tuple, build_chart: Callable[[], alt.TopLevelMixin]) -> str:
+        """
+        Returns the spec cached under the key, building and caching the chart first
+        if it is not there.
+        """
+        with self.lock:
+            spec = self.specs.get(key)
+            if spec is not None:
+                self.specs.move_to_end(key)
+                return spec
+
+        spec = json.dumps(build_chart().to_dict())
+
+        with self.lock:
+            self.specs[key] = spec
+            while len(self.specs) > self.max_charts:
+                self.specs.popitem(last=False)
+
+        return spec
@@ -1,22 +1,88 @@
 """
 Creates cookies for the Dashboard.
+A login is kept in one session cookie holding the user's id and email, signed with
+SESSION_SECRET, so a returning visitor is recognised without reading the database.
 """
+import hmac
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from hashlib import sha256
+from os import environ
+from secrets import token_bytes
+from time import time
+
 from extra_streamlit_components.CookieManager import CookieManager
 
+SESSION_COOKIE = "session"
+SESSION_SECONDS = 86400
+
+# Used when SESSION_SECRET is not set, so logins only last until the dashboard restarts.
+fallback_secret = token_bytes(32)
+
+
+def get_session_secret() -> bytes:
+    """
+    Returns the key session tokens are signed with.
+    """
+    secret = environ.get("SESSION_SECRET")
+    if not secret:
+        return fallback_secret
+    return secret.encode('utf-8')
+
+
+def sign(payload: bytes) -> str:
+    """
+    Returns the HMAC-SHA256 signature of the payload.
+    """
+    return hmac.new(get_session_secret(), payload, sha256).hexdigest()
+
+
+def create_session_token(user: dict, now: float | None = None) -> str:
+    """
+    Returns a signed token naming the user, which expires after SESSION_SECONDS.
+    """
+    expires = int((now if now is not None else time()) + SESSION_SECONDS)
+    payload = urlsafe_b64encode(json.dumps({"user_id": user["user_id"],
+                                            "email": user["email"],
+                                            "expires": expires}).encode('utf-8'))
+    return f"{payload.decode('ascii')}.{sign(payload)}"
+
+
+def read_session_token(token: str | None, now: float | None = None) -> dict | None:
+    """
+    Returns the user id and email in a session token, or None if the token
+    is missing, has been tampered with, or has expired.
+    """
+    if not token or "." not in token:
+        return None
+
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(sign(payload.encode('utf-8')).encode('utf-8'),
+                               signature.encode('utf-8')):
+        return None
+
+    try:
+        session = json.loads(urlsafe_b64decode(payload))
+    except (Base64Error, ValueError):
+        return None
+
+    if session["expires"] <= (now if now is not None else time()):
+        return None
+
+    return {"user_id": session["user_id"], "email": session["email"]}
+
 
 def set_cookies(user: dict, cookie_manager: CookieManager):
     """
     Sets the cookies to be stored for each login.
     """
-    cookie_manager.set("logged_in", "True", max_age=86400, key="new")
-    cookie_manager.set("user_email", user["email"], max_age=86400, key="old")
-    cookie_manager.set("user_id", str(user["user_id"]), max_age=86400)
+    cookie_manager.set(SESSION_COOKIE, create_session_token(user),
+                       max_age=SESSION_SECONDS, key="new")
 
 
 def clear_cookies_of_session(cookie_manager: CookieManager) -> None:
     """
     Clears the cookies that were stored in that session.
     """
-    cookie_manager.delete("logged_in", key="del")
-    cookie_manager.delete("user_email", key="dele")
-    cookie_manager.delete("user_id")
+    cookie_manager.delete(SESSION_COOKIE, key="del")
@@ -1,23 +1,29 @@
 """
 Streamlit app that runs the Dashboard.
 """
+import hmac
 import logging
+from os import environ
 from PIL import Image
 
 import bcrypt
 from dotenv import load_dotenv
 import extra_streamlit_components as stx
 from extra_streamlit_components.CookieManager import CookieManager
-import pandas as pd
+from psycopg2.extensions import connection
 import streamlit as st
 
-from cookies import set_cookies, clear_cookies_of_session
-from database import get_database_connection, load_all_database_info, get_user_info
-from rendering import render_dashboard, render_login_page
+from cookies import set_cookies, clear_cookies_of_session, read_session_token, SESSION_COOKIE
+from data_cache import DashboardCache, REFRESH_SECONDS
+from database import get_database_connection, get_credentials, get_user_by_email, save_credentials
+from rendering import get_user_scope, render_dashboard, render_login_page
 
 
 WEBSITE_URL = "http://3.10.142.198:5000/"
 LOGO_URL = "./dashboard/static/favicon.ico"
+ADMIN_EMAIL = "admin@saletracker.co.uk"
+DEFAULT_ADMIN_PASSWORD = "adminPassword"
+DEFAULT_USER_PASSWORD = "userPassword"
 
 im = Image.open(LOGO_URL)
 st.set_page_config(
@@ -25,26 +31,67 @@ st.set_page_config(
     layout="wide")
 
 
-def authenticate_user(users: list[dict], email: str, password: str) -> dict | None:
+@st.cache_resource
+def get_dashboard_cache() -> DashboardCache:
     """
-    Authenticates each user and only returns the user 
-    from the RDS if the details entered match, otherwise returns None.
+    Returns the cache of loaded frames shared by every session.
     """
-    for user in users:
-        if email == user["email"] and bcrypt.checkpw(password.encode('utf-8'), user["password"]):
-            return user
-    return None
+    return DashboardCache(get_database_connection,
+                          float(environ.get("DASHBOARD_REFRESH_SECONDS", REFRESH_SECONDS)))
 
 
-def handle_login(users: list[dict], email: str,
-                 password: str, cookie_manager: CookieManager):
+def authenticate_first_login(conn: connection, email: str, password: str) -> dict | None:
+    """
+    Returns the admin or user with the email if the password is the default one for
+    their account, storing its hash so that later logins are checked against it.
+    Returns None otherwise.
+    """
+    if email == ADMIN_EMAIL:
+        user = {"user_id": 0, "email": ADMIN_EMAIL}
+        default_password = environ.get("DASHBOARD_ADMIN_PASSWORD", DEFAULT_ADMIN_PASSWORD)
+    else:
+        user = get_user_by_email(conn, email)
+        default_password = DEFAULT_USER_PASSWORD
+
+    if user is None or not hmac.compare_digest(password.encode('utf-8'),
+                                               default_password.encode('utf-8')):
+        return None
+
+    save_credentials(conn, email, password, user["user_id"] or None, email == ADMIN_EMAIL)
+    return user
+
+
+def authenticate_user(conn: connection, email: str, password: str) -> dict | None:
+    """
+    Returns the user with the email if the password is theirs, otherwise None.
+    The email is looked up and the password checked against its one stored hash.
+    """
+    credentials = get_credentials(conn, email)
+
+    if credentials is None:
+        return authenticate_first_login(conn, email, password)
+
+    if not bcrypt.checkpw(password.encode('utf-8'),
+                          credentials["password_hash"].encode('utf-8')):
+        return None
+
+    return {"user_id": 0 if credentials["is_admin"] else credentials["user_id"],
+            "email": credentials["email"]}
+
+
+def handle_login(email: str, password: str, cookie_manager: CookieManager):
     """
     If the user is authenticated the session state details 
     are changed and cookies are set.
     If the user can't be authenticated 
     i.e. details are incorrect they will stay on the login page.
     """
-    user = authenticate_user(users, email, password)
+    conn = get_database_connection()
+    try:
+        user = authenticate_user(conn, email, password)
+    finally:
+        conn.close()
+
     if user:
         st.session_state['logged_in'] = True
         st.session_state['user_email'] = user["email"]
@@ -76,26 +123,24 @@ def main_display():
 
     logging.info("Loaded cookie manager")
 
-    users = get_user_info(get_database_connection())
+    # Check login state. A valid signed session needs no database read.
+    session = read_session_token(cookie_manager.get(SESSION_COOKIE))
 
-    # Check login state
-    logged_in = cookie_manager.get("logged_in")
-    user_email = cookie_manager.get("user_email")
-    user_id = cookie_manager.get("user_id")
-
-    if logged_in and user_email and user_id:
-        st.session_state['logged_in'] = logged_in == 'True'
-        st.session_state['user_email'] = user_email
-        st.session_state['user_id'] = int(user_id)
+    if session:
+        st.session_state['logged_in'] = True
+        st.session_state['user_email'] = session["email"]
+        st.session_state['user_id'] = session["user_id"]
 
     # Render login page or dashboard
     if not st.session_state.get('logged_in'):
         email, password = render_login_page()
         if st.button("Login"):
-            handle_login(users, email, password, cookie_manager)
+            handle_login(email, password, cookie_manager)
     else:
-        df = pd.DataFrame(load_all_database_info(get_database_connection()))
-        render_dashboard(df, users)
+        # Normal users only ever load their own subscriptions, products and prices.
+        # Widget clicks are served from the cache without reading the database.
+        frames = get_dashboard_cache().get_frames(get_user_scope())
+        render_dashboard(frames)
 
         st.sidebar.link_button("SaleTracker Website", WEBSITE_URL)
 
@@ -0,0 +1,233 @@
+"""
+Process-wide cache of the dashboard's frames, shared by every session.
+Each scope (one user, or the admin) is loaded in full once. After refresh_seconds,
+only the prices, subscriptions, products and users added or changed since the last
+load are read and merged in, so widget clicks do not touch the database and a refresh
+reads rows in proportion to what has changed.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from typing import Callable
+
+import pandas as pd
+from pandas import DataFrame
+from psycopg2.extensions import connection
+
+from database import (DashboardFrames, get_product_stats, load_dashboard_frames, load_frame,
+                      load_subscription_metrics, next_frames_version, set_column_types,
+                      POPULARITY_HISTORY_QUERY, PRODUCT_SUBSCRIBERS_QUERY, SUBSCRIPTIONS_QUERY)
+
+REFRESH_SECONDS = 60
+MAX_SCOPES = 500
+
+# Rows can commit out of id or time order, so each refresh re-reads a little behind
+# its high-water marks and drops the rows it already has.
+PRICE_ID_OVERLAP = 1000
+PRODUCT_CHANGE_OVERLAP = timedelta(minutes=10)
+
+NEW_SUBSCRIPTIONS_QUERY = """SELECT subscriptions.subscription_id, subscriptions.user_id,
+                subscriptions.product_id
+                FROM subscriptions
+                WHERE subscriptions.subscription_id > %(after)s
+                AND (%(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY subscriptions.subscription_id;"""
+
+# Products changed since the watermark, and every product newly subscribed to.
+CHANGED_PRODUCTS_QUERY = """SELECT products.product_id, products.product_name, products.product_url,
+                products.website_name, products.image_url, products.product_availability,
+                products.last_modified
+                FROM products
+                WHERE (products.last_modified > %(since)s
+                       OR products.product_id = ANY(%(new_product_ids)s))
+                AND products.product_id IN (
+                    SELECT subscriptions.product_id FROM subscriptions
+                    WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY products.product_id;"""
+
+# Prices recorded after the high-water mark, and the whole history of newly subscribed products.
+NEW_PRICES_QUERY = """SELECT prices.price_id, prices.updated_at, prices.price::float8 AS price,
+                prices.product_id
+                FROM prices
+                WHERE (prices.price_id > %(after)s OR prices.product_id = ANY(%(new_product_ids)s))
+                AND prices.product_id IN (
+                    SELECT subscriptions.product_id FROM subscriptions
+                    WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY prices.product_id, prices.updated_at DESC;"""
+
+NEW_USERS_QUERY = """SELECT users.user_id, users.email, users.first_name, users.last_name
+                FROM users
+                WHERE users.user_id > %(after)s
+                AND (%(user_id)s IS NULL OR users.user_id = %(user_id)s)
+                ORDER BY users.user_id;"""
+
+
+def get_high_water_mark(column: pd.Series, default):
+    """
+    Returns the largest value in the column, or the default if it is empty.
+    """
+    return column.max() if not column.empty else default
+
+
+def append_new_rows(df: DataFrame, new_rows: DataFrame, key: str) -> DataFrame:
+    """
+    Returns the frame with the new rows added, leaving out any it already holds.
+    Categories are merged, so string columns stay categorical.
+    """
+    new_rows = new_rows[~new_rows[key].isin(df[key])]
+    if new_rows.empty:
+        return df
+    if df.empty:
+        return new_rows.reset_index(drop=True)
+    return set_column_types(pd.concat([df, new_rows], ignore_index=True))
+
+
+def has_changed(products: DataFrame, reread_products: DataFrame) -> bool:
+    """
+    Returns whether any of the re-read products were modified after they were loaded.
+    """
+    loaded_at = products.set_index("Product ID")["Last Modified"]
+    modified_at = reread_products.set_index("Product ID")["Last Modified"]
+    return bool(modified_at.ne(loaded_at.reindex(modified_at.index)).any())
+
+
+class CachedFrames:
+    """
+    The frames loaded for one scope, with the high-water marks of what they hold.
+    """
+
+    def __init__(self, user_id: int | None, frames: DashboardFrames):
+        self.user_id = user_id
+        self.lock = Lock()
+        self.set_frames(frames)
+
+    def set_frames(self, frames: DashboardFrames) -> None:
+        """
+        Replaces the frames, and moves the high-water marks up to the rows they hold.
+        """
+        self.frames = frames
+        self.last_price_id = int(get_high_water_mark(frames.prices["Price ID"], 0))
+        self.last_subscription_id = int(get_high_water_mark(
+            frames.subscriptions["Subscription ID"], 0))
+        self.last_user_id = int(get_high_water_mark(frames.users["User ID"], 0))
+        self.last_modified = get_high_water_mark(frames.products["Last Modified"],
+                                                 datetime(1970, 1, 1))
+        self.loaded_at = monotonic()
+
+    def refresh(self, conn: connection) -> None:
+        """
+        Reads the rows added or changed since the last load and merges them in.
+        The subscription counts and the daily popularity, which are small, are
+        read again. The new frames replace the old ones whole, so sessions reading
+        the old frames are not affected.
+        """
+        params = {"user_id": self.user_id}
+        frames = self.frames
+
+        subscriptions = append_new_rows(frames.subscriptions, load_frame(
+            conn, NEW_SUBSCRIPTIONS_QUERY, {**params, "after": self.last_subscription_id}),
+            "Subscription ID")
+
+        # Only removals leave fewer subscriptions in the database than in the frame.
+        metrics = load_subscription_metrics(conn, params)
+        if metrics.subscription_count != len(subscriptions):
+            subscriptions = load_frame(conn, SUBSCRIPTIONS_QUERY, params)
+
+        subscribed_ids = subscriptions["Product ID"].unique()
+        loaded_ids = set(frames.products["Product ID"])
+        new_product_ids = [int(product_id) for product_id in subscribed_ids
+                           if product_id not in loaded_ids]
+
+        changed_products = load_frame(conn, CHANGED_PRODUCTS_QUERY, {
+            **params, "since": self.last_modified - PRODUCT_CHANGE_OVERLAP,
+            "new_product_ids": new_product_ids})
+        products = frames.products[
+            ~frames.products["Product ID"].isin(changed_products["Product ID"])
+            & frames.products["Product ID"].isin(subscribed_ids)]
+        products = append_new_rows(products, changed_products, "Product ID")
+
+        prices = frames.prices
+        if len(products) < len(frames.products):
+            prices = prices[prices["Product ID"].isin(subscribed_ids)]
+        prices = append_new_rows(prices, load_frame(conn, NEW_PRICES_QUERY, {
+            **params, "after": self.last_price_id - PRICE_ID_OVERLAP,
+            "new_product_ids": new_product_ids}), "Price ID")
+
+        users = append_new_rows(frames.users, load_frame(
+            conn, NEW_USERS_QUERY, {**params, "after": self.last_user_id}), "User ID")
+
+        popularity_history = load_frame(conn, POPULARITY_HISTORY_QUERY, params)
+
+        # Nothing new keeps the frames and their version, so cached charts stay valid.
+        if (prices is frames.prices and subscriptions is frames.subscriptions
+                and users is frames.users and not new_product_ids
+                and len(products) == len(frames.products)
+                and not has_changed(frames.products, changed_products)
+                and metrics == frames.metrics
+                and popularity_history.equals(frames.popularity_history)):
+            self.loaded_at = monotonic()
+            return
+
+        subscribers = load_frame(conn, PRODUCT_SUBSCRIBERS_QUERY, params)
+
+        self.set_frames(DashboardFrames(products=products, prices=prices,
+                                        subscriptions=subscriptions, users=users,
+                                        product_stats=get_product_stats(prices, subscribers),
+                                        popularity_history=popularity_history,
+                                        metrics=metrics, version=next_frames_version()))
+
+
+class DashboardCache:
+    """
+    The frames of the most recently used scopes, each refreshed at most once
+    every refresh_seconds. Connections are opened only when a scope is loaded
+    or refreshed, and closed straight after.
+    """
+
+    def __init__(self, connect: Callable[[], connection],
+                 refresh_seconds: float = REFRESH_SECONDS, max_scopes: int = MAX_SCOPES):
+        self.connect = connect
+        self.refresh_seconds = refresh_seconds
+        self.max_scopes = max_scopes
+        self.scopes = OrderedDict()
+        self.lock = Lock()
+
+    def get_frames(self, user_id: int | None) -> DashboardFrames:
+        """
+        Returns the frames for a user, or for the admin if the user id is None,
+        loading or refreshing them first if they are missing or out of date.
+        """
+        with self.lock:
+            cached = self.scopes.get(user_id)
+            if cached is not None:
+                self.scopes.move_to_end(user_id)
+
+        if cached is not None and monotonic() - cached.loaded_at < self.refresh_seconds:
+            return cached.frames
+
+        if cached is None:
+            conn = self.connect()
+            try:
+                cached = CachedFrames(user_id, load_dashboard_frames(conn, user_id))
+            finally:
+                conn.close()
+
+            with self.lock:
+                self.scopes[user_id] = cached
+                while len(self.scopes) > self.max_scopes:
+                    self.scopes.popitem(last=False)
+
+            return cached.frames
+
+        # Sessions arriving during a refresh wait for it rather than starting another.
+        with cached.lock:
+            if monotonic() - cached.loaded_at >= self.refresh_seconds:
+                conn = self.connect()
+                try:
+                    cached.refresh(conn)
+                finally:
+                    conn.close()
+
+        return cached.frames
@@ -1,7 +1,9 @@
 """
 Establishes a connection to the database.
 """
+from itertools import count
 from os import environ
+from typing import NamedTuple
 
 import bcrypt
 from dotenv import load_dotenv
@@ -11,16 +13,94 @@ from psycopg2 import connect
 from psycopg2.extensions import connection
 from psycopg2.extras import RealDictCursor
 
-SELECT_ALL_QUERY = """SELECT prices.price_id, prices.updated_at,
-                prices.price, products.product_id, products.product_name,
-                products.product_url, products.website_name, products.image_url,
-                products.product_availability, users.user_id, users.email,
-                users.first_name, users.last_name, subscriptions.subscription_id
+# Each frame holds one row per database row. A null user id loads every user's data,
+# for the admin; otherwise only the user's own subscriptions, products and prices.
+PRODUCTS_QUERY = """SELECT products.product_id, products.product_name, products.product_url,
+                products.website_name, products.image_url, products.product_availability,
+                products.last_modified
+                FROM products
+                WHERE products.product_id IN (
+                    SELECT subscriptions.product_id FROM subscriptions
+                    WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY products.product_id;"""
+
+PRICES_QUERY = """SELECT prices.price_id, prices.updated_at, prices.price::float8 AS price,
+                prices.product_id
                 FROM prices
-                JOIN products ON products.product_id = prices.product_id
-                JOIN subscriptions ON subscriptions.product_id = products.product_id
-                JOIN users ON users.user_id = subscriptions.user_id
-                ORDER BY product_id, updated_at DESC;"""
+                WHERE prices.product_id IN (
+                    SELECT subscriptions.product_id FROM subscriptions
+                    WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY prices.product_id, prices.updated_at DESC;"""
+
+SUBSCRIPTIONS_QUERY = """SELECT subscriptions.subscription_id, subscriptions.user_id,
+                subscriptions.product_id
+                FROM subscriptions
+                WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s
+                ORDER BY subscriptions.subscription_id;"""
+
+USERS_QUERY = """SELECT users.user_id, users.email, users.first_name, users.last_name
+                FROM users
+                WHERE %(user_id)s IS NULL OR users.user_id = %(user_id)s
+                ORDER BY users.user_id;"""
+
+# Counted in the database so the dashboard's totals do not need the subscriptions in memory.
+SUBSCRIPTION_METRICS_QUERY = """SELECT COUNT(DISTINCT subscriptions.user_id) AS user_count,
+                COUNT(DISTINCT subscriptions.product_id) AS product_count,
+                COUNT(*) AS subscription_count
+                FROM subscriptions
+                WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s;"""
+
+PRODUCT_SUBSCRIBERS_QUERY = """SELECT subscriptions.product_id,
+                COUNT(DISTINCT subscriptions.user_id) AS subscribers
+                FROM subscriptions
+                WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s
+                GROUP BY subscriptions.product_id
+                ORDER BY subscriptions.product_id;"""
+
+# Each product's subscriber count at the end of every day it changed, a running total
+# over the daily rollup the subscriptions triggers keep (see pipeline/schema.sql).
+POPULARITY_HISTORY_QUERY = """SELECT daily.product_id, daily.day,
+                SUM(daily.subscribed - daily.unsubscribed)
+                    OVER (PARTITION BY daily.product_id ORDER BY daily.day) AS subscribers
+                FROM product_popularity_daily AS daily
+                WHERE daily.product_id IN (
+                    SELECT subscriptions.product_id FROM subscriptions
+                    WHERE %(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s)
+                ORDER BY daily.product_id, daily.day;"""
+
+# Subscribed products whose names contain the term or a word like it, served by the
+# trigram index on product names. A null user id searches every user's products.
+SEARCH_PRODUCTS_QUERY = """SELECT products.product_id, products.product_name
+                FROM products
+                WHERE (products.product_name ILIKE %(contains)s
+                       OR %(term)s <%% products.product_name)
+                AND EXISTS (SELECT 1 FROM subscriptions
+                            WHERE subscriptions.product_id = products.product_id
+                            AND (%(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s))
+                ORDER BY products.product_name ILIKE %(prefix)s DESC,
+                         word_similarity(%(term)s, products.product_name) DESC,
+                         products.product_name
+                LIMIT %(limit)s;"""
+
+# Shown before anything has been typed, so the selectors start with a few products.
+FIRST_PRODUCTS_QUERY = """SELECT products.product_id, products.product_name
+                FROM products
+                WHERE EXISTS (SELECT 1 FROM subscriptions
+                              WHERE subscriptions.product_id = products.product_id
+                              AND (%(user_id)s IS NULL OR subscriptions.user_id = %(user_id)s))
+                ORDER BY products.product_id
+                LIMIT %(limit)s;"""
+
+GET_CREDENTIALS_QUERY = """SELECT credentials.email, credentials.password_hash,
+                credentials.user_id, credentials.is_admin
+                FROM credentials
+                WHERE credentials.email = %s;"""
+
+GET_USER_BY_EMAIL_QUERY = "SELECT users.user_id, users.email FROM users WHERE users.email = %s;"
+
+INSERT_CREDENTIALS_QUERY = """INSERT INTO credentials (email, password_hash, user_id, is_admin)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (email) DO NOTHING;"""
 
 COLUMNS = {"price_id": "Price ID", "updated_at": "Updated At",
            "price": "Price", "product_id": "Product ID",
@@ -28,7 +108,48 @@ COLUMNS = {"price_id": "Price ID", "updated_at": "Updated At",
            "image_url": "Image URL", "product_availability": "Product Availability",
            "website_name": "Website Name", "user_id": "User ID",
            "first_name": "User FirstName", "last_name": "User LastName",
-           "email": "User Email", "subscription_id": "Subscription ID"}
+           "email": "User Email", "subscription_id": "Subscription ID",
+           "last_modified": "Last Modified", "subscribers": "Subscribers", "day": "Day"}
+
+# Repeated strings are held once as categories, and ids in the narrowest type that fits.
+# Prices stay float64, as float32 cannot hold pence exactly and charts would show 24.989999771.
+COLUMN_TYPES = {"Price ID": "int32", "Updated At": "datetime64[ns]", "Price": "float64",
+                "Product ID": "int32", "Product Name": "category", "Product URL": "category",
+                "Image URL": "category", "Product Availability": "boolean",
+                "Website Name": "category", "User ID": "int32", "User FirstName": "category",
+                "User LastName": "category", "User Email": "category",
+                "Subscription ID": "int32", "Last Modified": "datetime64[ns]",
+                "Subscribers": "int32", "Day": "datetime64[ns]"}
+
+
+# Each load or change of the frames is given the next number, so anything worked out
+# from them can be cached against it.
+frames_versions = count(1)
+
+
+class SubscriptionMetrics(NamedTuple):
+    """
+    Totals shown in the dashboard's header, counted by the database.
+    """
+    user_count: int
+    product_count: int
+    subscription_count: int
+
+
+class DashboardFrames(NamedTuple):
+    """
+    The data shown on the dashboard, one frame per table, the statistics
+    of each product, its popularity by day, and the header's totals, all from
+    the same load.
+    """
+    products: DataFrame
+    prices: DataFrame
+    subscriptions: DataFrame
+    users: DataFrame
+    product_stats: DataFrame
+    popularity_history: DataFrame
+    metrics: SubscriptionMetrics
+    version: int
 
 
 def get_database_connection() -> connection:
@@ -47,16 +168,108 @@ def get_database_connection() -> connection:
         return error
 
 
-def load_all_database_info(db_conn: connection) -> DataFrame:
-    """Extract all data from the database."""
+def set_column_types(df: DataFrame) -> DataFrame:
+    """
+    Returns the frame with each of the dashboard's columns in its type from COLUMN_TYPES.
+    """
+    return df.astype({column: COLUMN_TYPES[column]
+                      for column in df.columns if column in COLUMN_TYPES})
 
-    with db_conn.cursor(cursor_factory=RealDictCursor) as cur:
 
-        cur.execute(SELECT_ALL_QUERY)
+def load_frame(db_conn: connection, query: str, params: dict) -> DataFrame:
+    """
+    Returns the results of a query as a data frame with the dashboard's column names
+    and types. The columns are kept even when there are no rows.
+    """
+    with db_conn.cursor() as cur:
+        cur.execute(query, params)
+        columns = [column.name for column in cur.description]
+        return set_column_types(
+            pd.DataFrame(cur.fetchall(), columns=columns).rename(columns=COLUMNS))
 
-        result = cur.fetchall()
 
-        return pd.DataFrame(result).rename(columns=COLUMNS)
+def load_dashboard_frames(db_conn: connection, user_id: int | None = None) -> DashboardFrames:
+    """
+    Returns the products, prices, subscriptions and users shown on the dashboard.
+    Only the user's own data is loaded if a user id is given.
+    """
+    params = {"user_id": user_id}
+    prices = load_frame(db_conn, PRICES_QUERY, params)
+
+    return DashboardFrames(products=load_frame(db_conn, PRODUCTS_QUERY, params),
+                           prices=prices,
+                           subscriptions=load_frame(db_conn, SUBSCRIPTIONS_QUERY, params),
+                           users=load_frame(db_conn, USERS_QUERY, params),
+                           product_stats=get_product_stats(
+                               prices, load_frame(db_conn, PRODUCT_SUBSCRIBERS_QUERY, params)),
+                           popularity_history=load_frame(db_conn, POPULARITY_HISTORY_QUERY, params),
+                           metrics=load_subscription_metrics(db_conn, params),
+                           version=next_frames_version())
+
+
+def next_frames_version() -> int:
+    """
+    Returns a version number that no other frames have had.
+    """
+    return next(frames_versions)
+
+
+def load_subscription_metrics(db_conn: connection, params: dict) -> SubscriptionMetrics:
+    """
+    Returns the number of subscribed users, subscribed products and subscriptions.
+    """
+    with db_conn.cursor() as cur:
+        cur.execute(SUBSCRIPTION_METRICS_QUERY, params)
+        return SubscriptionMetrics(*cur.fetchone())
+
+
+def get_product_stats(prices: DataFrame, subscribers: DataFrame) -> DataFrame:
+    """
+    Returns one row per product, indexed by product id, with its current, lowest and
+    highest prices, when its current price was recorded and when it first reached
+    its lowest price, and how many users are subscribed to it. The subscriber
+    counts come from PRODUCT_SUBSCRIBERS_QUERY.
+    """
+    product_ids = prices["Product ID"]
+    latest = prices.loc[prices["Updated At"].groupby(product_ids).idxmax()]
+    lowest_prices = prices["Price"].groupby(product_ids).transform("min")
+
+    stats = pd.DataFrame({
+        "Current Price": latest.set_index("Product ID")["Price"],
+        "Current Price At": latest.set_index("Product ID")["Updated At"],
+        "Lowest Price": prices["Price"].groupby(product_ids).min(),
+        "Lowest Price At": prices.loc[prices["Price"] == lowest_prices,
+                                      "Updated At"].groupby(product_ids).min(),
+        "Highest Price": prices["Price"].groupby(product_ids).max()})
+
+    stats = stats.join(subscribers.set_index("Product ID")["Subscribers"], how="outer")
+    stats["Subscribers"] = stats["Subscribers"].fillna(0).astype("int32")
+    stats.index = stats.index.astype("int32").rename("Product ID")
+
+    return stats
+
+
+def escape_like(term: str) -> str:
+    """
+    Returns the term with the characters that are special in LIKE patterns escaped.
+    """
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_products(db_conn: connection, term: str, limit: int,
+                    user_id: int | None = None) -> list[dict]:
+    """
+    Returns up to limit subscribed products whose names match the term, names starting
+    with it first. Only the user's products are searched if a user id is given.
+    An empty term returns the first products instead.
+    """
+    escaped_term = escape_like(term)
+    params = {"term": term, "contains": f"%{escaped_term}%", "prefix": f"{escaped_term}%",
+              "user_id": user_id, "limit": limit}
+
+    with db_conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(SEARCH_PRODUCTS_QUERY if term else FIRST_PRODUCTS_QUERY, params)
+        return cur.fetchall()
 
 
 def hash_password(password):
@@ -66,34 +279,34 @@ def hash_password(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
 
-def get_user_info(conn: connection) -> list[dict]:
+def get_credentials(conn: connection, email: str) -> dict | None:
     """
-    Gets all of the information from the users table in the RDS,
-    adds a password and account type to each user 
-    and returns a list of all users.
+    Returns the stored login for the email, or None if it has never logged in.
     """
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(GET_CREDENTIALS_QUERY, (email,))
+        return cur.fetchone()
 
-    admin = {"user_id": 0,
-             "email": "admin@saletracker.co.uk",
-             "type": "admin",
-             "first_name": "Admin",
-             "last_name": "Admin"}
-    admin["password"] = hash_password("adminPassword")
-
-    all_users = []
-    all_users.append(admin)
 
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM users;")
-    users = cur.fetchall()
-
-    for user in users:
+def get_user_by_email(conn: connection, email: str) -> dict | None:
+    """
+    Returns the id and email of the user with the email, or None if there is none.
+    """
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(GET_USER_BY_EMAIL_QUERY, (email,))
+        return cur.fetchone()
 
-        user["password"] = hash_password('userPassword')
-        user["type"] = 'user'
-        all_users.append(user)
 
-    return all_users
+def save_credentials(conn: connection, email: str, password: str,
+                     user_id: int | None, is_admin: bool) -> None:
+    """
+    Stores a bcrypt hash of the password as the login for the email,
+    unless one has already been stored.
+    """
+    with conn.cursor() as cur:
+        cur.execute(INSERT_CREDENTIALS_QUERY, (email, hash_password(password).decode('utf-8'),
+                                               user_id, is_admin))
+    conn.commit()
 
 
 if __name__ == "__main__":
@@ -102,4 +315,4 @@ if __name__ == "__main__":
 
     conn = get_database_connection()
 
-    print(load_all_database_info(conn))
+    print(load_dashboard_frames(conn))
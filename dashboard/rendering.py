@@ -1,18 +1,76 @@
 """
 Script with rendering functions used to show streamlit displays.
 """
+import json
+from typing import Callable
+
+import altair as alt
 import pandas as pd
-from pandas import DataFrame, Series
+from pandas import DataFrame
 import streamlit as st
 
+from chart_cache import ChartCache, get_chart_key
+from database import DashboardFrames, get_database_connection, search_products
 from visualisations import (get_latest_price_readings,
                             get_popularity_of_products,
+                            get_popularity_over_time,
                             get_price_of_products_over_time)
 
 FIRST_PRODUCT = 0
-DEFAULT_MIN = 1
 DEFAULT_PRODUCT = 3
+SEARCH_RESULT_LIMIT = 20
+SEARCH_CACHE_SECONDS = 60
 LOGO_URL = "./static/Logo.png"
+ADMIN_SECTIONS = ("Latest Prices", "Popularity", "Price History", "Users")
+USER_SECTIONS = ("Latest Prices", "Price History")
+
+# Widgets inside a fragment rerun only that fragment. It was experimental before Streamlit 1.37.
+fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+
+@st.cache_data(ttl=SEARCH_CACHE_SECONDS, show_spinner=False)
+def search_product_names(term: str, user_id: int | None) -> list[str]:
+    """
+    Returns the names of the products matching the search term, without repeats.
+    Results are cached, so each search opens a connection of its own rather than
+    keeping one open that the database could drop.
+    """
+    conn = get_database_connection()
+    try:
+        products = search_products(conn, term, SEARCH_RESULT_LIMIT, user_id)
+    finally:
+        conn.close()
+    return list(dict.fromkeys(product["product_name"] for product in products))
+
+
+@st.cache_resource
+def get_chart_cache() -> ChartCache:
+    """
+    Returns the cache of chart specs shared by every session.
+    """
+    return ChartCache()
+
+
+def show_chart(frames: DashboardFrames, chart_name: str, selected_names: list,
+               build_chart: Callable[[], alt.TopLevelMixin],
+               continues_to_now: bool = False) -> None:
+    """
+    Displays a chart of the selected products. The chart is only built if it has not
+    already been built from the same frames with the same products selected.
+    Charts continued to now are also rebuilt as time passes.
+    """
+    key = get_chart_key(chart_name, frames.version, selected_names, continues_to_now)
+    spec = get_chart_cache().get_spec(key, build_chart)
+    st.vega_lite_chart(json.loads(spec), use_container_width=True)
+
+
+def get_user_scope() -> int | None:
+    """
+    Returns the id of the logged in user, whose data is loaded and searched,
+    or None for the admin, who sees every user's data.
+    """
+    user_id = st.session_state.get('user_id')
+    return None if user_id == 0 else user_id
 
 
 def render_login_page() -> tuple:
@@ -33,138 +91,194 @@ def render_login_page() -> tuple:
     return email, password
 
 
-def get_most_recent_price(most_recent: DataFrame) -> Series:
+def with_product_names(df: DataFrame, products: DataFrame) -> DataFrame:
     """
-    Returns the most recent price information.
+    Returns the rows of a frame with a Product ID column, with their product's name added.
     """
-    sorted_product_df = most_recent.sort_values(
-        by='Updated At', ascending=False)
+    return df.merge(products[["Product ID", "Product Name"]], on="Product ID")
 
-    return sorted_product_df.iloc[0]
+
+def select_products(df: DataFrame, products: DataFrame, selected_names: list) -> DataFrame:
+    """
+    Returns the rows of a frame with a Product ID column that belong to the
+    selected products, with their names added.
+    """
+    selected = products[products["Product Name"].isin(selected_names)]
+    return with_product_names(df[df["Product ID"].isin(selected["Product ID"])], selected)
 
 
-def get_price_info(most_recent: DataFrame, sort_value) -> Series:
+def get_latest_prices(frames: DashboardFrames) -> DataFrame:
     """
-    Displays the price information for the most recent price for a particular product. 
-    If sort_value is False the highest price is returned. 
-    If the sort_value is True the lowest price is returned.
+    Returns the latest price reading of each product.
     """
-    sorted_product_df = most_recent.sort_values(
-        by='Price', ascending=sort_value)
-    return sorted_product_df.iloc[0]
+    latest_prices = frames.product_stats[["Current Price", "Current Price At"]].dropna()
+    return latest_prices.rename(columns={"Current Price": "Price",
+                                         "Current Price At": "Updated At"}).reset_index()
 
 
-def render_sidebar(df: DataFrame) -> None:
+def get_popularity(frames: DashboardFrames) -> DataFrame:
+    """
+    Returns the number of users subscribed to each product.
+    """
+    popularity = frames.product_stats[["Subscribers"]].rename(columns={"Subscribers": "Popularity"})
+    return popularity.reset_index()
+
+
+def render_sidebar(frames: DashboardFrames) -> None:
     """
     Creates a sidebar element that shows the image of the product
     depending on the product selected in the selectbox.
     """
-    st.sidebar.title('Product Image Viewer')
+    with st.sidebar:
+        display_product_viewer(frames)
 
-    selected_product_name = st.sidebar.selectbox(
-        'Select a Product', df['Product Name'].unique())
-    filtered_df = df[df['Product Name'] == selected_product_name]
 
-    if not filtered_df.empty:
+@fragment
+def display_product_viewer(frames: DashboardFrames) -> None:
+    """
+    Displays the selected product's image, prices, availability and link.
+    Searching or choosing a product reruns only the viewer.
+    """
+    st.title('Product Image Viewer')
 
-        # Displays the image of the selected product.
-        image_url = filtered_df['Image URL'].iloc[0]
-        st.sidebar.image(image_url)
+    search_term = st.text_input(
+        'Search Products', key="sidebar_search",
+        placeholder="Start typing a product name...").strip()
+    selected_product_name = st.selectbox(
+        'Select a Product', search_product_names(search_term, get_user_scope()))
+    selected_products = frames.products[frames.products['Product Name'] == selected_product_name]
 
-        # Different prices the product is/has been.
-        most_recent_price = get_most_recent_price(filtered_df)
-        st.sidebar.write(
-            f'Current price: £{round(most_recent_price["Price"], 2)}')
+    if not selected_products.empty:
+        product = selected_products.iloc[0]
 
-        highest_price = get_price_info(filtered_df, False)
-        st.sidebar.write(
-            f'Highest Price: £{round(highest_price["Price"], 2)}')
+        # Displays the image of the selected product.
+        st.image(product['Image URL'])
 
-        lowest_price = get_price_info(filtered_df, True)
-        st.sidebar.write(f'Lowest Price: £{round(lowest_price["Price"], 2)}')
+        # Different prices the product is/has been.
+        if product['Product ID'] in frames.product_stats.index:
+            stats = frames.product_stats.loc[product['Product ID']]
+            if pd.notna(stats["Current Price"]):
+                st.write(f'Current price: £{stats["Current Price"]:.2f}')
+                st.write(f'Highest Price: £{stats["Highest Price"]:.2f}')
+                st.write(f'Lowest Price: £{stats["Lowest Price"]:.2f} '
+                                 f'(first seen {stats["Lowest Price At"]:%d %b %Y})')
 
         # Changes the Product Availability from True/False to In Stock/Out of Stock.
-        print(most_recent_price["Product Availability"])
-        if most_recent_price["Product Availability"] == True:
-            st.sidebar.write(
+        availability = product["Product Availability"]
+        if pd.notna(availability) and availability:
+            st.write(
                 'Availability: In Stock')
         else:
-            st.sidebar.write(
+            st.write(
                 'Availability: Out of Stock')
 
         # Button that links to the products URL.
-        st.sidebar.link_button(
-            "Product Page", most_recent_price["Product URL"])
+        st.link_button(
+            "Product Page", product["Product URL"])
 
     else:
-        st.sidebar.write("No image available for the selected product.")
+        st.write("No image available for the selected product.")
 
 
-def display_admin_main_body(df: DataFrame) -> None:
+def choose_section(sections: tuple, key_value: str) -> str:
     """
-    Displays all of the admin main body for streamlit.
+    Returns the section picked from the row of sections. Only that section is run.
     """
-    sorted_df = df.sort_values(
-        by=['Product ID', 'Updated At'], ascending=[True, False])
+    return st.radio("Section", sections, horizontal=True, key=key_value,
+                    label_visibility="collapsed")
 
-    most_recent_prices = sorted_df.groupby('Product ID').first()
 
-    # Header metrics
-    head_cols = st.columns(3)
-    with head_cols[0]:
-        st.metric("Total No. of Users :bust_in_silhouette:",
-                  df["User Email"].nunique())
+@fragment
+def display_latest_prices(frames: DashboardFrames, key_value: str) -> None:
+    """
+    Displays the latest price of each selected product.
+    """
+    selected_latest = get_selected_products(key_value)
 
-    with head_cols[1]:
-        st.metric("Total No. of Products", df["Product Name"].nunique())
+    if not selected_latest:
+        st.error("Please select at least one product.")
+    else:
+        show_chart(frames, "latest_prices", selected_latest,
+                   lambda: get_latest_price_readings(select_products(
+                       get_latest_prices(frames), frames.products, selected_latest)))
 
-    with head_cols[2]:
-        st.metric("Total No. of Subscriptions",
-                  df["Subscription ID"].nunique())
 
-    # Main body of Dashboard
-    body_cols = st.columns(2)
-    with body_cols[0]:
+@fragment
+def display_popularity(frames: DashboardFrames) -> None:
+    """
+    Displays how many users are subscribed to each selected product, now and over time.
+    """
+    selected_popular = get_selected_products("all_admin_pop")
+
+    if not selected_popular:
+        st.error("Please select at least one product.")
+    else:
+        body_cols = st.columns(2)
+        with body_cols[0]:
+            show_chart(frames, "popularity", selected_popular,
+                       lambda: get_popularity_of_products(select_products(
+                           get_popularity(frames), frames.products, selected_popular)))
 
-        name_in_selected_products_price = get_names_of_selected_products(
-            most_recent_prices, "most_recent")
+        with body_cols[1]:
+            show_chart(frames, "popularity_over_time", selected_popular,
+                       lambda: get_popularity_over_time(select_products(
+                           frames.popularity_history, frames.products, selected_popular)),
+                       continues_to_now=True)
 
-        if not name_in_selected_products_price.any():
-            st.error("Please select at least one product.")
 
-        else:
-            st.altair_chart(get_latest_price_readings(
-                most_recent_prices[name_in_selected_products_price]), use_container_width=True)
+@fragment
+def display_price_history(frames: DashboardFrames, key_value: str) -> None:
+    """
+    Displays the price of each selected product over time.
+    """
+    selected_history = get_selected_products(key_value)
 
-    with body_cols[1]:
-        # Need to be repeated due to the use of a different dataframe.
-        name_in_selected_products = get_names_of_selected_products(
-            df, "all_admin_pop")
+    if not selected_history:
+        st.error("Please select at least one product.")
+    else:
+        show_chart(frames, "price_history", selected_history,
+                   lambda: get_price_of_products_over_time(select_products(
+                       frames.prices, frames.products, selected_history)),
+                   continues_to_now=True)
 
-        if not name_in_selected_products.any():
-            st.error("Please select at least one product.")
-        else:
-            st.altair_chart(get_popularity_of_products(df[name_in_selected_products]),
-                            use_container_width=True)
 
-    # Repeated in order for the selection bar to look more presentable.
-    name_in_selected_products_all = get_names_of_selected_products(
-        df, "all_admin")
+def display_admin_main_body(frames: DashboardFrames) -> None:
+    """
+    Displays all of the admin main body for streamlit.
+    The header totals are always shown, and below them only the chosen section.
+    """
+    # Header metrics
+    head_cols = st.columns(3)
+    with head_cols[0]:
+        st.metric("Total No. of Users :bust_in_silhouette:", frames.metrics.user_count)
+
+    with head_cols[1]:
+        st.metric("Total No. of Products", frames.metrics.product_count)
+
+    with head_cols[2]:
+        st.metric("Total No. of Subscriptions", frames.metrics.subscription_count)
 
-    st.altair_chart(get_price_of_products_over_time(df[name_in_selected_products_all]),
-                    use_container_width=True)
+    # Main body of Dashboard
+    section = choose_section(ADMIN_SECTIONS, "admin_section")
+
+    if section == "Latest Prices":
+        display_latest_prices(frames, "most_recent")
+    elif section == "Popularity":
+        display_popularity(frames)
+    elif section == "Price History":
+        display_price_history(frames, "all_admin")
+    else:
+        display_user_admin_info(frames.users)
 
 
-def display_user_admin_info(users: list[dict]) -> None:
+@fragment
+def display_user_admin_info(users: DataFrame) -> None:
     """
     Displays a table showing all user information.
     """
 
     st.title("User Information:")
-    admin_df = pd.DataFrame(users)
-    user_information = admin_df.loc[:, admin_df.columns != "password"]
-    wanted_user = user_information[["user_id", "first_name",
-                                    "last_name", "email"]]
+    wanted_user = users[["User ID", "User FirstName", "User LastName", "User Email"]]
     wanted_user.columns = ["User ID", "First Name", "Last Name", "Email"]
 
     selected_users = get_multiselect_products(
@@ -175,7 +289,7 @@ def display_user_admin_info(users: list[dict]) -> None:
                  hide_index=True, use_container_width=True)
 
 
-def render_admin_dashboard(df: DataFrame, users: list[dict]) -> None:
+def render_admin_dashboard(frames: DashboardFrames) -> None:
     """
     Creates the admin dashboard to see all admin data.
     """
@@ -187,11 +301,9 @@ def render_admin_dashboard(df: DataFrame, users: list[dict]) -> None:
     st.write(
         f"Welcome, {st.session_state['user_email']}! You're logged in to the Admin Dashboard.")
 
-    display_admin_main_body(df)
-
-    display_user_admin_info(users)
+    display_admin_main_body(frames)
 
-    render_sidebar(df)
+    render_sidebar(frames)
 
 
 def get_multiselect_products(min_default: int, products: DataFrame,
@@ -199,95 +311,72 @@ def get_multiselect_products(min_default: int, products: DataFrame,
                              title: str) -> st.multiselect:
     """Returns a multiselect bar that you are able to select product names from."""
 
-    return st.multiselect(title,
-                          list(products[value].unique()),
-                          default=products[value].unique(
-                          )[FIRST_PRODUCT:min_default],
+    options = products[value].unique().tolist()
+    return st.multiselect(title, options,
+                          default=options[FIRST_PRODUCT:min_default],
                           placeholder="Please select a product...", key=key_value)
 
 
-def get_selected_products(products: DataFrame, key_value: str) -> list:
+def get_selected_products(key_value: str) -> list:
     """
-    Returns the selected plants in the sidebar.
-    By Default this returns 1 if you have less than 3 products and
-    3 if you have more than 3.
+    Returns the names of the selected products.
+    The options are searched for as the user types rather than listing every product,
+    and the first 3 products are selected by default.
     """
-    if len(products["Product Name"].unique()) < 3:
-        return get_multiselect_products(DEFAULT_MIN, products,
-                                        key_value, "Product Name",
-                                        "Selected Products")
-
-    return get_multiselect_products(DEFAULT_PRODUCT, products,
-                                    key_value, "Product Name",
-                                    "Selected Products")
+    search_term = st.text_input("Search Products", key=f"{key_value}_search",
+                                placeholder="Start typing a product name...").strip()
+    matches = search_product_names(search_term, get_user_scope())
 
+    # Chosen products stay as options when a new search no longer matches them.
+    selected = st.session_state.get(key_value)
+    if selected is None:
+        selected = matches[FIRST_PRODUCT:DEFAULT_PRODUCT]
 
-def get_names_of_selected_products(products: DataFrame, key_value: str) -> pd.Series:
-    """
-    Returns the names of the selected products in the sidebar.
-    """
-    selected_products_names = get_selected_products(products, key_value)
-    return products["Product Name"].isin(selected_products_names)
+    return st.multiselect("Selected Products", list(dict.fromkeys(selected + matches)),
+                          default=selected, placeholder="Please select a product...",
+                          key=key_value)
 
 
-def display_user_specific_data(df: DataFrame) -> None:
+def display_user_specific_data(frames: DashboardFrames) -> None:
     """
     Creates a user specific display.
     """
-    sorted_df = df.sort_values(
-        by=['Product ID', 'Updated At'], ascending=[True, False])
-    most_recent_prices = sorted_df.groupby('Product ID').first()
-
     # User Header Metrics
     head_cols = st.columns(2)
     with head_cols[0]:
-        st.metric("Total No. of Products", df["Product Name"].nunique())
+        st.metric("Total No. of Products", frames.metrics.product_count)
 
     with head_cols[1]:
         st.metric("Total Price of Products",
-                  f'£{round(most_recent_prices["Price"].astype(float).sum(), 2)}')
-
-    # User latest product price bar chart.
-    name_in_selected_products = get_names_of_selected_products(
-        most_recent_prices, "recent_user")
-    if not name_in_selected_products.any():
-        st.error("Please select at least one product.")
+                  f'£{frames.product_stats["Current Price"].sum():.2f}')
 
+    # User latest product price bar chart, or product price over time.
+    if choose_section(USER_SECTIONS, "user_section") == "Latest Prices":
+        display_latest_prices(frames, "recent_user")
     else:
-        st.altair_chart(get_latest_price_readings(
-            most_recent_prices[name_in_selected_products]), use_container_width=True)
-
-    # User product price over time.
-    name_in_selected_products_all = get_names_of_selected_products(
-        df, "recent_user_all")
-    if not name_in_selected_products_all.any():
-        st.error("Please select at least one Product.")
-    else:
-        st.altair_chart(get_price_of_products_over_time(df[name_in_selected_products_all]),
-                        use_container_width=True)
+        display_price_history(frames, "recent_user_all")
 
 
-def render_user_dashboard(df: DataFrame) -> None:
+def render_user_dashboard(frames: DashboardFrames) -> None:
     """
     Creates the user dashboard in which each user will only be able to
-    see information relevant to them.
+    see information relevant to them. The frames hold only the user's own data.
     """
-    user_specific_df = df[df['User ID'] == st.session_state['user_id']]
     st.markdown("""
         <h1>
             <center><span style='color: #007bff;'>Sale</span>Tracker Dashboard</center>
         </h1>
         """, unsafe_allow_html=True)
     st.write(f"Welcome, {st.session_state['user_email']}! You're logged in.")
-    render_sidebar(user_specific_df)
-    display_user_specific_data(user_specific_df)
+    render_sidebar(frames)
+    display_user_specific_data(frames)
 
 
-def render_dashboard(df: DataFrame, users: list[dict]) -> None:
+def render_dashboard(frames: DashboardFrames) -> None:
     """
     Decides which dashboard to show depending on the type of account logged in.
     """
     if st.session_state.get('user_id') == 0:
-        render_admin_dashboard(df, users)
+        render_admin_dashboard(frames)
     else:
-        render_user_dashboard(df)
+        render_user_dashboard(frames)
@@ -0,0 +1,64 @@
+"""
+Tests the dashboard's chart cache.
+"""
+import json
+from unittest.mock import MagicMock, patch
+
+import altair as alt
+import pandas as pd
+
+from chart_cache import ChartCache, NOW_BUCKET_SECONDS, get_chart_key
+
+
+def make_chart() -> alt.Chart:
+    """
+    Returns a bar chart with more rows than Altair allows by default.
+    """
+    return alt.Chart(pd.DataFrame({"x": range(6000)})).mark_bar().encode(x="x:Q")
+
+
+def test_chart_built_once_per_key():
+    """
+    Test that a chart is built the first time it is asked for and then served from the cache.
+    """
+    build_chart = MagicMock(side_effect=make_chart)
+    cache = ChartCache()
+
+    first = cache.get_spec(("prices", 1, ("Coat",)), build_chart)
+    second = cache.get_spec(("prices", 1, ("Coat",)), build_chart)
+    cache.get_spec(("prices", 2, ("Coat",)), build_chart)
+
+    assert first is second
+    assert json.loads(first)["mark"]["type"] == "bar"
+    assert build_chart.call_count == 2
+
+
+def test_least_recently_used_chart_evicted():
+    """
+    Test that the least recently used chart is dropped when the cache is full.
+    """
+    cache = ChartCache(max_charts=2)
+    cache.get_spec(("prices", 1, ()), make_chart)
+    cache.get_spec(("popularity", 1, ()), make_chart)
+    cache.get_spec(("prices", 1, ()), make_chart)
+
+    cache.get_spec(("latest_prices", 1, ()), make_chart)
+
+    assert list(cache.specs) == [("prices", 1, ()), ("latest_prices", 1, ())]
+
+
+@patch("chart_cache.time")
+def test_chart_continued_to_now_changes_key_over_time(mock_time):
+    """
+    Test that a chart continued to now gets a new key once the time bucket passes,
+    while other charts keep theirs.
+    """
+    mock_time.return_value = 1000 * NOW_BUCKET_SECONDS
+    first = get_chart_key("price_history", 1, ["Coat", "Boots"], continues_to_now=True)
+    first_latest = get_chart_key("latest_prices", 1, ["Coat", "Boots"])
+
+    mock_time.return_value = 1001 * NOW_BUCKET_SECONDS
+    second = get_chart_key("price_history", 1, ["Boots", "Coat"], continues_to_now=True)
+
+    assert first != second
+    assert get_chart_key("latest_prices", 1, ["Boots", "Coat"]) == first_latest
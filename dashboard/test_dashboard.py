@@ -6,53 +6,126 @@ import pandas as pd
 import pytest
 from unittest.mock import patch, MagicMock
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from cookies import create_session_token, read_session_token, SESSION_SECONDS
 from dashboard import authenticate_user, handle_login, logout_of_dashboard
-from database import get_database_connection, load_all_database_info, get_user_info
+from visualisations import (downsample_price_series, get_latest_price_readings,
+                            get_popularity_over_time, get_price_of_products_over_time)
+from database import (get_database_connection, get_product_stats, load_dashboard_frames, load_frame,
+                      save_credentials, set_column_types, DashboardFrames,
+                      search_products, SubscriptionMetrics, SEARCH_PRODUCTS_QUERY, FIRST_PRODUCTS_QUERY)
 
 
 @pytest.fixture
-def users():
+def stored_credentials():
     """
-    Fixture for example users to be tested.
+    Fixture for a user's stored login.
     """
-    return [
-        {'email': 'person1@email.com',
-            'password': bcrypt.hashpw('password1'.encode('utf-8'), bcrypt.gensalt())},
-        {'email': 'person2@email.com',
-            'password': bcrypt.hashpw('password2'.encode('utf-8'), bcrypt.gensalt())}
-    ]
+    return {'email': 'person1@email.com', 'user_id': 1, 'is_admin': False,
+            'password_hash': bcrypt.hashpw('password1'.encode('utf-8'),
+                                           bcrypt.gensalt()).decode('utf-8')}
 
 
-def test_authenticate_correct_password(users):
+@patch('dashboard.get_credentials')
+def test_authenticate_correct_password(mock_get_credentials, stored_credentials):
     """
     Tests that the function successfully validates a correct password.
     """
-    user = authenticate_user(users, 'person1@email.com', 'password1')
-    assert user is not None
+    mock_get_credentials.return_value = stored_credentials
+
+    user = authenticate_user(MagicMock(), 'person1@email.com', 'password1')
+
+    assert user == {'user_id': 1, 'email': 'person1@email.com'}
 
 
-def test_reject_incorrect_password(users):
+@patch('dashboard.get_credentials')
+def test_reject_incorrect_password(mock_get_credentials, stored_credentials):
     """
     Tests that incorrect passwords are not authenticated.
     """
+    mock_get_credentials.return_value = stored_credentials
 
-    user = authenticate_user(users, 'person1@email.com', 'hello1')
+    user = authenticate_user(MagicMock(), 'person1@email.com', 'hello1')
     assert user is None
 
 
-def test_reject_unknown_user(users):
+@patch('dashboard.get_user_by_email')
+@patch('dashboard.get_credentials')
+def test_reject_unknown_user(mock_get_credentials, mock_get_user_by_email):
     """
     Tests that unknown users are not authenticated.
     """
+    mock_get_credentials.return_value = None
+    mock_get_user_by_email.return_value = None
 
-    user = authenticate_user(users, 'unknown_person@email.com', 'password1')
+    user = authenticate_user(MagicMock(), 'unknown_person@email.com', 'userPassword')
     assert user is None
 
 
+@patch('dashboard.save_credentials')
+@patch('dashboard.get_user_by_email')
+@patch('dashboard.get_credentials')
+def test_first_login_stores_credentials(mock_get_credentials, mock_get_user_by_email,
+                                        mock_save_credentials):
+    """
+    Tests that a user's first login with the default password stores its hash.
+    """
+    mock_conn = MagicMock()
+    mock_get_credentials.return_value = None
+    mock_get_user_by_email.return_value = {'user_id': 2, 'email': 'person2@email.com'}
+
+    user = authenticate_user(mock_conn, 'person2@email.com', 'userPassword')
+
+    assert user == {'user_id': 2, 'email': 'person2@email.com'}
+    mock_save_credentials.assert_called_once_with(
+        mock_conn, 'person2@email.com', 'userPassword', 2, False)
+
+
+@patch('dashboard.save_credentials')
+@patch('dashboard.get_credentials')
+def test_admin_first_login(mock_get_credentials, mock_save_credentials):
+    """
+    Tests that the admin logs in as user 0 without a row in the users table.
+    """
+    mock_get_credentials.return_value = None
+
+    user = authenticate_user(MagicMock(), 'admin@saletracker.co.uk', 'adminPassword')
+
+    assert user['user_id'] == 0
+    assert mock_save_credentials.call_args.args[3:] == (None, True)
+
+
+def test_session_token_round_trip():
+    """
+    Tests that a session token gives back the user it was made for until it expires.
+    """
+    token = create_session_token({'user_id': 3, 'email': 'person@email.com'}, now=1000)
+
+    assert read_session_token(token, now=1001) == {'user_id': 3, 'email': 'person@email.com'}
+    assert read_session_token(token, now=1000 + SESSION_SECONDS) is None
+
+
+def test_tampered_session_token_rejected():
+    """
+    Tests that a token whose contents were changed is not accepted.
+    """
+    token = create_session_token({'user_id': 3, 'email': 'person@email.com'})
+    payload, signature = token.rsplit(".", 1)
+    forged_payload = urlsafe_b64encode(urlsafe_b64decode(payload).replace(b'3', b'0', 1))
+
+    assert read_session_token(f"{forged_payload.decode()}.{signature}") is None
+    assert read_session_token("not-a-token") is None
+    assert read_session_token(None) is None
+
+
+@patch('dashboard.get_database_connection')
 @patch('dashboard.authenticate_user')
 @patch('dashboard.st.session_state')
 @patch('dashboard.st.error')
-def test_handle_login(mock_st_error, mock_session_state, mock_authenticate_user):
+def test_handle_login(mock_st_error, mock_session_state, mock_authenticate_user,
+                      mock_get_database_connection):
     """
     Tests that an error is not called, and that logged_in, user_email
     and user_id are each called once when the login is successful. 
@@ -60,7 +133,6 @@ def test_handle_login(mock_st_error, mock_session_state, mock_authenticate_user)
     mock_authenticate_user.return_value = {
         'user_id': 1, 'email': 'person@email.com'}
     handle_login(
-        users=mock_authenticate_user.return_value,
         email='person@email.com',
         password='password1',
         cookie_manager=MagicMock()
@@ -116,84 +188,202 @@ def test_get_database_connection_connection_error(mock_connect):
     assert isinstance(result, ConnectionError)
 
 
-@patch("database.connect")
-def test_load_all_database_info(mock_connect):
-    """
-    Test that checks data is returned in the format of COLUMNS as specified in the SELECT_ALL_QUERY.
-    """
-    mock_connection = MagicMock()
-    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
-    mock_cursor.fetchall.return_value = [
-        {"price_id": 1, "updated_at": "2022-01-01", "price": 100.0, "product_id": 123,
-         "product_name": "Example Product", "product_url": "http://example.com",
-         "image_url": "http://example.com/image.jpg", "product_availability": "In Stock",
-         "website_name": "Example Website", "user_id": 456, "first_name": "John",
-         "last_name": "Doe", "email": "john.doe@example.com", "subscription_id": 789}
-    ]
-    result = load_all_database_info(mock_connection)
-
-    # Check that result is in the form of a data frame
-    assert isinstance(result, pd.DataFrame)
-
-    expected_df = pd.DataFrame([
-        {"Price ID": 1, "Updated At": "2022-01-01", "Price": 100.0, "Product ID": 123,
-         "Product Name": "Example Product", "Product URL": "http://example.com",
-         "Image URL": "http://example.com/image.jpg", "Product Availability": "In Stock",
-         "Website Name": "Example Website", "User ID": 456, "User FirstName": "John",
-         "User LastName": "Doe", "User Email": "john.doe@example.com", "Subscription ID": 789}
-    ])
-    # Check if column names are appropriately renamed
-    assert result.equals(expected_df)
-
-
-@patch("database.connection")
+@patch("database.get_product_stats")
+def test_load_dashboard_frames_scoped_to_user(mock_get_product_stats):
+    """
+    Test that each table is loaded into its own frame with the dashboard's column names,
+    and that a user's queries are limited to their own data.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.description = [MagicMock(), MagicMock()]
+    mock_cursor.description[0].name = "product_id"
+    mock_cursor.description[1].name = "price"
+    mock_cursor.fetchall.return_value = [(123, 100.0)]
+    mock_cursor.fetchone.return_value = (1, 2, 3)
+
+    result = load_dashboard_frames(mock_conn, user_id=456)
+
+    assert isinstance(result, DashboardFrames)
+    assert result.prices.equals(pd.DataFrame([{"Product ID": 123, "Price": 100.0}]).astype(
+        {"Product ID": "int32", "Price": "float64"}))
+    assert result.metrics == SubscriptionMetrics(user_count=1, product_count=2, subscription_count=3)
+    assert mock_cursor.execute.call_count == 7
+    for call in mock_cursor.execute.call_args_list:
+        assert call.args[1] == {"user_id": 456}
+
+
+@patch("database.get_product_stats")
+def test_load_dashboard_frames_keeps_columns_when_empty(mock_get_product_stats):
+    """
+    Test that a query with no rows still gives a frame with its columns.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.description = [MagicMock()]
+    mock_cursor.description[0].name = "subscription_id"
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.return_value = (0, 0, 0)
+
+    result = load_dashboard_frames(mock_conn)
+
+    assert result.subscriptions.columns.tolist() == ["Subscription ID"]
+    assert result.subscriptions.empty
+    assert result.subscriptions["Subscription ID"].dtype == "int32"
+
+
+def test_load_frame_sets_column_types():
+    """
+    Test that repeated strings become categories and timestamps become datetimes.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.description = [MagicMock(), MagicMock(), MagicMock()]
+    for column, name in zip(mock_cursor.description,
+                            ["website_name", "product_availability", "last_modified"]):
+        column.name = name
+    mock_cursor.fetchall.return_value = [("ASOS", True, datetime(2024, 1, 1)),
+                                         ("ASOS", None, datetime(2024, 1, 2))]
+
+    products = load_frame(mock_conn, "SELECT", {})
+
+    assert products["Website Name"].dtype == "category"
+    assert products["Product Availability"].dtype == "boolean"
+    assert products["Last Modified"].dtype == "datetime64[ns]"
+
+
+def test_get_product_stats():
+    """
+    Test that each product's current, lowest and highest prices are worked out and joined to
+    its subscriber count, including for products with no prices or no subscribers.
+    """
+    prices = pd.DataFrame({"Product ID": [1, 1, 1, 2], "Price": [5.0, 4.0, 4.0, 9.0],
+                           "Updated At": [datetime(2024, 1, 3), datetime(2024, 1, 1),
+                                          datetime(2024, 1, 2), datetime(2024, 1, 1)]})
+    subscribers = pd.DataFrame({"Product ID": [1, 3], "Subscribers": [2, 1]})
+
+    stats = get_product_stats(prices, subscribers)
+
+    assert stats.loc[1, "Current Price"] == 5.0
+    assert stats.loc[1, "Current Price At"] == datetime(2024, 1, 3)
+    assert stats.loc[1, "Lowest Price"] == 4.0
+    assert stats.loc[1, "Lowest Price At"] == datetime(2024, 1, 1)
+    assert stats.loc[1, "Highest Price"] == 5.0
+    assert stats["Subscribers"].to_dict() == {1: 2, 2: 0, 3: 1}
+    assert pd.isna(stats.loc[3, "Current Price"])
+
+
 @patch("database.hash_password")
-def test_get_user_info(mock_hash_password, mock_connection):
+def test_save_credentials_stores_hash(mock_hash_password):
+    """
+    Test that only a hash of the password is stored.
+    """
+    mock_conn = MagicMock()
+    mock_hash_password.return_value = b"hashed"
+
+    save_credentials(mock_conn, "user1@example.com", "userPassword", 1, False)
+
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    assert mock_cursor.execute.call_args.args[1] == ("user1@example.com", "hashed", 1, False)
+    mock_conn.commit.assert_called_once()
+
+
+def test_search_products_escapes_term():
+    """
+    Test that a search matches the term literally within the user's products.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+
+    search_products(mock_conn, "50%_off", 20, user_id=4)
+
+    query, params = mock_cursor.execute.call_args.args
+    assert query == SEARCH_PRODUCTS_QUERY
+    assert params == {"term": "50%_off", "contains": "%50\\%\\_off%",
+                      "prefix": "50\\%\\_off%", "user_id": 4, "limit": 20}
+
+
+def test_search_products_without_term():
     """
-    Test that all user information is retrieved from database and admin login details are created.
+    Test that an empty search returns the first products rather than searching.
     """
     mock_conn = MagicMock()
-    mock_cursor = mock_conn.cursor.return_value
-
-    mock_cursor.fetchall.return_value = [
-        {"user_id": 1, "email": "user1@example.com",
-            "first_name": "John", "last_name": "Doe"},
-        {"user_id": 2, "email": "user2@example.com",
-            "first_name": "Jane", "last_name": "Smith"}
-    ]
-
-    mock_hash_password.side_effect = lambda password: f"hashed_{password}"
-
-    result = get_user_info(mock_conn)
-
-    assert isinstance(result, list)
-    assert len(result) == 3
-
-    # Admin user
-    assert result[0] == {
-        "user_id": 0,
-        "email": "admin@saletracker.co.uk",
-        "type": "admin",
-        "first_name": "Admin",
-        "last_name": "Admin",
-        "password": "hashed_adminPassword"
-    }
-
-    # Regular users
-    assert result[1] == {
-        "user_id": 1,
-        "email": "user1@example.com",
-        "type": "user",
-        "first_name": "John",
-        "last_name": "Doe",
-        "password": "hashed_userPassword"
-    }
-
-    assert result[2] == {
-        "user_id": 2,
-        "email": "user2@example.com",
-        "type": "user",
-        "first_name": "Jane",
-        "last_name": "Smith",
-        "password": "hashed_userPassword"
-    }
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+
+    search_products(mock_conn, "", 20)
+
+    assert mock_cursor.execute.call_args.args[0] == FIRST_PRODUCTS_QUERY
+
+
+def test_downsample_drops_repeated_prices():
+    """
+    Test that readings repeating the previous price are dropped, and price changes kept.
+    """
+    prices = pd.DataFrame({"Product ID": [1] * 5 + [2] * 2,
+                           "Updated At": pd.date_range("2024-01-01", periods=7, freq="h"),
+                           "Price": [5.0, 5.0, 6.0, 6.0, 5.0, 5.0, 5.0]})
+
+    downsampled = downsample_price_series(prices, max_points=10)
+
+    assert downsampled["Price"].tolist() == [5.0, 6.0, 5.0, 5.0]
+    assert downsampled["Product ID"].tolist() == [1, 1, 1, 2]
+
+
+def test_downsample_keeps_extremes_within_limit():
+    """
+    Test that long series are cut to the limit without losing their highest and lowest prices.
+    """
+    price = [10.0 + position % 7 for position in range(10000)]
+    price[4321] = 999.0
+    price[8765] = 0.5
+    prices = pd.DataFrame({"Product ID": 1, "Price": price,
+                           "Updated At": pd.date_range("2024-01-01", periods=10000, freq="min")})
+
+    downsampled = downsample_price_series(prices, max_points=100)
+
+    assert len(downsampled) <= 100
+    assert downsampled["Price"].max() == 999.0
+    assert downsampled["Price"].min() == 0.5
+    assert downsampled["Updated At"].is_monotonic_increasing
+    assert downsampled["Updated At"].iloc[-1] == prices["Updated At"].iloc[-1]
+
+
+def test_price_chart_is_bounded():
+    """
+    Test that the price chart holds at most the limit plus a point at now for each product.
+    """
+    prices = pd.DataFrame({"Product ID": 1, "Product Name": "Jeans",
+                           "Price": [str(10 + position % 3) for position in range(5000)],
+                           "Updated At": pd.date_range("2024-01-01", periods=5000, freq="min")})
+
+    chart = get_price_of_products_over_time(prices, max_points=40)
+
+    assert len(chart.data) <= 41
+    assert prices["Price"].dtype == object
+
+
+def test_chart_prices_keep_their_pence():
+    """
+    Test that typed prices reach the chart spec exactly as stored, without float32 noise.
+    """
+    latest = set_column_types(pd.DataFrame({"Product Name": ["Jeans", "Shirt"],
+                                            "Price": [24.99, 10.1]}))
+
+    spec = get_latest_price_readings(latest).to_dict()
+
+    assert [row["Price (£)"] for row in spec["datasets"][spec["data"]["name"]]] == [24.99, 10.1]
+
+
+def test_popularity_chart_continues_to_today():
+    """
+    Test that each product's subscriber count is carried on to today.
+    """
+    popularity_history = pd.DataFrame({"Product ID": [1, 1, 2], "Product Name": ["Coat", "Coat", "Hat"],
+                                       "Day": pd.to_datetime(["2024-01-01", "2024-01-03", "2024-01-02"]),
+                                       "Subscribers": [2, 1, 4]})
+
+    chart = get_popularity_over_time(popularity_history)
+
+    assert len(chart.data) == 5
+    assert chart.data["Day"].max() == pd.Timestamp.now().normalize()
+    assert chart.data.groupby("Product ID")["Subscribers"].last().to_dict() == {1: 1, 2: 4}
@@ -0,0 +1,191 @@
+"""
+Tests the dashboard's frame cache.
+"""
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+from data_cache import append_new_rows, DashboardCache, NEW_PRICES_QUERY, NEW_SUBSCRIPTIONS_QUERY
+from database import (DashboardFrames, SubscriptionMetrics, POPULARITY_HISTORY_QUERY,
+                      PRODUCT_SUBSCRIBERS_QUERY, SUBSCRIPTIONS_QUERY)
+
+
+def make_prices(prices: list) -> pd.DataFrame:
+    """
+    Returns a prices frame from (price id, product id, price) rows, each recorded
+    an hour after the one before.
+    """
+    prices = pd.DataFrame(prices, columns=["Price ID", "Product ID", "Price"])
+    prices["Updated At"] = [datetime(2024, 1, 1) + timedelta(hours=price_id)
+                            for price_id in prices["Price ID"]]
+    return prices
+
+
+def make_frames(prices: list, subscriptions: list) -> DashboardFrames:
+    """
+    Returns frames holding two products, one user, and the given prices and subscriptions.
+    """
+    return DashboardFrames(
+        products=pd.DataFrame({"Product ID": [1, 2], "Product Name": ["Coat", "Hat"],
+                               "Last Modified": [datetime(2024, 1, 1)] * 2}),
+        prices=make_prices(prices),
+        subscriptions=pd.DataFrame(subscriptions,
+                                   columns=["Subscription ID", "User ID", "Product ID"]),
+        users=pd.DataFrame({"User ID": [7], "User Email": ["person@email.com"]}),
+        product_stats=pd.DataFrame(),
+        popularity_history=pd.DataFrame(columns=["Product ID", "Day", "Subscribers"]),
+        metrics=SubscriptionMetrics(1, 1, len(subscriptions)),
+        version=1)
+
+
+def make_connection(subscription_count: int) -> MagicMock:
+    """
+    Returns a mock connection whose subscription metrics query returns the count.
+    """
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value.fetchone.return_value = (
+        1, 1, subscription_count)
+    return mock_conn
+
+
+def fake_new_rows(new_rows: dict):
+    """
+    Returns a stand-in for load_frame that returns the new rows given for each query,
+    and an empty frame with the same columns as the cached one for the rest.
+    """
+    empty = make_frames([], [])
+
+    def load_frame(_conn, query, _params):
+        if query in new_rows:
+            return new_rows[query]
+        if query == PRODUCT_SUBSCRIBERS_QUERY:
+            return pd.DataFrame({"Product ID": [], "Subscribers": []}, dtype="int32")
+        if query == POPULARITY_HISTORY_QUERY:
+            return pd.DataFrame(columns=["Product ID", "Day", "Subscribers"])
+        if "FROM products" in query:
+            return empty.products.iloc[0:0]
+        if "FROM prices" in query:
+            return empty.prices
+        if "FROM subscriptions" in query:
+            return empty.subscriptions
+        return empty.users.iloc[0:0]
+
+    return load_frame
+
+
+@patch("data_cache.load_dashboard_frames")
+def test_frames_served_from_cache(mock_load_dashboard_frames):
+    """
+    Test that frames are loaded once and then served without connecting until they expire.
+    """
+    mock_load_dashboard_frames.return_value = make_frames([(1, 1, 10.0)], [(1, 7, 1)])
+    mock_connect = MagicMock()
+    cache = DashboardCache(mock_connect, refresh_seconds=60)
+
+    first = cache.get_frames(7)
+    second = cache.get_frames(7)
+
+    assert first is second
+    mock_connect.assert_called_once()
+    mock_connect.return_value.close.assert_called_once()
+
+
+@patch("data_cache.load_frame")
+@patch("data_cache.load_dashboard_frames")
+def test_refresh_appends_only_new_rows(mock_load_dashboard_frames, mock_load_frame):
+    """
+    Test that a refresh reads rows after the high-water marks and appends those not held.
+    """
+    mock_load_dashboard_frames.return_value = make_frames([(1, 1, 10.0), (2, 1, 9.0)],
+                                                          [(1, 7, 1)])
+    mock_load_frame.side_effect = fake_new_rows({
+        NEW_PRICES_QUERY: make_prices([(2, 1, 9.0), (3, 1, 8.0)])})
+    cache = DashboardCache(lambda: make_connection(1), refresh_seconds=0)
+    cache.get_frames(7)
+
+    frames = cache.get_frames(7)
+
+    assert frames.prices["Price ID"].tolist() == [1, 2, 3]
+    assert frames.product_stats.loc[1, "Current Price"] == 8.0
+    assert frames.version > 1
+    prices_call = [call for call in mock_load_frame.call_args_list
+                   if call.args[1] == NEW_PRICES_QUERY][0]
+    assert prices_call.args[2]["user_id"] == 7
+    assert prices_call.args[2]["new_product_ids"] == []
+
+
+@patch("data_cache.load_frame")
+@patch("data_cache.load_dashboard_frames")
+def test_refresh_drops_removed_subscriptions(mock_load_dashboard_frames, mock_load_frame):
+    """
+    Test that removed subscriptions are noticed from the count, and their products dropped.
+    """
+    mock_load_dashboard_frames.return_value = make_frames([(1, 1, 10.0), (2, 2, 5.0)],
+                                                          [(1, 7, 1), (2, 7, 2)])
+    mock_load_frame.side_effect = fake_new_rows({
+        SUBSCRIPTIONS_QUERY: pd.DataFrame([(2, 7, 2)],
+                                          columns=["Subscription ID", "User ID", "Product ID"])})
+    cache = DashboardCache(lambda: make_connection(1), refresh_seconds=0)
+    cache.get_frames(7)
+
+    frames = cache.get_frames(7)
+
+    assert frames.subscriptions["Subscription ID"].tolist() == [2]
+    assert frames.metrics.subscription_count == 1
+    assert frames.products["Product ID"].tolist() == [2]
+    assert frames.prices["Price ID"].tolist() == [2]
+
+
+@patch("data_cache.load_frame")
+@patch("data_cache.load_dashboard_frames")
+def test_refresh_loads_newly_subscribed_products(mock_load_dashboard_frames, mock_load_frame):
+    """
+    Test that a new subscription to a product not yet loaded reads its whole history.
+    """
+    mock_load_dashboard_frames.return_value = make_frames([(1, 1, 10.0)], [(1, 7, 1)])
+    mock_load_frame.side_effect = fake_new_rows({
+        NEW_SUBSCRIPTIONS_QUERY: pd.DataFrame(
+            [(5, 7, 3)], columns=["Subscription ID", "User ID", "Product ID"])})
+    cache = DashboardCache(lambda: make_connection(2), refresh_seconds=0)
+    cache.get_frames(7)
+
+    frames = cache.get_frames(7)
+
+    assert frames.subscriptions["Subscription ID"].tolist() == [1, 5]
+    prices_call = [call for call in mock_load_frame.call_args_list
+                   if call.args[1] == NEW_PRICES_QUERY][0]
+    assert prices_call.args[2]["new_product_ids"] == [3]
+
+
+@patch("data_cache.load_frame")
+@patch("data_cache.load_dashboard_frames")
+def test_refresh_without_changes_keeps_frames(mock_load_dashboard_frames, mock_load_frame):
+    """
+    Test that a refresh that finds nothing new keeps the frames and their version.
+    """
+    mock_load_dashboard_frames.return_value = make_frames([(1, 1, 10.0)], [(1, 7, 1), (2, 7, 2)])
+    mock_load_frame.side_effect = fake_new_rows({})
+    cache = DashboardCache(lambda: make_connection(2), refresh_seconds=0)
+    first = cache.get_frames(7)
+
+    second = cache.get_frames(7)
+
+    assert second is first
+    assert second.version == 1
+
+
+def test_append_new_rows_keeps_column_types():
+    """
+    Test that appending rows with new categories keeps the columns categorical and narrow.
+    """
+    products = pd.DataFrame({"Product ID": [1], "Product Name": ["Coat"]}).astype(
+        {"Product ID": "int32", "Product Name": "category"})
+    new_products = pd.DataFrame({"Product ID": [1, 2], "Product Name": ["Coat", "Hat"]}).astype(
+        {"Product ID": "int32", "Product Name": "category"})
+
+    products = append_new_rows(products, new_products, "Product ID")
+
+    assert products["Product Name"].tolist() == ["Coat", "Hat"]
+    assert products["Product Name"].dtype == "category"
+    assert products["Product ID"].dtype == "int32"
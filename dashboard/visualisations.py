@@ -11,6 +11,7 @@ from pandas import DataFrame
 NUM_COLUMNS_LEGEND = 3
 MAX_WIDTH = 600
 MAX_HEIGHT = 400
+MAX_POINTS_PER_SERIES = 400
 
 
 def get_latest_price_readings(latest_data: DataFrame) -> alt.vegalite.v5.api.Chart:
@@ -18,9 +19,7 @@ def get_latest_price_readings(latest_data: DataFrame) -> alt.vegalite.v5.api.Cha
     Returns an altair bar chart that shows the latest price readings for each product.
     """
 
-    latest_data["Price (£)"] = latest_data["Price"].astype(float)
-
-    latest_data = latest_data[["Product Name", "Price (£)"]]
+    latest_data = latest_data[["Product Name", "Price"]].rename(columns={"Price": "Price (£)"})
 
     latest_price_readings = alt.Chart(latest_data).mark_bar().encode(
         y=alt.Y('Product Name:N'),
@@ -34,15 +33,12 @@ def get_latest_price_readings(latest_data: DataFrame) -> alt.vegalite.v5.api.Cha
     return latest_price_readings
 
 
-def get_popularity_of_products(df: DataFrame) -> alt.vegalite.v5.api.Chart:
+def get_popularity_of_products(product_popularity: DataFrame) -> alt.vegalite.v5.api.Chart:
     """
-    Displays the popularity (number of subscriptions each product has) over time.
+    Displays the popularity (number of subscribers) of each product,
+    from a frame with one row per product.
     """
-    grouped = df.groupby('Product Name')
-
-    product_popularity = grouped['Subscription ID'].nunique()
-    product_popularity = product_popularity.reset_index()
-    product_popularity.columns = ['Product Name', 'Popularity']
+    product_popularity = product_popularity[["Product Name", "Popularity"]]
 
     popularity = alt.Chart(product_popularity).mark_bar().encode(
         y=alt.Y('Product Name:N'),
@@ -56,22 +52,68 @@ def get_popularity_of_products(df: DataFrame) -> alt.vegalite.v5.api.Chart:
     return popularity
 
 
-def get_price_of_products_over_time(df: DataFrame) -> alt.vegalite.v5.api.Chart:
+def get_popularity_over_time(popularity_history: DataFrame) -> alt.vegalite.v5.api.Chart:
     """
-    Displays the price of all products over time in a line graph.
+    Displays each product's number of subscribers by day in a line graph,
+    continued to today.
+    """
+    today = popularity_history.groupby("Product ID").tail(1).assign(
+        Day=pd.Timestamp.now().normalize())
+    popularity_history = pd.concat([popularity_history, today])
+
+    return alt.Chart(popularity_history).mark_line(interpolate="step-after").encode(
+        x=alt.X('Day:T', axis=alt.Axis(title='Day')),
+        y=alt.Y('Subscribers:Q', axis=alt.Axis(title='Subscribers', tickMinStep=1)),
+        color=alt.Color('Product Name:N', legend=alt.Legend(
+            orient='bottom', columns=NUM_COLUMNS_LEGEND)),
+        tooltip=['Product Name:N', 'Subscribers:Q', 'Day:T']
+    ).properties(
+        title='Product Popularity Over Time',
+        width=MAX_WIDTH,
+        height=MAX_HEIGHT
+    )
+
+
+def downsample_price_series(df: DataFrame, max_points: int = MAX_POINTS_PER_SERIES) -> DataFrame:
+    """
+    Returns at most max_points readings for each product, in time order.
+    Readings that repeat the product's previous price are dropped first, which leaves
+    a step chart unchanged. If a product still has too many, its readings are split
+    into max_points // 4 runs and only the first, cheapest, dearest and last of
+    each run are kept, so price spikes and drops still show.
     """
-    df['Updated At'] = pd.to_datetime(df['Updated At'])
+    df = df.sort_values(["Product ID", "Updated At"], kind="stable")
+    df = df[df["Price"].ne(df.groupby("Product ID")["Price"].shift())].reset_index(drop=True)
+
+    series_sizes = df.groupby("Product ID")["Price"].transform("size")
+    if (series_sizes <= max_points).all():
+        return df
+
+    position = df.groupby("Product ID").cumcount()
+    runs = max(max_points // 4, 1)
+    run = (position * runs // series_sizes).where(series_sizes > max_points, position)
+
+    by_run = df.groupby([df["Product ID"], run])["Price"]
+    row_numbers = df.index.to_series().groupby([df["Product ID"], run])
+    kept = pd.concat([by_run.idxmin(), by_run.idxmax(),
+                      row_numbers.first(), row_numbers.last()]).unique()
 
-    df['Price'] = df['Price'].astype(float)
+    return df.loc[sorted(kept)].reset_index(drop=True)
+
+
+def get_price_of_products_over_time(df: DataFrame,
+                                    max_points: int = MAX_POINTS_PER_SERIES) -> alt.vegalite.v5.api.Chart:
+    """
+    Displays the price of all products over time in a line graph.
+    Each product's line is downsampled to at most max_points readings, and continued to now.
+    """
+    df = downsample_price_series(df, max_points)
 
-    ext = df.sort_values('Updated At').groupby('Product ID').tail(1)
-    ext_date = ext['Updated At']
-    ext_date = ext_date.apply(lambda x: datetime.now())
-    ext['Updated At'] = ext_date
+    ext = df.groupby("Product ID").tail(1).assign(**{"Updated At": datetime.now()})
 
     df = pd.concat([df, ext])
 
-    line_chart = alt.Chart(df).mark_line(interpolate="step").encode(
+    line_chart = alt.Chart(df).mark_line(interpolate="step-after").encode(
         x=alt.X('Updated At:T', axis=alt.Axis(title='Time')),
         y=alt.Y('Price:Q', axis=alt.Axis(title='Price')),
         color=alt.Color('Product Name:N', legend=alt.Legend(
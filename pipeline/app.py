@@ -1,177 +1,871 @@
 """
 API.
 """
+import csv
+import io
+import json
+import logging
+from hashlib import sha1
 from os import environ, _Environ
+from time import perf_counter
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from typing import Iterator
+from threading import BoundedSemaphore, Lock
 
 from boto3 import client
 from mypy_boto3_ses import SESClient
 from dotenv import load_dotenv
-from flask import Flask, render_template, request
-from psycopg2 import connect, extras
+from flask import Flask, render_template, request, jsonify, g, Request, Response, stream_with_context
+from psycopg2 import extras, pool
 from psycopg2.extensions import connection
 
-from extract import scrape_asos_page
+from cache import TTLCache
+from extract import (canonicalise_url, scrape_product, get_size_mask,
+                     scrape_asos_product_page, get_stock_prices, add_stock_price)
+from metrics import InstrumentedConnection, REQUEST_DURATION, render_metrics, request_breakdown, time_outbound
+from query_catalog import QueryCatalog
 
 app = Flask(__name__, template_folder='./templates')
 
-
-EMAIL_SELECTION_QUERY = "SELECT email FROM users;"
-PRODUCT_URL_SELECTION_QUERY = "SELECT product_name FROM products;"
-INSERT_USER_DATA_QUERY = "INSERT INTO users(email, first_name, last_name) VALUES (%s, %s, %s)"
-INSERT_INTO_PRODUCTS_QUERY = """
-                INSERT INTO products (product_name, product_url, image_url, product_availability, website_name) 
-                VALUES (%s, %s, %s, %s, %s)
+SUBMISSION_WORKERS = 4
+JOB_LEASE_SECONDS = 300
+DB_POOL_SIZE = 10
+DB_POOL_TIMEOUT_SECONDS = 30
+SUBSCRIPTIONS_CACHE_SIZE = 1000
+SUBSCRIPTIONS_CACHE_SECONDS = 60
+BULK_IMPORT_MAX_URLS = 500
+BULK_SCRAPE_WORKERS = 8
+BULK_SCRAPE_BUDGET_SECONDS = 120
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+API_MAX_POINTS = 1000
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+SEARCH_MIN_LENGTH = 2
+HISTORY_START = datetime(1970, 1, 1)
+HISTORY_END = datetime(9999, 12, 31)
+
+# Each user's subscribed products, by email. Prices are refreshed when entries expire.
+subscriptions_cache = TTLCache(SUBSCRIPTIONS_CACHE_SIZE, SUBSCRIPTIONS_CACHE_SECONDS)
+
+# Created on first use, once the environment has been loaded.
+connection_pool = None
+connection_slots = None
+connection_pool_lock = Lock()
+
+# Scraping and inserting submitted products happens off the request thread.
+job_executor = ThreadPoolExecutor(
+    max_workers=int(environ.get("SUBMISSION_WORKERS", SUBMISSION_WORKERS)))
+
+# Shared by all bulk imports, so together they never scrape more than this many pages at once.
+bulk_scrape_executor = ThreadPoolExecutor(
+    max_workers=int(environ.get("BULK_SCRAPE_WORKERS", BULK_SCRAPE_WORKERS)))
+
+
+# The no-op DO UPDATE makes RETURNING give back existing rows; xmax is 0 only for new rows.
+UPSERT_USER_QUERY = """
+                INSERT INTO users (email, first_name, last_name) VALUES (%s, %s, %s)
+                ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+                RETURNING user_id, (xmax = 0) AS inserted;
+                """
+UPSERT_PRODUCT_QUERY = """
+                INSERT INTO products (product_name, product_url, image_url, product_availability, website_name,
+                                      variant_ids, variant_sizes, stock_bitmap, asos_product_id) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s::varbit, %s)
+                ON CONFLICT (product_url) DO UPDATE SET product_url = EXCLUDED.product_url
+                RETURNING product_id, variant_sizes, (xmax = 0) AS inserted;
                 """
-PRODUCT_ID_QUERY = "SELECT product_id FROM products WHERE product_url = (%s)"
 INSERT_INTO_PRICES_QUERY = "INSERT INTO prices (updated_at, product_id, price) VALUES (%s, %s, %s)"
-SELECT_SUB_BY_PRODUCT_AND_USER_QUERY = "SELECT * FROM subscriptions WHERE user_id = (%s) AND product_id = (%s);"
-INSERT_INTO_SUBSCRIPTIONS_QUERY = "INSERT INTO subscriptions (user_id, product_id) VALUES (%s, %s);"
-SELECT_USERS_BY_EMAIL_QUERY = "SELECT user_id FROM users WHERE email = (%s);"
+INSERT_INTO_SUBSCRIPTIONS_QUERY = """
+                INSERT INTO subscriptions (user_id, product_id, size_mask) VALUES (%s, %s, %s::varbit)
+                ON CONFLICT (user_id, product_id) DO NOTHING;
+                """
 GET_PRODUCTS_FROM_EMAIL_QUERY = """
-                SELECT DISTINCT ON (prices.product_id) users.first_name, products.product_name,products.product_url, products.product_id, products.image_url, products.product_availability, prices.price
+                SELECT users.first_name, products.product_name, products.product_url, products.product_id,
+                       products.image_url, products.product_availability, latest_price.price
                 FROM users
                 JOIN subscriptions ON users.user_id = subscriptions.user_id
                 JOIN products ON subscriptions.product_id = products.product_id
-                JOIN prices ON products.product_id = prices.product_id
-                WHERE users.email = (%s)
-                ORDER BY prices.product_id, prices.updated_at DESC;  
+                LEFT JOIN LATERAL (
+                    SELECT price FROM prices
+                    WHERE prices.product_id = products.product_id
+                    ORDER BY updated_at DESC LIMIT 1
+                ) AS latest_price ON TRUE
+                WHERE users.email = %s
+                ORDER BY products.product_name;
+                """
+GET_TRACKED_PRODUCT_QUERY = "SELECT product_id, variant_sizes FROM products WHERE product_url = %s;"
+GET_TRACKED_PRODUCTS_QUERY = """
+                SELECT product_url, product_id, variant_sizes FROM products
+                WHERE product_url = ANY(%s);
                 """
-GET_SUBS_BY_EMAIL_QUERY = """
-                SELECT subscriptions.user_id
-                FROM subscriptions
-                JOIN users ON subscriptions.user_id = users.user_id
-                WHERE users.email = (%s);
+BULK_UPSERT_PRODUCTS_QUERY = """
+                INSERT INTO products (product_name, product_url, image_url, product_availability, website_name,
+                                      variant_ids, variant_sizes, stock_bitmap, asos_product_id)
+                VALUES %s
+                ON CONFLICT (product_url) DO UPDATE SET product_url = EXCLUDED.product_url
+                RETURNING product_id, product_url, variant_sizes, (xmax = 0) AS inserted;
+                """
+BULK_PRODUCT_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, %s::varbit, %s)"
+BULK_INSERT_PRICES_QUERY = "INSERT INTO prices (updated_at, product_id, price) VALUES %s;"
+BULK_INSERT_SUBSCRIPTIONS_QUERY = """
+                INSERT INTO subscriptions (user_id, product_id, size_mask) VALUES %s
+                ON CONFLICT (user_id, product_id) DO NOTHING;
+                """
+BULK_SUBSCRIPTION_TEMPLATE = "(%s, %s, %s::varbit)"
+API_SUBSCRIPTIONS_QUERY = """
+                SELECT products.product_id, products.product_name, products.product_url, products.image_url,
+                       products.product_availability, latest_price.price,
+                       latest_price.updated_at AS price_updated_at, products.last_modified
+                FROM users
+                JOIN subscriptions ON users.user_id = subscriptions.user_id
+                JOIN products ON subscriptions.product_id = products.product_id
+                LEFT JOIN LATERAL (
+                    SELECT price, updated_at FROM prices
+                    WHERE prices.product_id = products.product_id
+                    ORDER BY updated_at DESC LIMIT 1
+                ) AS latest_price ON TRUE
+                WHERE users.email = %s AND products.product_id > %s
+                ORDER BY products.product_id
+                LIMIT %s;
                 """
-GET_PROD_ID_BY_PROD_NAME_QUERY = "SELECT product_id FROM products WHERE product_name = %s;"
-DELETE_SUBSCRIPTIONS_QUERY = "DELETE FROM subscriptions WHERE product_id = (%s) AND user_id = (%s);"
+# New prices touch their product, so these rows identify a page without reading prices.
+API_SUBSCRIPTIONS_VERSION_QUERY = """
+                SELECT products.product_id, products.last_modified
+                FROM users
+                JOIN subscriptions ON users.user_id = subscriptions.user_id
+                JOIN products ON subscriptions.product_id = products.product_id
+                WHERE users.email = %s AND products.product_id > %s
+                ORDER BY products.product_id
+                LIMIT %s;
+                """
+PRODUCT_LAST_MODIFIED_QUERY = "SELECT last_modified FROM products WHERE product_id = %s;"
+PRICE_HISTORY_QUERY = """
+                SELECT price_id, updated_at, price FROM prices
+                WHERE product_id = %s AND updated_at >= %s AND updated_at < %s
+                AND (updated_at, price_id) > (%s, %s)
+                ORDER BY updated_at, price_id
+                LIMIT %s;
+                """
+DOWNSAMPLED_PRICE_HISTORY_QUERY = """
+                WITH history AS (
+                    SELECT updated_at, price FROM prices
+                    WHERE product_id = %s AND updated_at >= %s AND updated_at < %s
+                ), bounds AS (
+                    SELECT extract(epoch FROM min(updated_at)) AS first_at,
+                           extract(epoch FROM max(updated_at)) + 1 AS last_at
+                    FROM history
+                )
+                SELECT min(updated_at) AS updated_at, min(price) AS min_price, max(price) AS max_price,
+                       (array_agg(price ORDER BY updated_at DESC))[1] AS price
+                FROM history, bounds
+                GROUP BY width_bucket(extract(epoch FROM updated_at), first_at, last_at, %s)
+                ORDER BY 1;
+                """
+# Names containing the term, or with a word close to it, both served by the trigram index.
+# Names starting with the term come first, then the closest fuzzy matches.
+SEARCH_PRODUCTS_QUERY = """
+                SELECT product_id, product_name, image_url, product_url
+                FROM products
+                WHERE product_name ILIKE %s OR %s <%% product_name
+                ORDER BY product_name ILIKE %s DESC, word_similarity(%s, product_name) DESC, product_name
+                LIMIT %s;
+                """
+DELETE_SUBSCRIPTION_QUERY = """
+                DELETE FROM subscriptions USING users
+                WHERE subscriptions.user_id = users.user_id
+                AND users.email = %s AND subscriptions.product_id = %s;
+                """
+INSERT_SUBMISSION_JOB_QUERY = """
+                INSERT INTO submission_jobs (first_name, last_name, email, product_url, sizes)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING job_id;
+                """
+CLAIM_SUBMISSION_JOB_QUERY = """
+                UPDATE submission_jobs
+                SET status = 'running', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s
+                AND (status = 'pending'
+                     OR (status = 'running'
+                         AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+                RETURNING first_name, last_name, email, product_url, sizes;
+                """
+FINISH_SUBMISSION_JOB_QUERY = """
+                UPDATE submission_jobs
+                SET status = %s, last_error = %s, finished_at = CURRENT_TIMESTAMP
+                WHERE job_id = %s;
+                """
+GET_SUBMISSION_JOB_QUERY = """
+                SELECT job_id, status, product_url, last_error, created_at, finished_at
+                FROM submission_jobs WHERE job_id = %s;
+                """
+GET_UNFINISHED_JOBS_QUERY = """
+                SELECT job_id FROM submission_jobs
+                WHERE status = 'pending'
+                OR (status = 'running'
+                    AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                ORDER BY job_id;
+                """
+
+QUERIES = QueryCatalog({
+    "upsert_user": UPSERT_USER_QUERY,
+    "upsert_product": UPSERT_PRODUCT_QUERY,
+    "insert_price": INSERT_INTO_PRICES_QUERY,
+    "insert_subscription": INSERT_INTO_SUBSCRIPTIONS_QUERY,
+    "products_by_email": GET_PRODUCTS_FROM_EMAIL_QUERY,
+    "tracked_product": GET_TRACKED_PRODUCT_QUERY,
+    "api_subscriptions": API_SUBSCRIPTIONS_QUERY,
+    "api_subscriptions_version": API_SUBSCRIPTIONS_VERSION_QUERY,
+    "product_last_modified": PRODUCT_LAST_MODIFIED_QUERY,
+    "price_history": PRICE_HISTORY_QUERY,
+    "downsampled_price_history": DOWNSAMPLED_PRICE_HISTORY_QUERY,
+    "search_products": SEARCH_PRODUCTS_QUERY,
+    "delete_subscription": DELETE_SUBSCRIPTION_QUERY,
+    "submission_job": GET_SUBMISSION_JOB_QUERY
+})
+
+
+def get_connection_pool() -> pool.ThreadedConnectionPool:
+    """
+    Returns the app's pool of database connections, creating it on first use.
+    Every connection is kept open between requests, so requests do not pay
+    for a new handshake with the database.
+    """
+    global connection_pool, connection_slots  # pylint: disable=global-statement
+
+    with connection_pool_lock:
+        if connection_pool is None:
+            size = int(environ.get("DB_POOL_SIZE", DB_POOL_SIZE))
+            connection_slots = BoundedSemaphore(size)
+            connection_pool = pool.ThreadedConnectionPool(
+                size, size,
+                user=environ["DB_USER"],
+                password=environ["DB_PASSWORD"],
+                host=environ["DB_HOST"],
+                port=environ["DB_PORT"],
+                database=environ["DB_NAME"],
+                connection_factory=InstrumentedConnection
+            )
+
+    return connection_pool
+
+
+def checkout_connection() -> connection:
+    """
+    Waits for a free connection in the pool and checks it out.
+    Raises a PoolError if none becomes free in time.
+    """
+    connections = get_connection_pool()
+
+    if not connection_slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+        raise pool.PoolError("No database connection became free in time")
+
+    try:
+        return connections.getconn()
+    except Exception:
+        connection_slots.release()
+        raise
+
+
+def return_connection(conn: connection) -> None:
+    """
+    Returns a checked out connection to the pool.
+    Uncommitted work is rolled back, and closed connections are replaced.
+    """
+    get_connection_pool().putconn(conn, close=bool(conn.closed))
+    connection_slots.release()
 
 
 def get_database_connection() -> connection:
     """
-    Return a connection our database.
+    Return the current request's database connection, checking one out of the
+    pool the first time it is needed. It goes back to the pool on teardown.
     """
-    try:
-        return connect(
-            user=environ["DB_USER"],
-            password=environ["DB_PASSWORD"],
-            host=environ["DB_HOST"],
-            port=environ["DB_PORT"],
-            database=environ["DB_NAME"]
-        )
-    except ConnectionError as error:
-        return error
+    if 'db_conn' not in g:
+        g.db_conn = checkout_connection()
 
+    return g.db_conn
 
-def insert_user_data(conn: connection, data_user: dict):
+
+@app.before_request
+def start_request_timer() -> None:
+    """
+    Starts timing the request and collecting the breakdown of where its time goes.
+    """
+    g.request_started = perf_counter()
+    g.request_breakdown_token = request_breakdown.set({})
+
+
+def observe_request_time(method: str, route: str, path: str, status: int,
+                         started: float, breakdown: dict) -> None:
+    """
+    Records a finished request's latency, and logs a breakdown of it if it was
+    slower than SLOW_REQUEST_MS.
+    """
+    elapsed = perf_counter() - started
+    REQUEST_DURATION.observe((method, route, str(status)), elapsed)
+
+    slow_request_ms = environ.get("SLOW_REQUEST_MS")
+    if slow_request_ms and elapsed * 1000 >= float(slow_request_ms):
+        summary = ", ".join(f"{kind} {seconds * 1000:.0f}ms over {calls} call(s)"
+                            for kind, (seconds, calls) in sorted(breakdown.items()))
+        logging.warning(f"Slow request {method} {path} took "
+                        f"{elapsed * 1000:.0f}ms: {summary or 'no database or outbound calls'}")
+
+
+@app.after_request
+def record_request_time(response: Response) -> Response:
     """
-    Inserts user data into users table in required database.
+    Records the request's latency once its response is finished.
+    The body of a streamed response is produced after this runs, so it is timed
+    when the server closes the response, after its last byte.
+    """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # The breakdown keeps collecting while a response streams, so it is summed at the end.
+    timing = (request.method, route, request.path, response.status_code,
+              g.request_started, request_breakdown.get())
+
+    if response.is_streamed:
+        response.call_on_close(lambda: observe_request_time(*timing))
+    else:
+        observe_request_time(*timing)
+
+    return response
+
+
+@app.teardown_request
+def stop_request_timer(_error) -> None:
+    """
+    Stops collecting the request's breakdown.
+    """
+    token = g.pop('request_breakdown_token', None)
+    if token is not None:
+        request_breakdown.reset(token)
+
+
+@app.teardown_appcontext
+def release_database_connection(_error) -> None:
+    """
+    Returns the request's database connection to the pool, if it used one.
+    """
+    conn = g.pop('db_conn', None)
+
+    if conn is not None:
+        return_connection(conn)
+
+
+def insert_user_data(conn: connection, data_user: dict) -> dict:
+    """
+    Inserts user data into users table in required database, unless the email
+    is already registered. Returns the user id and whether the user is new.
+    The caller is responsible for committing the transaction.
     """
     cur = conn.cursor(cursor_factory=extras.RealDictCursor)
 
-    cur.execute(EMAIL_SELECTION_QUERY)
-    rows = cur.fetchall()
+    QUERIES.execute(cur, "upsert_user", (data_user["email"],
+                                         data_user["first_name"],
+                                         data_user["last_name"]))
+    user = cur.fetchone()
 
-    emails = [row["email"] for row in rows]
+    cur.close()
 
-    if data_user['email'] in emails:
-        conn.commit()
-        cur.close()
+    return user
+
+
+def insert_product_data_and_price_data(conn: connection, data_product: dict) -> dict:
+    """
+    Inserts product data into products table in the required database, unless the
+    product url is already tracked. Also inserts price data into the prices table
+    if product has just been added for the first time.
+    Returns the product id, its size labels and whether the product is new.
+    The caller is responsible for committing the transaction.
+    """
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+
+    QUERIES.execute(cur, "upsert_product", (data_product.get('product_name', 'Unknown'),
+                                            data_product['product_url'],
+                                            data_product['image_URL'],
+                                            data_product['is_in_stock'],
+                                            data_product['website_name'],
+                                            data_product.get('variant_ids', []),
+                                            data_product.get('variant_sizes', []),
+                                            data_product.get('stock_bitmap', ''),
+                                            data_product.get('asos_product_id')))
+    product = cur.fetchone()
+
+    if product['inserted']:
+        QUERIES.execute(cur, "insert_price", (datetime.now(),
+                                              product["product_id"],
+                                              data_product["price"]))
+
+    cur.close()
 
+    return product
+
+
+def insert_subscription_data(conn: connection, user_id: int, product: dict,
+                             sizes: list | None = None) -> None:
+    """
+    Inserts subscription data into the subscription table, unless the user
+    is already subscribed to the product.
+    If sizes are given, the subscription only covers those size variants.
+    The caller is responsible for committing the transaction.
+    """
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+
+    size_mask = get_size_mask(product.get('variant_sizes'), sizes or [])
+    QUERIES.execute(cur, "insert_subscription",
+                    (user_id, product['product_id'], size_mask))
+
+    cur.close()
+
+
+def register_submission(conn: connection, data_user: dict, data_product: dict,
+                        sizes: list | None = None) -> bool:
+    """
+    Inserts the user, product and subscription of a submission in one transaction.
+    Products which are already tracked, and so have a product id, are not inserted again.
+    Returns whether the user is new.
+    """
+    user = insert_user_data(conn, data_user)
+    if 'product_id' in data_product:
+        product = data_product
     else:
-        cur.execute(INSERT_USER_DATA_QUERY, (data_user["email"],
-                                             data_user["first_name"],
-                                             data_user["last_name"]))
+        product = insert_product_data_and_price_data(conn, data_product)
+    insert_subscription_data(conn, user['user_id'], product, sizes)
+
+    conn.commit()
+    subscriptions_cache.invalidate(data_user['email'])
+
+    return user['inserted']
+
+
+def get_products_from_email(conn: connection, email: str) -> list:
+    """
+    Returns list of products the user has subscribed to, with their current prices.
+    Lists are cached per email until they expire or the user's subscriptions change.
+    """
+    products = subscriptions_cache.get(email)
 
+    if products is None:
+        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+
+        QUERIES.execute(cur, "products_by_email", (email,))
+        products = list(cur.fetchall())
         conn.commit()
         cur.close()
 
-        ses_client = get_ses_client(environ)
+        subscriptions_cache.set(email, products)
+
+    return products
+
+
+def get_ses_client(config: _Environ) -> SESClient:
+    """
+    Returns an SES client to send emails to users.
+    """
+
+    return client('ses',
+                  aws_access_key_id=config['AWS_ACCESS_KEY'],
+                  aws_secret_access_key=config['AWS_SECRET_ACCESS_KEY'])
+
 
+def send_verification_email(email: str) -> None:
+    """
+    Asks SES to send a new user the email that lets them receive alerts.
+    """
+    ses_client = get_ses_client(environ)
+
+    with time_outbound("ses", "verify_email_address"):
         ses_client.verify_email_address(
-            EmailAddress=data_user['email'])
+            EmailAddress=email)
 
 
-def insert_product_data_and_price_data(conn: connection, data_product: dict):
+def create_submission_job(conn: connection, submission: dict) -> int:
     """
-    Inserts product data into products table in the required database.
-    Also inserts price data into the prices table if product has just been
-    added for the first time.
+    Records a product submission as a pending job and returns the job id.
     """
+    with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        cur.execute(INSERT_SUBMISSION_JOB_QUERY, (submission['first_name'],
+                                                  submission['last_name'],
+                                                  submission['email'],
+                                                  submission['url'],
+                                                  submission['sizes']))
+        job_id = cur.fetchone()['job_id']
 
+    conn.commit()
+
+    return job_id
+
+
+def get_tracked_product(conn: connection, product_url: str) -> dict | None:
+    """
+    Returns the id and size labels of the product with the url, if it is already tracked.
+    """
     cur = conn.cursor(cursor_factory=extras.RealDictCursor)
 
-    cur.execute(PRODUCT_URL_SELECTION_QUERY)
-    rows = cur.fetchall()
-    current_timestamp = datetime.now()
+    QUERIES.execute(cur, "tracked_product", (product_url,))
+    product = cur.fetchone()
+
+    cur.close()
+
+    return product
+
+
+def run_submission(conn: connection, job: dict) -> None:
+    """
+    Finds or scrapes the submitted product, then inserts the user, product and subscription.
+    Products which are already tracked are served from the database without scraping.
+    """
+    product_url = canonicalise_url(job['product_url'])
+
+    product_data = get_tracked_product(conn, product_url)
+    if product_data is None:
+        header = {
+            'user-agent': environ["USER_AGENT"]
+        }
+
+        product_data = scrape_product(product_url, header)
+        if not isinstance(product_data, dict):
+            raise ValueError(
+                f"Could not scrape {product_url}: {product_data}")
 
-    product_urls = [row["product_name"] for row in rows]
+    user_data = {
+        'first_name': job['first_name'],
+        'last_name': job['last_name'],
+        'email': job['email']
+    }
+
+    if register_submission(conn, user_data, product_data, job['sizes']):
+        send_verification_email(job['email'])
+
+
+def process_submission_job(job_id: int) -> None:
+    """
+    Claims a submission job and runs it on its own pooled connection, recording
+    whether it succeeded. Jobs already claimed by another worker are left alone.
+    """
+    conn = checkout_connection()
+
+    try:
+        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+        cur.execute(CLAIM_SUBMISSION_JOB_QUERY, (job_id, JOB_LEASE_SECONDS))
+        job = cur.fetchone()
+        conn.commit()
+
+        if job is None:
+            return
+
+        try:
+            run_submission(conn, job)
+        except Exception as error:  # pylint: disable=broad-except
+            conn.rollback()
+            logging.error(f"Submission job {job_id} failed: {error}")
+            cur.execute(FINISH_SUBMISSION_JOB_QUERY,
+                        ('failed', str(error), job_id))
+        else:
+            cur.execute(FINISH_SUBMISSION_JOB_QUERY, ('done', None, job_id))
 
-    if data_product['product_name'] in product_urls:
         conn.commit()
         cur.close()
+    finally:
+        return_connection(conn)
+
+
+def resume_submission_jobs(conn: connection) -> int:
+    """
+    Queues any jobs left pending, or abandoned mid-run, by a previous process.
+    Returns the number of jobs queued.
+    """
+    with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        cur.execute(GET_UNFINISHED_JOBS_QUERY, (JOB_LEASE_SECONDS,))
+        job_ids = [row['job_id'] for row in cur.fetchall()]
+
+    conn.commit()
+
+    for job_id in job_ids:
+        job_executor.submit(process_submission_job, job_id)
 
+    return len(job_ids)
+
+
+def read_bulk_import(bulk_request: Request) -> tuple[dict, list, list]:
+    """
+    Returns the user, canonical product urls and sizes of a bulk import.
+    JSON bodies hold all three. CSV bodies hold a url column, with the
+    user and sizes in the query string. Raises a ValueError if the import is invalid.
+    """
+    if bulk_request.mimetype == "text/csv":
+        fields = bulk_request.args
+        rows = csv.DictReader(io.StringIO(bulk_request.get_data(as_text=True)))
+        urls = [row.get("url") or "" for row in rows]
+        sizes = fields.get("sizes", "").split(",")
     else:
+        fields = bulk_request.get_json(silent=True)
+        if not isinstance(fields, dict):
+            raise ValueError("The body must be a JSON object or CSV")
+        urls = fields.get("urls") or []
+        sizes = fields.get("sizes") or []
+
+    user_data = {
+        'first_name': (fields.get("first_name") or "").capitalize(),
+        'last_name': (fields.get("last_name") or "").capitalize(),
+        'email': fields.get("email")
+    }
+    if not all(user_data.values()):
+        raise ValueError("A first name, last name and email are required")
+
+    urls = list(dict.fromkeys(canonicalise_url(url) for url in urls if url.strip()))
+    if not urls:
+        raise ValueError("No product urls were given")
+    if len(urls) > BULK_IMPORT_MAX_URLS:
+        raise ValueError(f"At most {BULK_IMPORT_MAX_URLS} urls can be imported at once")
+
+    return user_data, urls, [size.strip() for size in sizes if size.strip()]
+
+
+def get_tracked_products(conn: connection, product_urls: list) -> dict:
+    """
+    Returns the id and size labels of each url's product which is already tracked, by url.
+    """
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
 
-        cur.execute(INSERT_INTO_PRODUCTS_QUERY, (data_product.get('product_name', 'Unknown'),
-                                                 data_product['product_url'],
-                                                 data_product['image_URL'],
-                                                 data_product['is_in_stock'],
-                                                 data_product['website_name']))
+    cur.execute(GET_TRACKED_PRODUCTS_QUERY, (product_urls,))
+    products = {product['product_url']: product for product in cur.fetchall()}
 
-        cur.execute(PRODUCT_ID_QUERY, (data_product["product_url"],))
+    cur.close()
 
-        product_id = cur.fetchone()
+    return products
 
-        price_query = INSERT_INTO_PRICES_QUERY
-        cur.execute(price_query, (current_timestamp,
-                                  product_id["product_id"],
-                                  data_product["price"]))
-        conn.commit()
-        cur.close()
 
+def scrape_product_pages(product_urls: list, header: dict) -> Iterator[tuple[str, dict | Exception]]:
+    """
+    Scrapes the product pages on the bulk scrape pool, yielding each url with its
+    page data, or the error that stopped it, as soon as it is known.
+    Pages not scraped within the budget are given up on.
+    """
+    futures = {bulk_scrape_executor.submit(scrape_asos_product_page, url, header): url
+               for url in product_urls}
 
-def insert_subscription_data(conn: connection, user_email: str, product_url: str) -> None:
+    try:
+        for future in as_completed(futures, timeout=BULK_SCRAPE_BUDGET_SECONDS):
+            try:
+                yield futures[future], future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                yield futures[future], error
+    except FutureTimeoutError:
+        for future, url in futures.items():
+            if not future.done():
+                future.cancel()
+                yield url, TimeoutError("The product page was not scraped in time")
+
+
+def insert_bulk_products(conn: connection, products: list) -> list:
     """
-    Inserts subscription data into the subscription table.
+    Inserts the products which are not already tracked, and the first price of
+    each new one, in two statements. Returns the id, url and size labels of every product.
+    The caller is responsible for committing the transaction.
     """
+    if not products:
+        return []
 
     cur = conn.cursor(cursor_factory=extras.RealDictCursor)
 
-    user_query = SELECT_USERS_BY_EMAIL_QUERY
-    cur.execute(user_query, (user_email,))
-    user_id = cur.fetchone().get('user_id')
+    rows = extras.execute_values(
+        cur, BULK_UPSERT_PRODUCTS_QUERY,
+        [(product.get('product_name', 'Unknown'), product['product_url'], product['image_URL'],
+          product['is_in_stock'], product['website_name'], product['variant_ids'],
+          product['variant_sizes'], product['stock_bitmap'], product.get('asos_product_id'))
+         for product in products],
+        template=BULK_PRODUCT_TEMPLATE, fetch=True)
+
+    prices = {product['product_url']: product['price'] for product in products}
+    current_timestamp = datetime.now()
+    new_prices = [(current_timestamp, row['product_id'], prices[row['product_url']])
+                  for row in rows if row['inserted']]
+    if new_prices:
+        extras.execute_values(cur, BULK_INSERT_PRICES_QUERY, new_prices)
+
+    cur.close()
 
-    cur.execute(PRODUCT_ID_QUERY, (product_url,))
-    product_id = cur.fetchone().get('product_id')
+    return rows
+
+
+def insert_bulk_subscriptions(conn: connection, user_id: int, products: list,
+                              sizes: list | None = None) -> None:
+    """
+    Subscribes the user to every product they are not already subscribed to, in one statement.
+    The caller is responsible for committing the transaction.
+    """
+    if not products:
+        return
 
-    cur.execute(SELECT_SUB_BY_PRODUCT_AND_USER_QUERY, (user_id, product_id))
+    cur = conn.cursor()
 
-    if cur.fetchone() is None:
-        cur.execute(INSERT_INTO_SUBSCRIPTIONS_QUERY, (user_id, product_id))
+    extras.execute_values(
+        cur, BULK_INSERT_SUBSCRIPTIONS_QUERY,
+        [(user_id, product['product_id'], get_size_mask(product.get('variant_sizes'), sizes or []))
+         for product in products],
+        template=BULK_SUBSCRIPTION_TEMPLATE)
 
+    cur.close()
+
+
+def bulk_import_line(url: str, status: str, **details) -> str:
+    """
+    Returns one line of the streamed bulk import response.
+    """
+    return json.dumps({'url': url, 'status': status, **details}) + "\n"
+
+
+def import_products(user_data: dict, product_urls: list, sizes: list) -> Iterator[str]:
+    """
+    Subscribes the user to every product url, yielding one result line per url.
+    Tracked products are not scraped. The rest are scraped concurrently, priced in
+    batched stockprice calls and written, with all subscriptions, in one transaction.
+    No connection is held while pages are scraped, which can take up to
+    BULK_SCRAPE_BUDGET_SECONDS, so imports cannot drain the pool.
+    """
+    conn = checkout_connection()
+    try:
+        tracked_products = get_tracked_products(conn, product_urls)
         conn.commit()
+    finally:
+        return_connection(conn)
+
+    header = {
+        'user-agent': environ["USER_AGENT"]
+    }
+
+    product_pages = {}
+    for url, product_page in scrape_product_pages(
+            [url for url in product_urls if url not in tracked_products], header):
+        if isinstance(product_page, Exception):
+            yield bulk_import_line(url, 'failed', error=str(product_page))
+        else:
+            product_pages[url] = product_page
+
+    stock_prices = get_stock_prices(
+        [product_page['asos_product_id'] for product_page in product_pages.values()])
+
+    new_products = []
+    for url, product_page in product_pages.items():
+        product_api_result = stock_prices.get(str(product_page['asos_product_id']))
+        if product_api_result is None:
+            yield bulk_import_line(url, 'failed', error="The price and stock could not be found")
+        else:
+            new_products.append(add_stock_price(product_page, product_api_result))
+
+    conn = checkout_connection()
+    try:
+        user = insert_user_data(conn, user_data)
+        products = list(tracked_products.values()) + insert_bulk_products(conn, new_products)
+        insert_bulk_subscriptions(conn, user['user_id'], products, sizes)
 
+        conn.commit()
+    finally:
+        return_connection(conn)
+    subscriptions_cache.invalidate(user_data['email'])
 
-def get_products_from_email(conn: connection, email: str) -> list:
+    if user['inserted']:
+        send_verification_email(user_data['email'])
+
+    for product in products:
+        yield bulk_import_line(product['product_url'], 'subscribed',
+                               product_id=product['product_id'],
+                               new_product=bool(product.get('inserted')))
+
+
+def get_int_arg(name: str, default: int, minimum: int, maximum: int) -> int:
     """
-    Returns list of products the user has subscribed to.
+    Returns an integer query string argument, raising a ValueError if it is out of range.
     """
-    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    value = request.args.get(name, default, type=int)
+    if value is None or not minimum <= value <= maximum:
+        raise ValueError(f"{name} must be a whole number from {minimum} to {maximum}")
+    return value
+
+
+def get_time_arg(name: str, default: datetime) -> datetime:
+    """
+    Returns an ISO 8601 time query string argument, raising a ValueError if it is invalid.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as error:
+        raise ValueError(f"{name} must be an ISO 8601 time") from error
 
-    cur.execute(GET_PRODUCTS_FROM_EMAIL_QUERY, (email,))
 
-    return cur.fetchall()
+def get_history_cursor(start: datetime) -> tuple[datetime, int]:
+    """
+    Returns the time and price id which the requested page of price history comes after.
+    """
+    after = request.args.get("after")
+    if after is None:
+        return start, 0
+    try:
+        updated_at, price_id = after.rsplit(",", 1)
+        return datetime.fromisoformat(updated_at), int(price_id)
+    except ValueError as error:
+        raise ValueError("after must be a cursor returned by a previous page") from error
 
 
-def get_ses_client(config: _Environ) -> SESClient:
+def escape_like(term: str) -> str:
     """
-    Returns an SES client to send emails to users.
+    Returns the term with the characters that are special in LIKE patterns escaped.
     """
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
-    return client('ses',
-                  aws_access_key_id=config['AWS_ACCESS_KEY'],
-                  aws_secret_access_key=config['AWS_SECRET_ACCESS_KEY'])
+
+def search_products(conn: connection, term: str, limit: int) -> list:
+    """
+    Returns up to limit products whose names contain the term or a word like it,
+    names starting with the term first.
+    """
+    escaped_term = escape_like(term)
+
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    QUERIES.execute(cur, "search_products", (f"%{escaped_term}%", term, f"{escaped_term}%",
+                                             term, limit))
+    products = cur.fetchall()
+    conn.commit()
+    cur.close()
+
+    return products
+
+
+def get_subscriptions_etag(rows: list, limit: int) -> str:
+    """
+    Returns the ETag of a page of subscriptions, given up to limit + 1 rows from
+    the start of the page. The page only changes when a product in it changes,
+    the subscriptions do, or the page after it starts somewhere else.
+    """
+    page = rows[:limit]
+    next_after = page[-1]['product_id'] if len(rows) > limit else None
+
+    return sha1("-".join(
+        [f"{row['product_id']}:{row['last_modified'].timestamp()}" for row in page]
+        + [f"next:{next_after}"]
+    ).encode()).hexdigest()
+
+
+def to_api_product(row: dict) -> dict:
+    """
+    Returns a subscribed product row as it is shown by the API.
+    """
+    return {
+        'product_id': row['product_id'],
+        'product_name': row['product_name'],
+        'product_url': row['product_url'],
+        'image_url': row['image_url'],
+        'in_stock': row['product_availability'],
+        'price': float(row['price']) if row['price'] is not None else None,
+        'price_updated_at': row['price_updated_at'].isoformat() if row['price_updated_at'] else None
+    }
 
 
 @app.route("/")
@@ -189,28 +883,20 @@ def submit():
     """
     connection = get_database_connection()
     if request.method == 'POST':
-        first_name = request.form.get('firstName').capitalize()
-        last_name = request.form.get('lastName').capitalize()
-        email = request.form.get('email')
-        url = request.form.get('url')
-
-        header = {
-            'user-agent': environ["USER_AGENT"]
+        submission = {
+            'first_name': request.form.get('firstName').capitalize(),
+            'last_name': request.form.get('lastName').capitalize(),
+            'email': request.form.get('email'),
+            'url': request.form.get('url'),
+            'sizes': [size.strip() for size in request.form.get('sizes', '').split(',')
+                      if size.strip()]
         }
 
-        product_data = scrape_asos_page(url, header)
-
-        user_data = {
-            'first_name': first_name,
-            'last_name': last_name,
-            'email': email
-        }
+        # The scrape and inserts run in the background, so slow pages do not hold the worker.
+        job_id = create_submission_job(connection, submission)
+        job_executor.submit(process_submission_job, job_id)
 
-        insert_user_data(connection, user_data)
-        insert_product_data_and_price_data(connection, product_data)
-        insert_subscription_data(connection, email, url)
-
-        return render_template('/submitted_form/submitted_form.html')
+        return render_template('/submitted_form/submitted_form.html', job_id=job_id), 202
 
     if request.method == "GET":
         return render_template('/submission_form/input_website.html')
@@ -221,36 +907,18 @@ def unsubscribe_index():
     """
     Displays the unsubscribe HTML page.
     """
-    conn = get_database_connection()
     if request.method == "POST":
+        conn = get_database_connection()
         email = request.form.get('email')
 
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+        # Cached rows are shared between requests, so they are copied before labelling.
+        user_products = [dict(product, available="In Stock" if product["product_availability"]
+                              else "Out of Stock")
+                         for product in get_products_from_email(conn, email)]
 
-        cur.execute(EMAIL_SELECTION_QUERY)
-        rows = cur.fetchall()
-
-        emails = [row["email"] for row in rows]
-
-        if email not in emails:
-            return render_template('/subscriptions/not_subscribed.html')
-
-        cur.execute(GET_SUBS_BY_EMAIL_QUERY, (email,))
-
-        result = cur.fetchall()
-
-        if not result:
+        if not user_products:
             return render_template('/subscriptions/not_subscribed.html')
 
-        user_products = get_products_from_email(conn, email)
-        print(user_products)
-
-        for user in user_products:
-            if user["product_availability"] == True:
-                user["available"] = "In Stock"
-            else:
-                user["available"] = "Out of Stock"
-
         user_first_name = [product["first_name"]
                            for product in user_products][0]
 
@@ -270,24 +938,192 @@ def delete_subscription():
     """
     Deletes subscriptions.
     """
-    conn = get_database_connection()
-    product_name = request.form.get("product_name")
+    product_id = request.form.get("product_id", type=int)
     email = request.form.get('user_email')
 
-    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-    cur.execute(GET_PROD_ID_BY_PROD_NAME_QUERY, (product_name,))
-    product_id = cur.fetchone()['product_id']
+    if product_id is None or not email:
+        return 'A product id and email are required', 400
 
-    cur.execute(SELECT_USERS_BY_EMAIL_QUERY, (email,))
-    user_id = cur.fetchone()['user_id']
+    conn = get_database_connection()
 
-    cur.execute(DELETE_SUBSCRIPTIONS_QUERY,
-                (product_id, user_id))
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    QUERIES.execute(cur, "delete_subscription", (email, product_id))
     conn.commit()
+    cur.close()
+
+    subscriptions_cache.invalidate(email)
 
     return 'Subscription deleted successfully', 200
 
 
+@app.route('/jobs/<int:job_id>', methods=["GET"])
+def submission_job_status(job_id: int):
+    """
+    Returns the status of a product submission job.
+    """
+    conn = get_database_connection()
+
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    QUERIES.execute(cur, "submission_job", (job_id,))
+    job = cur.fetchone()
+    conn.commit()
+
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job), 200
+
+
+@app.route('/products/bulk', methods=["POST"])
+def bulk_import():
+    """
+    Subscribes one user to many products, streaming a JSON line per url as its result is known.
+    """
+    try:
+        user_data, product_urls, sizes = read_bulk_import(request)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    return Response(stream_with_context(import_products(user_data, product_urls, sizes)),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/api/v1/subscriptions', methods=["GET"])
+def api_subscriptions():
+    """
+    Returns a page of the products a user is subscribed to, ordered by product id.
+    The next page comes after the returned next_after.
+    """
+    email = request.args.get("email")
+    try:
+        if not email:
+            raise ValueError("email is required")
+        after = get_int_arg("after", 0, 0, 2 ** 31 - 1)
+        limit = get_int_arg("limit", API_DEFAULT_LIMIT, 1, API_MAX_LIMIT)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    conn = get_database_connection()
+
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    # Polling clients are answered from the products' last changes alone.
+    # One extra row shows whether there is another page.
+    if request.if_none_match:
+        QUERIES.execute(cur, "api_subscriptions_version", (email, after, limit + 1))
+        etag = get_subscriptions_etag(cur.fetchall(), limit)
+        if request.if_none_match.contains_weak(etag):
+            conn.commit()
+            cur.close()
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    QUERIES.execute(cur, "api_subscriptions", (email, after, limit + 1))
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+
+    page = rows[:limit]
+    response = jsonify({
+        'subscriptions': [to_api_product(row) for row in page],
+        'next_after': page[-1]['product_id'] if len(rows) > limit else None
+    })
+    response.set_etag(get_subscriptions_etag(rows, limit), weak=True)
+
+    return response
+
+
+@app.route('/api/v1/products/search', methods=["GET"])
+def api_search_products():
+    """
+    Returns the products matching a partial or misspelt name, for autocomplete.
+    Terms shorter than SEARCH_MIN_LENGTH match nothing.
+    """
+    term = request.args.get("q", "").strip()
+    try:
+        limit = get_int_arg("limit", SEARCH_DEFAULT_LIMIT, 1, SEARCH_MAX_LIMIT)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    if len(term) < SEARCH_MIN_LENGTH:
+        return jsonify({'products': []})
+
+    products = search_products(get_database_connection(), term, limit)
+
+    return jsonify({'products': [{'product_id': product['product_id'],
+                                  'product_name': product['product_name'],
+                                  'product_url': product['product_url'],
+                                  'image_url': product['image_url']}
+                                 for product in products]})
+
+
+@app.route('/api/v1/products/<int:product_id>/prices', methods=["GET"])
+def api_price_history(product_id: int):
+    """
+    Returns a product's prices between the from and to times, either as pages of
+    readings ordered by time, or downsampled to at most the requested number of points.
+    Clients sending the ETag of a previous response get a 304 until the product changes.
+    """
+    try:
+        start = get_time_arg("from", HISTORY_START)
+        end = get_time_arg("to", HISTORY_END)
+        after_time, after_id = get_history_cursor(start)
+        limit = get_int_arg("limit", API_DEFAULT_LIMIT, 1, API_MAX_LIMIT)
+        points = get_int_arg("points", 0, 0, API_MAX_POINTS)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    conn = get_database_connection()
+
+    cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+    QUERIES.execute(cur, "product_last_modified", (product_id,))
+    product = cur.fetchone()
+
+    if product is None:
+        conn.commit()
+        return jsonify({'error': 'Product not found'}), 404
+
+    # New prices touch the product, so its last change identifies the history.
+    etag = f"{product_id}-{product['last_modified'].timestamp()}"
+    if request.if_none_match.contains_weak(etag):
+        conn.commit()
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    if points:
+        QUERIES.execute(cur, "downsampled_price_history", (product_id, start, end, points))
+        prices = [{'updated_at': row['updated_at'].isoformat(), 'price': float(row['price']),
+                   'min_price': float(row['min_price']), 'max_price': float(row['max_price'])}
+                  for row in cur.fetchall()]
+        next_after = None
+    else:
+        QUERIES.execute(cur, "price_history",
+                        (product_id, start, end, after_time, after_id, limit + 1))
+        rows = cur.fetchall()
+        page = rows[:limit]
+        prices = [{'price_id': row['price_id'], 'updated_at': row['updated_at'].isoformat(),
+                   'price': float(row['price'])} for row in page]
+        next_after = (f"{page[-1]['updated_at'].isoformat()},{page[-1]['price_id']}"
+                      if len(rows) > limit else None)
+
+    conn.commit()
+    cur.close()
+
+    response = jsonify({'product_id': product_id, 'prices': prices, 'next_after': next_after})
+    response.set_etag(etag, weak=True)
+
+    return response
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """
+    Returns request, query and outbound call timings in the Prometheus text format.
+    """
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/submitted", methods=["POST"])
 def submitted_form():
     """
@@ -299,4 +1135,6 @@ def submitted_form():
 
 if __name__ == "__main__":
     load_dotenv()
+    with app.app_context():
+        resume_submission_jobs(get_database_connection())
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,102 @@
+"""
+Small in-process caches used by the API to avoid repeating database reads and scrapes.
+Entries expire after a fixed time, and the least recently used entries are
+dropped once the cache is full.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+from typing import Callable
+
+
+class TTLCache:
+    """
+    A thread-safe mapping whose entries expire ttl_seconds after they are set.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for the key, or the default if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        """
+        Caches the value for the key, dropping the least recently used entry if full.
+        """
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """
+        Removes the key from the cache, if it is there.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes every entry from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers arriving while a call for
+    their key is in flight wait for it and share its result.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = Lock()
+
+    def do(self, key, function: Callable, *args):
+        """
+        Returns the result of function(*args), or of the call already running for the key.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = Future()
+                self.calls[key] = call
+
+        if not is_leader:
+            return call.result()
+
+        try:
+            result = function(*args)
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -5,7 +5,7 @@ Configuration Test file - for creating a test client.
 import pytest
 from flask.testing import FlaskClient
 
-from app import app
+from app import app, subscriptions_cache
 
 
 @pytest.fixture()
@@ -14,3 +14,11 @@ def api_client() -> FlaskClient:
     Returns a version of the API for testing.
     """
     return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def empty_subscriptions_cache():
+    """
+    Stops cached subscriptions leaking between tests.
+    """
+    subscriptions_cache.clear()
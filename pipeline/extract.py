@@ -3,14 +3,25 @@ Extracts/scrapes the desired information from the required product.
 """
 import json
 from os import environ
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
 
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 import requests
 
+from cache import SingleFlight, TTLCache
+from metrics import time_outbound
+
 STARTER_ASOS_API = "https://www.asos.com/api/product/catalogue/v3/stockprice?"
+SCRAPE_CACHE_SIZE = 500
+SCRAPE_CACHE_SECONDS = 600
+STOCKPRICE_BATCH_SIZE = 50
+
+# Recent scrapes by canonical url, so popular products are not scraped again within minutes.
+scrape_cache = TTLCache(SCRAPE_CACHE_SIZE,
+                        int(environ.get("SCRAPE_CACHE_SECONDS", SCRAPE_CACHE_SECONDS)))
+scrape_flights = SingleFlight()
 
 
 def get_domain_name(url: str) -> str:
@@ -22,69 +33,203 @@ def get_domain_name(url: str) -> str:
     return domain_name
 
 
-def scrape_asos_page(url: str, header: dict) -> dict:
+def canonicalise_url(url: str) -> str:
     """
-    Scrapes an ASOS page and returns a dict of desired data about the product.
+    Returns the url without its query string, fragment or trailing slash, and with a
+    lower case scheme and host, so that links to the same product compare equal.
+    """
+    parsed_url = urlparse(url.strip())
+    return urlunparse((parsed_url.scheme.lower(), parsed_url.netloc.lower(),
+                       parsed_url.path.rstrip("/"), "", "", ""))
+
+
+def get_variant_id(variant: dict) -> int:
+    """
+    Returns the ASOS id of a size variant from the stockprice API.
+    """
+    return variant.get("variantId", variant.get("id"))
+
+
+def get_variant_sizes(product_data: dict) -> dict:
+    """
+    Returns the size label of each variant listed on the product page, keyed by variant id.
+    """
+    if "hasVariant" not in product_data.keys() and "@graph" in product_data.keys():
+        product_data = product_data['@graph'][0]
+
+    return {str(variant["sku"]): variant["size"]
+            for variant in product_data.get("hasVariant", [])
+            if "sku" in variant and "size" in variant}
+
+
+def get_stock_bitmap(variants: list) -> tuple[list, int]:
+    """
+    Returns the variant ids in bit order and a bitmap with bit i set
+    when variant i is in stock.
+    """
+    variant_ids = [get_variant_id(variant) for variant in variants]
+    bitmap = 0
+    for position, variant in enumerate(variants):
+        if variant["isInStock"]:
+            bitmap |= 1 << position
+
+    return variant_ids, bitmap
+
+
+def bitmap_to_bits(bitmap: int, width: int) -> str:
+    """
+    Returns a bitmap as a Postgres bit string, with variant 0 as the leftmost bit.
+    """
+    if width == 0:
+        return ""
+    return format(bitmap, f"0{width}b")[::-1]
+
+
+def get_size_mask(variant_sizes: list, wanted_sizes: list) -> str | None:
+    """
+    Returns a bit string selecting the variants with the wanted size labels,
+    or None if none of them match so that the subscription covers every size.
+    """
+    wanted = {size.strip().lower() for size in wanted_sizes if size.strip()}
+    mask = 0
+    for position, size in enumerate(variant_sizes or []):
+        if size.lower() in wanted:
+            mask |= 1 << position
+
+    if not mask:
+        return None
+    return bitmap_to_bits(mask, len(variant_sizes))
+
+
+def scrape_asos_product_page(url: str, header: dict) -> dict:
+    """
+    Scrapes an ASOS product page and returns the details in its structured data,
+    along with the label of each size variant. Raises an AttributeError if the
+    page has no product data.
     """
     domain_name = get_domain_name(url)
-    page = requests.get(url, headers=header, timeout=5)
+    with time_outbound("asos", "product_page"):
+        page = requests.get(url, headers=header, timeout=5)
     soup = BeautifulSoup(page.text, "html.parser").find(
         "script", type="application/ld+json")
+    product_data = json.loads(soup.string)
+
+    wanted_prod_data = {
+        "product_url": url,
+        "website_name": domain_name
+    }
+
+    if "name" in product_data.keys():
+        wanted_prod_data["product_name"] = product_data["name"]
+    else:
+        wanted_prod_data["product_name"] = product_data['@graph'][0]["name"]
+
+    if "image" in product_data.keys():
+        wanted_prod_data["image_URL"] = product_data["image"]
+    else:
+        wanted_prod_data["image_URL"] = product_data['@graph'][0]["image"]
+
+    if "productID" in product_data.keys():
+        wanted_prod_data["asos_product_id"] = product_data['productID']
+    else:
+        wanted_prod_data["asos_product_id"] = product_data['@graph'][0]['productID']
+
+    wanted_prod_data["size_labels"] = get_variant_sizes(product_data)
+
+    return wanted_prod_data
+
+
+def get_stock_prices(asos_product_ids: list) -> dict:
+    """
+    Returns the stockprice API result for each ASOS product id, keyed by the id as a string.
+    Ids are requested STOCKPRICE_BATCH_SIZE at a time. Products in a batch whose
+    request fails are left out.
+    """
+    stock_prices = {}
+
+    for start in range(0, len(asos_product_ids), STOCKPRICE_BATCH_SIZE):
+        batch = asos_product_ids[start:start + STOCKPRICE_BATCH_SIZE]
+        price_endpoint = f"""{STARTER_ASOS_API}productIds={
+            ','.join(str(asos_product_id) for asos_product_id in batch)
+            }&store=COM&currency=GBP"""
+
+        try:
+            with time_outbound("asos", "stockprice"):
+                product_api_results = requests.get(price_endpoint, timeout=5).json()
+        except (requests.RequestException, ValueError):
+            continue
+
+        for product_api_result in product_api_results:
+            stock_prices[str(product_api_result["productId"])] = product_api_result
+
+    return stock_prices
+
+
+def add_stock_price(product_page: dict, product_api_result: dict) -> dict:
+    """
+    Returns the scraped product page data with the price and per-size stock
+    from its stockprice API result.
+    """
+    wanted_prod_data = {key: value for key, value in product_page.items()
+                        if key != "size_labels"}
+
+    price = product_api_result["productPrice"]["current"]["value"]
+    sizes = product_api_result['variants']
+
+    if price:
+        wanted_prod_data["price"] = price
+    else:
+        wanted_prod_data["price"] = 0
+
+    variant_ids, stock_bitmap = get_stock_bitmap(sizes)
+    size_labels = product_page["size_labels"]
+
+    wanted_prod_data["variant_ids"] = variant_ids
+    wanted_prod_data["variant_sizes"] = [size_labels.get(str(variant_id), str(variant_id))
+                                         for variant_id in variant_ids]
+    wanted_prod_data["stock_bitmap"] = bitmap_to_bits(
+        stock_bitmap, len(variant_ids))
+    wanted_prod_data["is_in_stock"] = stock_bitmap != 0
+
+    return wanted_prod_data
+
+
+def scrape_asos_page(url: str, header: dict) -> dict:
+    """
+    Scrapes an ASOS page and returns a dict of desired data about the product.
+    """
     try:
-        product_data = json.loads(soup.string)
-
-        wanted_prod_data = {
-            "product_url": url,
-            "website_name": domain_name
-        }
-
-        if "name" in product_data.keys():
-            wanted_prod_data["product_name"] = product_data["name"]
-        else:
-            wanted_prod_data["product_name"] = product_data['@graph'][0]["name"]
-
-        if "image" in product_data.keys():
-            wanted_prod_data["image_URL"] = product_data["image"]
-        else:
-            wanted_prod_data["image_URL"] = product_data['@graph'][0]["image"]
-
-        if "productID" in product_data.keys():
-            price_endpoint = f"""{STARTER_ASOS_API}productIds={
-                product_data['productID']
-                }&store=COM&currency=GBP"""
-        else:
-            price_endpoint = f"""{STARTER_ASOS_API}productIds={
-                product_data['@graph'][0]['productID']
-                }&store=COM&currency=GBP"""
-
-        price = requests.get(price_endpoint, timeout=5).json()[
-            0]["productPrice"]["current"]["value"]
-
-        sizes = requests.get(price_endpoint, timeout=5).json()[0]['variants']
-
-        if price:
-            wanted_prod_data["price"] = price
-        else:
-            wanted_prod_data["price"] = 0
-
-        availabilities = []
-        for size in sizes:
-            if size["isInStock"] == True:
-                availabilities.append(size["isInStock"])
-            else:
-                availabilities.append(size["isInStock"])
-
-        if True in availabilities:
-            wanted_prod_data["is_in_stock"] = True
-        else:
-            wanted_prod_data["is_in_stock"] = False
-
-        return wanted_prod_data
+        product_page = scrape_asos_product_page(url, header)
+
+        price_endpoint = f"""{STARTER_ASOS_API}productIds={
+            product_page['asos_product_id']
+            }&store=COM&currency=GBP"""
+
+        with time_outbound("asos", "stockprice"):
+            product_api_result = requests.get(price_endpoint, timeout=5).json()[0]
+
+        return add_stock_price(product_page, product_api_result)
 
     except AttributeError as error:
         return error
 
 
+def scrape_product(url: str, header: dict) -> dict:
+    """
+    Returns the scraped data for the product at the canonical url.
+    Recent results are reused, and concurrent requests for the same url share one scrape.
+    Failed scrapes are not cached.
+    """
+    product_data = scrape_cache.get(url)
+
+    if product_data is None:
+        product_data = scrape_flights.do(url, scrape_asos_page, url, header)
+        if isinstance(product_data, dict):
+            scrape_cache.set(url, product_data)
+
+    return product_data
+
+
 if __name__ == "__main__":
 
     load_dotenv()
@@ -0,0 +1,128 @@
+"""
+A local stand-in for ASOS, used to load test the API without scraping the real site.
+It serves recorded product pages and stockprice results for any product id, after
+a configurable delay to mimic the real site's latency.
+"""
+
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from string import Template
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+
+RECORDED_DIRECTORY = path.join(path.dirname(path.abspath(__file__)), "recorded_asos")
+STOCKPRICE_PATH = "/api/product/catalogue/v3/stockprice"
+PRODUCT_PATH_PATTERN = re.compile(r"^/[\w-]+/prd/(?P<product_id>\d+)$")
+
+
+def read_recording(file_name: str) -> Template:
+    """
+    Returns a recorded response with its product details replaced by placeholders.
+    """
+    with open(path.join(RECORDED_DIRECTORY, file_name), encoding="utf-8") as recording:
+        return Template(recording.read())
+
+
+def get_product_fields(product_id: int) -> dict:
+    """
+    Returns the made-up details used to fill in the recordings for a product.
+    Each product has four size variants and a price that depends on its id.
+    """
+    fields = {"product_id": product_id,
+              "name": f"Load Test Product {product_id}",
+              "price": f"{10 + product_id % 90}.99"}
+    for variant in range(1, 5):
+        fields[f"variant_{variant}"] = product_id * 10 + variant
+
+    return fields
+
+
+class FakeAsosHandler(BaseHTTPRequestHandler):
+    """
+    Answers product page and stockprice requests from the recordings.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves the recording matching the request path, or a 404.
+        """
+        sleep(self.server.latency_seconds)
+
+        parsed_url = urlparse(self.path)
+        product_match = PRODUCT_PATH_PATTERN.match(parsed_url.path)
+
+        if product_match:
+            fields = get_product_fields(int(product_match.group("product_id")))
+            self.send_body(self.server.product_page.substitute(fields), "text/html")
+        elif parsed_url.path == STOCKPRICE_PATH:
+            product_ids = parse_qs(parsed_url.query).get("productIds", [""])[0]
+            results = [json.loads(self.server.stockprice.substitute(
+                get_product_fields(int(product_id))))
+                for product_id in product_ids.split(",") if product_id.isdigit()]
+            self.send_body(json.dumps(results), "application/json")
+        else:
+            self.send_error(404)
+
+    def send_body(self, body: str, content_type: str) -> None:
+        """
+        Sends a 200 response with the body.
+        """
+        encoded_body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Keeps request logs out of the load test's output.
+        """
+
+
+class FakeAsosServer(ThreadingHTTPServer):
+    """
+    Serves FakeAsosHandler on a free local port from a background thread.
+    Use as a context manager to start and stop it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency_seconds: float = 0):
+        super().__init__(("127.0.0.1", 0), FakeAsosHandler)
+        self.latency_seconds = latency_seconds
+        self.product_page = read_recording("product_page.html.tmpl")
+        self.stockprice = read_recording("stockprice.json.tmpl")
+
+    @property
+    def url(self) -> str:
+        """
+        The address the server is listening on.
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stockprice_api(self) -> str:
+        """
+        The stockprice endpoint, in the form extract.STARTER_ASOS_API expects.
+        """
+        return f"{self.url}{STOCKPRICE_PATH}?"
+
+    def product_url(self, product_id: int) -> str:
+        """
+        Returns the address of a product page.
+        """
+        return f"{self.url}/load-test-product/prd/{product_id}"
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,284 @@
+"""
+Load tests the API's submission and subscription endpoints.
+The API is served in-process against the Postgres database in .env, which should
+be loaded with schema.sql. It refuses to run against a database on another host. ASOS is replaced by fake_asos.py and SES by a stub, each
+with a configurable delay. Run from this folder, e.g.
+`python3 load_test.py --concurrency 1 8 32 --requests 200`.
+Each scenario prints its throughput and p50/p95/p99 latency at each concurrency.
+The users, products and jobs it creates are deleted when it finishes.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from statistics import quantiles
+from threading import Lock, Thread, local
+from time import perf_counter, sleep
+from typing import Callable
+
+import requests
+from dotenv import load_dotenv
+from werkzeug.serving import make_server
+
+import app as api
+import extract
+from fake_asos import FakeAsosServer
+
+
+LOAD_TEST_EMAIL_PATTERN = "load-test-%@example.com"
+JOB_DRAIN_TIMEOUT_SECONDS = 300
+LOCAL_DB_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+UNFINISHED_JOBS_QUERY = """
+            SELECT COUNT(*) FROM submission_jobs
+            WHERE status IN ('pending', 'running') AND email LIKE %s;
+            """
+LOAD_TEST_SUBSCRIPTIONS_QUERY = """
+            SELECT users.email, subscriptions.product_id FROM subscriptions
+            JOIN users ON users.user_id = subscriptions.user_id
+            WHERE users.email LIKE %s
+            ORDER BY subscriptions.subscription_id;
+            """
+CLEAN_UP_QUERIES = [
+    "DELETE FROM notifications WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM stock_snapshots WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM subscriptions WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM subscription_history WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM product_popularity_daily WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM prices WHERE product_id IN (SELECT product_id FROM products WHERE product_url LIKE %s);",
+    "DELETE FROM products WHERE product_url LIKE %s;",
+]
+CLEAN_UP_USERS_QUERIES = [
+    "DELETE FROM submission_jobs WHERE email LIKE %s;",
+    "DELETE FROM subscriptions WHERE user_id IN (SELECT user_id FROM users WHERE email LIKE %s);",
+    "DELETE FROM users WHERE email LIKE %s;",
+]
+
+
+class StubSESClient:
+    """
+    Stands in for the SES client, taking a fixed time to answer each call.
+    """
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+        self.lock = Lock()
+
+    def verify_email_address(self, EmailAddress: str) -> dict:  # pylint: disable=invalid-name
+        """
+        Pretends to send a verification email.
+        """
+        sleep(self.latency_seconds)
+        with self.lock:
+            self.calls += 1
+        return {"EmailAddress": EmailAddress}
+
+
+def summarise_latencies(latencies: list, elapsed: float) -> dict:
+    """
+    Returns the throughput and the 50th, 95th and 99th percentile latencies in milliseconds.
+    """
+    if len(latencies) > 1:
+        cut_points = quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = cut_points[49], cut_points[94], cut_points[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0.0
+
+    return {"throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50": p50 * 1000, "p95": p95 * 1000, "p99": p99 * 1000}
+
+
+def run_scenario(send_request: Callable, requests_to_send: int, concurrency: int) -> dict:
+    """
+    Sends requests from concurrency threads, each with its own session, and returns
+    the latency summary. A request fails if it raises or gets an unexpected status.
+    """
+    sessions = local()
+    latencies = []
+    errors = 0
+
+    def timed_request(request_number: int) -> tuple[float, bool]:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+
+        start = perf_counter()
+        try:
+            succeeded = send_request(sessions.session, request_number)
+        except requests.RequestException:
+            succeeded = False
+        return perf_counter() - start, succeeded
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, succeeded in executor.map(timed_request, range(requests_to_send)):
+            latencies.append(latency)
+            errors += not succeeded
+    elapsed = perf_counter() - start
+
+    return dict(summarise_latencies(latencies, elapsed), errors=errors)
+
+
+def get_load_test_email(user_number: int) -> str:
+    """
+    Returns the email of one of the load test's users.
+    """
+    return LOAD_TEST_EMAIL_PATTERN.replace("%", str(user_number))
+
+
+def wait_for_jobs(timeout_seconds: float) -> float:
+    """
+    Waits until the background workers have finished every load test submission,
+    and returns how long that took.
+    """
+    start = perf_counter()
+    conn = api.checkout_connection()
+
+    try:
+        with conn.cursor() as cur:
+            while perf_counter() - start < timeout_seconds:
+                cur.execute(UNFINISHED_JOBS_QUERY, (LOAD_TEST_EMAIL_PATTERN,))
+                conn.commit()
+                if cur.fetchone()[0] == 0:
+                    break
+                sleep(0.1)
+    finally:
+        api.return_connection(conn)
+
+    return perf_counter() - start
+
+
+def get_load_test_subscriptions() -> list:
+    """
+    Returns the email and product id of every load test subscription.
+    """
+    conn = api.checkout_connection()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(LOAD_TEST_SUBSCRIPTIONS_QUERY, (LOAD_TEST_EMAIL_PATTERN,))
+            subscriptions = cur.fetchall()
+        conn.commit()
+    finally:
+        api.return_connection(conn)
+
+    return subscriptions
+
+
+def clean_up(product_url_pattern: str) -> None:
+    """
+    Deletes the rows created by the load test.
+    """
+    conn = api.checkout_connection()
+
+    try:
+        with conn.cursor() as cur:
+            for query in CLEAN_UP_QUERIES:
+                cur.execute(query, (product_url_pattern,))
+            for query in CLEAN_UP_USERS_QUERIES:
+                cur.execute(query, (LOAD_TEST_EMAIL_PATTERN,))
+        conn.commit()
+    finally:
+        api.return_connection(conn)
+
+
+def print_result(scenario: str, concurrency: int, result: dict) -> None:
+    """
+    Prints one row of the results table.
+    """
+    print(f"{scenario:<22}{concurrency:>12}{result['throughput']:>10.1f}"
+          f"{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}"
+          f"{result['errors']:>8}")
+
+
+def check_database_is_local(host: str) -> None:
+    """
+    Raises a ValueError unless the database is on this machine, so the load test's
+    writes and clean up cannot reach a shared or production database.
+    """
+    # A host starting with / is the directory of a local Unix socket.
+    if host not in LOCAL_DB_HOSTS and not host.startswith("/"):
+        raise ValueError(f"The load test only runs against a local database, not {host}")
+
+
+def run_load_test(concurrency_levels: list, requests_per_level: int, users: int,
+                  products: int, asos_latency: float, ses_latency: float) -> None:
+    """
+    Serves the API and drives each endpoint at each concurrency level, printing the results.
+    """
+    check_database_is_local(environ["DB_HOST"])
+    environ.setdefault("USER_AGENT", "sale-tracker-load-test")
+    ses_client = StubSESClient(ses_latency)
+    api.get_ses_client = lambda config: ses_client
+
+    with FakeAsosServer(asos_latency) as asos:
+        extract.STARTER_ASOS_API = asos.stockprice_api
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+        api_url = f"http://127.0.0.1:{server.server_port}"
+
+        def add_product(session: requests.Session, request_number: int) -> bool:
+            response = session.post(f"{api_url}/addproducts", data={
+                "firstName": "load", "lastName": "test",
+                "email": get_load_test_email(request_number % users),
+                "url": asos.product_url(request_number % products + 1),
+                "sizes": "UK 8, UK 10"})
+            return response.status_code == 202
+
+        def list_subscriptions(session: requests.Session, request_number: int) -> bool:
+            response = session.post(f"{api_url}/subscriptions", data={
+                "email": get_load_test_email(request_number % users)})
+            return response.status_code == 200
+
+        print(f"{'scenario':<22}{'concurrency':>12}{'req/s':>10}"
+              f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+
+        try:
+            for concurrency in concurrency_levels:
+                print_result("/addproducts", concurrency,
+                             run_scenario(add_product, requests_per_level, concurrency))
+                drain_time = wait_for_jobs(JOB_DRAIN_TIMEOUT_SECONDS)
+                print(f"{'  jobs finished after':<22}{drain_time:>32.1f}s")
+
+                print_result("/subscriptions", concurrency,
+                             run_scenario(list_subscriptions, requests_per_level, concurrency))
+
+                subscriptions = get_load_test_subscriptions()
+
+                def delete_subscription(session: requests.Session, request_number: int) -> bool:
+                    email, product_id = subscriptions[request_number % len(subscriptions)]
+                    response = session.post(f"{api_url}/delete_subscription", data={
+                        "product_id": product_id, "user_email": email})
+                    return response.status_code == 200
+
+                if subscriptions:
+                    print_result("/delete_subscription", concurrency,
+                                 run_scenario(delete_subscription,
+                                              min(requests_per_level, len(subscriptions)),
+                                              concurrency))
+        finally:
+            server.shutdown()
+            api.job_executor.shutdown(wait=True, cancel_futures=True)
+            clean_up(f"{asos.url}/%")
+
+    print(f"SES verification emails sent: {ses_client.calls}")
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario at each concurrency level")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("--asos-latency-ms", type=float, default=200)
+    parser.add_argument("--ses-latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    run_load_test(args.concurrency, args.requests, args.users, args.products,
+                  args.asos_latency_ms / 1000, args.ses_latency_ms / 1000)
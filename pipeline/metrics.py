@@ -0,0 +1,227 @@
+"""
+Latency and row count metrics for the API, exposed in the Prometheus text format.
+Requests, SQL statements and calls to ASOS and SES are timed, and the time each
+request spends waiting on the database and on other services is kept so that
+slow requests can be logged with a breakdown.
+"""
+
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+from psycopg2.extensions import cursor
+
+from query_catalog import PreparingConnection
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STATEMENT_PATTERN = re.compile(
+    r"^\s*(?:EXECUTE\s+(?P<prepared>\w+)|PREPARE\s+(?P<preparing>\w+)"
+    r"|(?P<verb>\w+)(?:.*?\b(?:FROM|INTO|UPDATE)\s+|\s+)(?P<table>\w+))",
+    re.IGNORECASE | re.DOTALL)
+
+# Seconds spent on each kind of work during the current request, if one is being timed.
+request_breakdown = ContextVar("request_breakdown", default=None)
+
+registry = []
+
+
+def format_labels(label_names: tuple, labels: tuple, extra: str = "") -> str:
+    """
+    Returns label names and values in the Prometheus text format.
+    """
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label_value(value) -> str:
+    """
+    Returns a label value with backslashes, quotes and newlines escaped.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, separately for each set of labels.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple,
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        """
+        Records one observation for the labels.
+        """
+        with self.lock:
+            bucket_counts, _, _ = series = self.series.setdefault(
+                labels, [[0] * len(self.buckets), 0.0, 0])
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        """
+        Returns the histogram as lines of the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+
+        with self.lock:
+            for labels, (bucket_counts, total, count) in sorted(self.series.items()):
+                bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, bucket_count in zip(bounds, bucket_counts + [count]):
+                    bucket_labels = format_labels(self.label_names, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+
+        return lines
+
+
+class Counter:
+    """
+    A running total, kept separately for each set of labels.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.series = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def increment(self, labels: tuple, amount: float = 1) -> None:
+        """
+        Adds the amount to the total for the labels.
+        """
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        """
+        Returns the counter as lines of the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} counter"]
+
+        with self.lock:
+            for labels, total in sorted(self.series.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {total}")
+
+        return lines
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds",
+                             "Time taken to handle each request.",
+                             ("method", "route", "status"))
+QUERY_DURATION = Histogram("db_query_duration_seconds",
+                           "Time taken by each SQL statement.", ("statement",))
+QUERY_ROWS = Counter("db_query_rows_total",
+                     "Rows returned or changed by each SQL statement.", ("statement",))
+OUTBOUND_DURATION = Histogram("outbound_request_duration_seconds",
+                              "Time taken by calls to other services.", ("service", "operation"))
+
+
+def render_metrics() -> str:
+    """
+    Returns every metric in the Prometheus text format.
+    """
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+def add_to_breakdown(kind: str, seconds: float) -> None:
+    """
+    Adds time spent on a kind of work to the current request's breakdown.
+    """
+    breakdown = request_breakdown.get()
+    if breakdown is not None:
+        total, calls = breakdown.get(kind, (0.0, 0))
+        breakdown[kind] = (total + seconds, calls + 1)
+
+
+@contextmanager
+def time_outbound(service: str, operation: str) -> Iterator[None]:
+    """
+    Times a call to another service, such as a scrape of ASOS or an email through SES.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        OUTBOUND_DURATION.observe((service, operation), elapsed)
+        add_to_breakdown(service, elapsed)
+
+
+def statement_label(query) -> str:
+    """
+    Returns a short, low-cardinality name for a SQL statement: the name of a prepared
+    statement, or its first keyword and the table it works on.
+    """
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+
+    match = STATEMENT_PATTERN.match(str(query))
+    if match is None:
+        return "other"
+    if match.group("prepared"):
+        return match.group("prepared")
+    if match.group("preparing"):
+        return f"prepare {match.group('preparing')}"
+    return f"{match.group('verb').lower()} {match.group('table').lower()}"
+
+
+timed_cursor_classes = {}
+
+
+def get_timed_cursor_class(cursor_class: type) -> type:
+    """
+    Returns a subclass of the cursor class whose statements are timed.
+    """
+    timed_class = timed_cursor_classes.get(cursor_class)
+
+    if timed_class is None:
+        def execute(self, query, params=None):
+            start = perf_counter()
+            try:
+                return cursor_class.execute(self, query, params)
+            finally:
+                elapsed = perf_counter() - start
+                label = statement_label(query)
+                QUERY_DURATION.observe((label,), elapsed)
+                QUERY_ROWS.increment((label,), max(self.rowcount, 0))
+                add_to_breakdown("db", elapsed)
+
+        timed_class = type(f"Timed{cursor_class.__name__}", (cursor_class,), {"execute": execute})
+        timed_cursor_classes[cursor_class] = timed_class
+
+    return timed_class
+
+
+class InstrumentedConnection(PreparingConnection):
+    """
+    A database connection whose cursors time every statement they execute.
+    Pass as connection_factory when connecting.
+    """
+
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get("cursor_factory") or self.cursor_factory or cursor
+        kwargs["cursor_factory"] = get_timed_cursor_class(cursor_class)
+        return super().cursor(*args, **kwargs)
@@ -0,0 +1,78 @@
+"""
+Catalog of the parameterised queries which are run many times per connection.
+Each query is prepared on the server once per connection and then executed by name,
+so Postgres does not re-parse and re-plan it on every call.
+"""
+
+import re
+
+from psycopg2.extensions import connection, cursor
+
+
+PLACEHOLDER = re.compile(r"%[s%]")
+
+
+class PreparingConnection(connection):
+    """
+    A database connection which remembers the statements prepared on it.
+    Pass as connection_factory when connecting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+def to_positional_parameters(query: str) -> tuple[str, int]:
+    """
+    Returns the query with psycopg2 %s placeholders replaced by
+    Postgres $1, $2... parameters and %% escapes replaced by %, and the
+    number of parameters.
+    """
+    count = 0
+
+    def number_placeholder(match: re.Match) -> str:
+        nonlocal count
+        if match.group() == "%%":
+            return "%"
+        count += 1
+        return f"${count}"
+
+    return PLACEHOLDER.sub(number_placeholder, query.strip().rstrip(";")), count
+
+
+class QueryCatalog:
+    """
+    A named set of queries which are prepared lazily on each connection they run on.
+    """
+
+    def __init__(self, queries: dict[str, str]):
+        self.queries = queries
+        self.statements = {name: to_positional_parameters(query)
+                           for name, query in queries.items()}
+
+    def execute(self, cur: cursor, name: str, params: tuple = ()) -> None:
+        """
+        Executes the named query with the given parameters on the cursor.
+        Connections which cannot remember prepared statements run the plain query.
+        """
+        conn = cur.connection
+        prepared = getattr(conn, "prepared_statements", None)
+
+        if prepared is None:
+            cur.execute(self.queries[name], params)
+            return
+
+        statement, param_count = self.statements[name]
+
+        if name not in prepared:
+            # Prepared statements outlive transactions, so this is only done once.
+            with conn.cursor() as prepare_cur:
+                prepare_cur.execute(f"PREPARE {name} AS {statement}")
+            prepared.add(name)
+
+        if param_count:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * param_count)})",
+                        params)
+        else:
+            cur.execute(f"EXECUTE {name}")
@@ -1,15 +1,32 @@
+DROP TABLE IF EXISTS product_popularity_daily;
+DROP TABLE IF EXISTS subscription_history;
+DROP TABLE IF EXISTS credentials;
+DROP TABLE IF EXISTS submission_jobs;
+DROP TABLE IF EXISTS stock_snapshots;
+DROP TABLE IF EXISTS notifications;
 DROP TABLE IF EXISTS prices;
 DROP TABLE IF EXISTS subscriptions;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS products;
+DROP FUNCTION IF EXISTS touch_product;
+DROP FUNCTION IF EXISTS touch_priced_product;
+DROP FUNCTION IF EXISTS record_subscriptions;
+DROP FUNCTION IF EXISTS record_unsubscriptions;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 CREATE TABLE products (
     product_id SERIAL PRIMARY KEY,
     product_name VARCHAR(255),
-    product_url TEXT NOT NULL,
+    product_url TEXT NOT NULL UNIQUE,
     website_name VARCHAR(255) NOT NULL,
     product_availability BOOLEAN,
-    image_url TEXT
+    image_url TEXT,
+    variant_ids BIGINT[] NOT NULL DEFAULT '{}',
+    variant_sizes TEXT[] NOT NULL DEFAULT '{}',
+    stock_bitmap VARBIT NOT NULL DEFAULT B'',
+    asos_product_id BIGINT,
+    last_modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE prices (
@@ -21,17 +38,172 @@ CREATE TABLE prices (
 
 CREATE TABLE  users (
     user_id SERIAL PRIMARY KEY,
-    email TEXT NOT NULL,
+    email TEXT NOT NULL UNIQUE,
     first_name VARCHAR(255) NOT NULL,
     last_name VARCHAR(255) NOT NULL
 );
 
+-- Dashboard logins. Hashes are bcrypt, stored on first login so they are never
+-- recomputed. The admin has no row in users.
+CREATE TABLE credentials (
+    email TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    user_id INT,
+    is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE  subscriptions (
     subscription_id SERIAL PRIMARY KEY,
     user_id INT,
-    product_id INT
+    product_id INT,
+    size_mask VARBIT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (user_id, product_id)
+);
+
+-- Every subscription ever made, kept after it is deleted from subscriptions.
+-- Written by the subscriptions triggers below.
+CREATE TABLE subscription_history (
+    subscription_id INT PRIMARY KEY,
+    user_id INT,
+    product_id INT,
+    created_at TIMESTAMP NOT NULL,
+    removed_at TIMESTAMP
+);
+
+-- Subscriptions made and removed per product per day, kept up to date by the
+-- subscriptions triggers. A running total over the days gives the subscriber count.
+CREATE TABLE product_popularity_daily (
+    product_id INT NOT NULL,
+    day DATE NOT NULL,
+    subscribed INT NOT NULL DEFAULT 0,
+    unsubscribed INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, day)
 );
 
+CREATE TABLE stock_snapshots (
+    snapshot_id SERIAL PRIMARY KEY,
+    recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    product_id INT NOT NULL,
+    stock_bitmap VARBIT NOT NULL
+);
+
+CREATE TABLE notifications (
+    notification_id SERIAL PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    product_id INT,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    message_id TEXT,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    claimed_at TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+CREATE TABLE submission_jobs (
+    job_id SERIAL PRIMARY KEY,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    first_name VARCHAR(255) NOT NULL,
+    last_name VARCHAR(255) NOT NULL,
+    email TEXT NOT NULL,
+    product_url TEXT NOT NULL,
+    sizes TEXT[] NOT NULL DEFAULT '{}',
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX submission_jobs_unfinished_idx
+ON submission_jobs (job_id)
+WHERE status IN ('pending', 'running');
+
+CREATE INDEX products_last_modified_idx
+ON products (last_modified);
+
+CREATE INDEX prices_latest_idx
+ON prices (product_id, updated_at DESC);
+
+-- Serves product search: ILIKE substring matches and <% fuzzy word matches on names.
+CREATE INDEX products_name_trgm_idx
+ON products USING GIN (product_name gin_trgm_ops);
+
+CREATE FUNCTION touch_product() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.last_modified = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION touch_priced_product() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE products SET last_modified = CURRENT_TIMESTAMP
+    WHERE product_id = NEW.product_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The updater's snapshot re-reads only the products whose last_modified has moved.
+CREATE TRIGGER products_last_modified
+BEFORE UPDATE ON products
+FOR EACH ROW
+WHEN (OLD.* IS DISTINCT FROM NEW.*)
+EXECUTE FUNCTION touch_product();
+
+CREATE TRIGGER prices_touch_product
+AFTER INSERT ON prices
+FOR EACH ROW EXECUTE FUNCTION touch_priced_product();
+
+CREATE FUNCTION record_subscriptions() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO subscription_history (subscription_id, user_id, product_id, created_at)
+    SELECT subscription_id, user_id, product_id, created_at FROM added;
+
+    INSERT INTO product_popularity_daily (product_id, day, subscribed)
+    SELECT product_id, CURRENT_DATE, COUNT(*) FROM added GROUP BY product_id
+    ON CONFLICT (product_id, day)
+    DO UPDATE SET subscribed = product_popularity_daily.subscribed + EXCLUDED.subscribed;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION record_unsubscriptions() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE subscription_history SET removed_at = CURRENT_TIMESTAMP
+    FROM removed
+    WHERE subscription_history.subscription_id = removed.subscription_id;
+
+    INSERT INTO product_popularity_daily (product_id, day, unsubscribed)
+    SELECT product_id, CURRENT_DATE, COUNT(*) FROM removed GROUP BY product_id
+    ON CONFLICT (product_id, day)
+    DO UPDATE SET unsubscribed = product_popularity_daily.unsubscribed + EXCLUDED.unsubscribed;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Once per statement, so a bulk subscription updates each product's day once.
+CREATE TRIGGER subscriptions_recorded
+AFTER INSERT ON subscriptions
+REFERENCING NEW TABLE AS added
+FOR EACH STATEMENT EXECUTE FUNCTION record_subscriptions();
+
+CREATE TRIGGER subscriptions_removal_recorded
+AFTER DELETE ON subscriptions
+REFERENCING OLD TABLE AS removed
+FOR EACH STATEMENT EXECUTE FUNCTION record_unsubscriptions();
+
+CREATE INDEX notifications_undelivered_idx
+ON notifications (notification_id)
+WHERE status IN ('pending', 'sending');
+
 ALTER TABLE prices
 ADD CONSTRAINT product_fk
 FOREIGN KEY (product_id)
@@ -42,6 +214,21 @@ ADD CONSTRAINT user_fk
 FOREIGN KEY (user_id)
 REFERENCES users(user_id);
 
+ALTER TABLE credentials
+ADD CONSTRAINT credentials_user_fk
+FOREIGN KEY (user_id)
+REFERENCES users(user_id) ON DELETE CASCADE;
+
+ALTER TABLE stock_snapshots
+ADD CONSTRAINT stock_snapshot_product_fk
+FOREIGN KEY (product_id)
+REFERENCES products(product_id);
+
+ALTER TABLE notifications
+ADD CONSTRAINT notification_product_fk
+FOREIGN KEY (product_id)
+REFERENCES products(product_id);
+
 ALTER TABLE products 
 ADD CONSTRAINT product_sub_fk
 FOREIGN KEY (product_id)
@@ -3,7 +3,7 @@ function getUserEmail() {
             console.log(userEmail)
             return userEmail
         }
-        function deleteItem(element, productName) {
+        function deleteItem(element, productId) {
             var userEmail = getUserEmail()
             if (confirm("Are you sure you want to unsubscribe from receiving notifications for this product?")) {
                 var xhr_request = new XMLHttpRequest();
@@ -14,6 +14,6 @@ function getUserEmail() {
                         element.parentNode.parentNode.remove();
                     }
                 }
-                xhr_request.send("product_name=" + encodeURIComponent(productName) + "&user_email=" + encodeURIComponent(userEmail));
+                xhr_request.send("product_id=" + encodeURIComponent(productId) + "&user_email=" + encodeURIComponent(userEmail));
             }
         }
\ No newline at end of file
@@ -1,65 +1,43 @@
 """
 Unit tests for the file app.py.
 """
+import json
+from datetime import datetime
+from os import environ
+from statistics import median
+from time import perf_counter, sleep
 from unittest.mock import MagicMock, patch
 
+import pytest
 from dotenv import load_dotenv
+from flask import request
+from psycopg2 import connect
 
-from app import insert_user_data, insert_product_data_and_price_data, insert_subscription_data, get_products_from_email
+from query_catalog import PreparingConnection
 
+from app import insert_user_data, insert_product_data_and_price_data, insert_subscription_data, get_products_from_email, process_submission_job, get_database_connection, app, register_submission, subscriptions_cache, run_submission, read_bulk_import, get_subscriptions_etag
 
-def test_insert_user_data_no_insert():
-    """
-    Tests that execute is only called once when
-    the email is already in the database. 
-    """
-
-    test_data = {'email': 'person1@email.com',
-                 'first_name': 'John',
-                 'last_name': 'Doe'}
-
-    emails = [{"email": 'person1@email.com'}]
-
-    mock_db_connection = MagicMock()
-    mock_execute = mock_db_connection.cursor().execute
-    mock_fetchall = mock_db_connection.cursor().fetchall
-
-    mock_fetchall.return_value = emails
-
-    insert_user_data(mock_db_connection, test_data)
-
-    mock_execute.assert_called_once()
 
-
-@patch("app.get_ses_client")
-def test_insert_user_data_correct(mock_get_ses_client):
+def test_insert_user_data_returns_user():
     """
-    Tests that execute is called twice and verify email is called once
-    when the email is not in the database.
+    Tests that a user is upserted with a single execute and returned.
     """
 
     test_data = {'email': 'person1@email.com',
                  'first_name': 'John',
                  'last_name': 'Doe'}
 
-    emails = [{"email": 'person2@email.com'}]
-
     mock_db_connection = MagicMock()
     mock_execute = mock_db_connection.cursor().execute
-    mock_fetchall = mock_db_connection.cursor().fetchall
-
-    mock_fetchall.return_value = emails
-
-    mock_ses = MagicMock()
-
-    mock_get_ses_client.return_value = mock_ses
+    mock_fetchone = mock_db_connection.cursor().fetchone
 
-    mock_verify_email = mock_ses.verify_email_address
+    mock_fetchone.return_value = {"user_id": 2, "inserted": False}
 
-    insert_user_data(mock_db_connection, test_data)
+    user = insert_user_data(mock_db_connection, test_data)
 
-    assert mock_verify_email.call_count == 1
-    assert mock_execute.call_count == 2
+    mock_execute.assert_called_once()
+    assert user == {"user_id": 2, "inserted": False}
+    mock_db_connection.commit.assert_not_called()
 
 
 def test_insert_product_data_no_insert():
@@ -68,15 +46,14 @@ def test_insert_product_data_no_insert():
     is already in the database.
     """
 
-    test_data = {"product_name": "test product"}
-
-    product_data = [{"product_name": "test product"}]
+    test_data = {"product_name": "test product", "product_url": "test_url",
+                 "image_URL": "test_url", "is_in_stock": True, "website_name": "asos", "price": 0}
 
     mock_db_connection = MagicMock()
     mock_execute = mock_db_connection.cursor().execute
-    mock_fetchall = mock_db_connection.cursor().fetchall
+    mock_fetchone = mock_db_connection.cursor().fetchone
 
-    mock_fetchall.return_value = product_data
+    mock_fetchone.return_value = {"product_id": 5, "variant_sizes": [], "inserted": False}
 
     insert_product_data_and_price_data(mock_db_connection, test_data)
 
@@ -85,45 +62,57 @@ def test_insert_product_data_no_insert():
 
 def test_insert_product_data_correct():
     """
-    Tests that execute is called twice when the product is not in the database.
+    Tests that execute is called twice when the product is not in the database,
+    once for the product and once for its first price.
     """
 
     test_data = {"product_name": "test product", "product_url": "test_url",
                  "image_URL": "test_url", "is_in_stock": True, "website_name": "asos", "price": 0}
 
-    product_data = [{"product_name": "product1", "product_url": "test_url",
-                     "image_URL": "test_url", "is_in_stock": True, "website_name": "asos"}]
-
     mock_db_connection = MagicMock()
     mock_execute = mock_db_connection.cursor().execute
-    mock_fetchall = mock_db_connection.cursor().fetchall
+    mock_fetchone = mock_db_connection.cursor().fetchone
 
-    mock_fetchall.return_value = product_data
+    mock_fetchone.return_value = {"product_id": 5, "variant_sizes": [], "inserted": True}
 
     insert_product_data_and_price_data(mock_db_connection, test_data)
 
-    assert mock_execute.call_count == 4
+    assert mock_execute.call_count == 2
 
 
-def test_insert_subscription_data_no_insert():
+def test_insert_subscription_data():
     """
-    Tests that execute is called three times when the subscription is in the database.
+    Tests that a subscription is inserted with a single execute.
     """
 
-    test_email = "test@email.com"
-    test_url = "test_url"
-
-    mock_data = {"user_id": 2, "product_id": 5}
-
     mock_db_connection = MagicMock()
     mock_execute = mock_db_connection.cursor().execute
-    mock_fetchone = mock_db_connection.cursor().fetchone
 
-    mock_fetchone.return_value = mock_data
+    insert_subscription_data(mock_db_connection, 2,
+                             {"product_id": 5, "variant_sizes": []})
+
+    assert mock_execute.call_count == 1
+
+
+@patch("app.insert_subscription_data")
+@patch("app.insert_product_data_and_price_data")
+@patch("app.insert_user_data")
+def test_register_submission_commits_once(mock_insert_user_data,
+                                          mock_insert_product_data_and_price_data,
+                                          mock_insert_subscription_data):
+    """
+    Tests that the user, product and subscription are committed in one transaction.
+    """
+    mock_db_connection = MagicMock()
+    mock_insert_user_data.return_value = {"user_id": 2, "inserted": True}
+    mock_insert_product_data_and_price_data.return_value = {"product_id": 5}
 
-    insert_subscription_data(mock_db_connection, test_email, test_url)
+    is_new_user = register_submission(mock_db_connection, {"email": "test@email.com"}, {}, ["UK 8"])
 
-    assert mock_execute.call_count == 3
+    assert is_new_user
+    mock_insert_subscription_data.assert_called_once_with(
+        mock_db_connection, 2, {"product_id": 5}, ["UK 8"])
+    mock_db_connection.commit.assert_called_once()
 
 
 def test_get_products_from_email():
@@ -141,14 +130,35 @@ def test_get_products_from_email():
     assert mock_execute.call_count == 1
 
 
+def test_get_products_from_email_cached():
+    """
+    Tests a repeated lookup is served from the cache until the email is invalidated.
+    """
+
+    mock_conn = MagicMock()
+    email = "example@email.com"
+
+    mock_execute = mock_conn.cursor().execute
+    mock_conn.cursor().fetchall.return_value = [{"product_id": 5}]
+
+    assert get_products_from_email(mock_conn, email) == [{"product_id": 5}]
+    assert get_products_from_email(mock_conn, email) == [{"product_id": 5}]
+    assert mock_execute.call_count == 1
+
+    subscriptions_cache.invalidate(email)
+    get_products_from_email(mock_conn, email)
+
+    assert mock_execute.call_count == 2
+
+
 @patch("app.insert_subscription_data")
 @patch("app.insert_product_data_and_price_data")
 @patch("app.insert_user_data")
-@patch("app.scrape_asos_page")
+@patch("app.scrape_product")
 @patch("app.get_database_connection")
 @patch("app.render_template")
 def test_submit_get(mock_render_template, mock_get_database_connection,
-                    mock_scrape_asos_page, mock_insert_user_data,
+                    mock_scrape_product, mock_insert_user_data,
                     mock_insert_product_data_and_price_data, mock_insert_subscription_data, api_client):
     """
     Tests a get request to the addproducts returns a 200 status code.
@@ -164,11 +174,11 @@ def test_submit_get(mock_render_template, mock_get_database_connection,
 @patch("app.insert_subscription_data")
 @patch("app.insert_product_data_and_price_data")
 @patch("app.insert_user_data")
-@patch("app.scrape_asos_page")
+@patch("app.scrape_product")
 @patch("app.get_database_connection")
 @patch("app.render_template")
 def test_subscriptions_post(mock_render_template, mock_get_database_connection,
-                            mock_scrape_asos_page, mock_insert_user_data,
+                            mock_scrape_product, mock_insert_user_data,
                             mock_insert_product_data_and_price_data, mock_insert_subscription_data, api_client):
     """
     Tests a post request to the subscriptions page returns a 200 status code.
@@ -192,10 +202,26 @@ def test_delete_subscriptions_post(mock_get_database_connection, api_client):
     load_dotenv()
 
     response = api_client.post("/delete_subscription", data={
-        "email": "test@email.com"
+        "product_id": "5", "user_email": "test@email.com"
     })
 
     assert response.status_code == 200
+    assert mock_get_database_connection.return_value.cursor().execute.call_args[0][1] == (
+        "test@email.com", 5)
+
+
+@patch("app.get_database_connection")
+def test_delete_subscriptions_post_without_product_id(mock_get_database_connection, api_client):
+    """
+    Tests a post request to the delete subscriptions page without a product id is rejected.
+    """
+
+    response = api_client.post("/delete_subscription", data={
+        "user_email": "test@email.com"
+    })
+
+    assert response.status_code == 400
+    mock_get_database_connection.assert_not_called()
 
 
 @patch("app.get_database_connection")
@@ -211,3 +237,432 @@ def test_submitted_post(mock_get_database_connection, api_client):
     })
 
     assert response.status_code == 200
+
+
+@patch("app.job_executor")
+@patch("app.create_submission_job")
+@patch("app.get_database_connection")
+@patch("app.render_template")
+def test_submit_post_queues_job(mock_render_template, mock_get_database_connection,
+                                mock_create_submission_job, mock_job_executor, api_client):
+    """
+    Tests a post request to addproducts records a job and returns without scraping.
+    """
+    mock_render_template.return_value = "submitted"
+    mock_create_submission_job.return_value = 7
+
+    response = api_client.post("/addproducts", data={
+        "firstName": "test", "lastName": "user", "email": "test@email.com",
+        "url": "https://www.asos.com/product", "sizes": "UK 8, UK 10"
+    })
+
+    assert response.status_code == 202
+    assert mock_create_submission_job.call_args[0][1]['sizes'] == [
+        'UK 8', 'UK 10']
+    mock_job_executor.submit.assert_called_once_with(
+        process_submission_job, 7)
+
+
+@patch("app.run_submission")
+@patch("app.return_connection")
+@patch("app.checkout_connection")
+def test_process_submission_job_records_failure(mock_checkout_connection,
+                                                mock_return_connection,
+                                                mock_run_submission):
+    """
+    Tests that a job which raises is rolled back and marked as failed.
+    """
+    mock_conn = mock_checkout_connection.return_value
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.fetchone.return_value = {'product_url': 'https://www.asos.com/product'}
+    mock_run_submission.side_effect = ValueError("Could not scrape")
+
+    process_submission_job(7)
+
+    mock_conn.rollback.assert_called_once()
+    assert mock_cursor.execute.call_args[0][1] == (
+        'failed', 'Could not scrape', 7)
+    mock_return_connection.assert_called_once_with(mock_conn)
+
+
+@patch("app.run_submission")
+@patch("app.return_connection")
+@patch("app.checkout_connection")
+def test_process_submission_job_already_claimed(mock_checkout_connection,
+                                                mock_return_connection,
+                                                mock_run_submission):
+    """
+    Tests that a job claimed by another worker is not run again.
+    """
+    mock_conn = mock_checkout_connection.return_value
+    mock_conn.cursor.return_value.fetchone.return_value = None
+
+    process_submission_job(7)
+
+    mock_run_submission.assert_not_called()
+    mock_return_connection.assert_called_once_with(mock_conn)
+
+
+@patch("app.get_database_connection")
+def test_submission_job_status_not_found(mock_get_database_connection, api_client):
+    """
+    Tests the job status endpoint returns 404 for an unknown job.
+    """
+    mock_cursor = mock_get_database_connection.return_value.cursor.return_value
+    mock_cursor.fetchone.return_value = None
+
+    response = api_client.get("/jobs/7")
+
+    assert response.status_code == 404
+
+
+@patch("app.return_connection")
+@patch("app.checkout_connection")
+def test_request_connection_returned_on_teardown(mock_checkout_connection,
+                                                 mock_return_connection):
+    """
+    Tests that a request checks out one pooled connection and returns it on teardown.
+    """
+    with app.test_request_context("/subscriptions"):
+        first = get_database_connection()
+        second = get_database_connection()
+
+        assert first is second
+        mock_return_connection.assert_not_called()
+
+    mock_checkout_connection.assert_called_once()
+    mock_return_connection.assert_called_once_with(first)
+
+
+SEED_USERS_QUERY = """
+            INSERT INTO users (email, first_name, last_name)
+            SELECT 'seed' || n || '@email.com', 'Seed', 'User' FROM generate_series(1, %s) AS n;
+            """
+SEED_PRODUCTS_QUERY = """
+            INSERT INTO products (product_name, product_url, website_name)
+            SELECT 'Seed product ' || n, 'https://www.asos.com/seed/' || n, 'www.asos.com'
+            FROM generate_series(1, %s) AS n;
+            """
+
+
+def time_registrations(conn, count: int, label: str) -> float:
+    """
+    Returns the median time in seconds to register a new user and product.
+    """
+    timings = []
+
+    for n in range(count):
+        user_data = {'email': f'{label}{n}@email.com',
+                     'first_name': 'Test', 'last_name': 'User'}
+        product_data = {"product_name": f"{label} product {n}",
+                        "product_url": f"https://www.asos.com/{label}/{n}",
+                        "image_URL": "test_url", "is_in_stock": True,
+                        "website_name": "www.asos.com", "price": 10}
+
+        start = perf_counter()
+        user = insert_user_data(conn, user_data)
+        product = insert_product_data_and_price_data(conn, product_data)
+        insert_subscription_data(conn, user['user_id'], product)
+        timings.append(perf_counter() - start)
+
+    return median(timings)
+
+
+@pytest.mark.skipif(environ.get("RUN_DATABASE_TESTS") != "1",
+                    reason="Needs a database loaded with schema.sql")
+def test_registration_latency_flat_as_tables_grow():
+    """
+    Tests that registering stays as fast with a million users and products as with none.
+    Everything inserted is rolled back.
+    """
+    conn = connect(user=environ["DB_USER"], password=environ["DB_PASSWORD"],
+                   host=environ["DB_HOST"], port=environ["DB_PORT"],
+                   database=environ["DB_NAME"], connection_factory=PreparingConnection)
+
+    try:
+        empty_tables = time_registrations(conn, 200, "before")
+
+        with conn.cursor() as cur:
+            cur.execute(SEED_USERS_QUERY, (1_000_000,))
+            cur.execute(SEED_PRODUCTS_QUERY, (1_000_000,))
+            cur.execute("ANALYZE users; ANALYZE products;")
+
+        full_tables = time_registrations(conn, 200, "after")
+
+        assert full_tables < empty_tables * 3
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@patch("app.register_submission")
+@patch("app.scrape_product")
+@patch("app.get_tracked_product")
+def test_run_submission_tracked_product_not_scraped(mock_get_tracked_product,
+                                                   mock_scrape_product,
+                                                   mock_register_submission):
+    """
+    Tests that a product which is already tracked is taken from the database,
+    looked up by its canonical url.
+    """
+    mock_conn = MagicMock()
+    tracked_product = {"product_id": 5, "variant_sizes": []}
+    mock_get_tracked_product.return_value = tracked_product
+    mock_register_submission.return_value = False
+
+    run_submission(mock_conn, {"product_url": "https://www.asos.com/prd/123/?clr=red",
+                               "first_name": "Test", "last_name": "User",
+                               "email": "test@email.com", "sizes": []})
+
+    mock_get_tracked_product.assert_called_once_with(
+        mock_conn, "https://www.asos.com/prd/123")
+    mock_scrape_product.assert_not_called()
+    assert mock_register_submission.call_args[0][2] is tracked_product
+
+
+def test_read_bulk_import_json():
+    """
+    Tests a JSON bulk import is read with canonical, de-duplicated urls.
+    """
+    with app.test_request_context("/products/bulk", method="POST", json={
+            "first_name": "test", "last_name": "user", "email": "test@email.com",
+            "urls": ["https://www.asos.com/prd/1?clr=red", "https://www.asos.com/prd/1", " "],
+            "sizes": ["UK 8"]}):
+        user_data, urls, sizes = read_bulk_import(request)
+
+    assert user_data == {'first_name': 'Test', 'last_name': 'User', 'email': 'test@email.com'}
+    assert urls == ["https://www.asos.com/prd/1"]
+    assert sizes == ["UK 8"]
+
+
+def test_read_bulk_import_csv():
+    """
+    Tests a CSV bulk import takes urls from the body and the user from the query string.
+    """
+    with app.test_request_context(
+            "/products/bulk?first_name=test&last_name=user&email=test@email.com&sizes=UK 8,UK 10",
+            method="POST", data="url\nhttps://www.asos.com/prd/1\nhttps://www.asos.com/prd/2\n",
+            content_type="text/csv"):
+        user_data, urls, sizes = read_bulk_import(request)
+
+    assert user_data['email'] == 'test@email.com'
+    assert urls == ["https://www.asos.com/prd/1", "https://www.asos.com/prd/2"]
+    assert sizes == ["UK 8", "UK 10"]
+
+
+@patch("app.BULK_IMPORT_MAX_URLS", 1)
+def test_bulk_import_too_many_urls(api_client):
+    """
+    Tests a bulk import over the url limit is rejected before anything is scraped.
+    """
+    response = api_client.post("/products/bulk", json={
+        "first_name": "test", "last_name": "user", "email": "test@email.com",
+        "urls": ["https://www.asos.com/prd/1", "https://www.asos.com/prd/2"]})
+
+    assert response.status_code == 400
+
+
+@patch.dict("os.environ", {"USER_AGENT": "test"})
+@patch("app.insert_bulk_subscriptions")
+@patch("app.insert_bulk_products")
+@patch("app.insert_user_data")
+@patch("app.get_stock_prices")
+@patch("app.scrape_product_pages")
+@patch("app.get_tracked_products")
+@patch("app.return_connection")
+@patch("app.checkout_connection")
+def test_bulk_import_streams_results(mock_checkout_connection, mock_return_connection,
+                                     mock_get_tracked_products,
+                                     mock_scrape_product_pages, mock_get_stock_prices,
+                                     mock_insert_user_data, mock_insert_bulk_products,
+                                     mock_insert_bulk_subscriptions, api_client):
+    """
+    Tests a bulk import prices new products in one batch, commits once and
+    streams a result line for every url. No connection is held while scraping.
+    """
+    tracked = {"product_url": "https://www.asos.com/prd/1", "product_id": 1, "variant_sizes": []}
+    mock_get_tracked_products.return_value = {tracked["product_url"]: tracked}
+
+    def scrape_product_pages(_product_urls, _header):
+        assert mock_return_connection.call_count == mock_checkout_connection.call_count
+        return [
+            ("https://www.asos.com/prd/2", {"product_url": "https://www.asos.com/prd/2",
+                                            "asos_product_id": 22, "size_labels": {}}),
+            ("https://www.asos.com/prd/3", AttributeError("no product data"))]
+    mock_scrape_product_pages.side_effect = scrape_product_pages
+    mock_get_stock_prices.return_value = {"22": {"productPrice": {"current": {"value": 10}},
+                                                 "variants": []}}
+    mock_insert_user_data.return_value = {"user_id": 7, "inserted": False}
+    mock_insert_bulk_products.return_value = [
+        {"product_url": "https://www.asos.com/prd/2", "product_id": 2, "inserted": True}]
+
+    response = api_client.post("/products/bulk", json={
+        "first_name": "test", "last_name": "user", "email": "test@email.com",
+        "urls": ["https://www.asos.com/prd/1", "https://www.asos.com/prd/2",
+                 "https://www.asos.com/prd/3"]})
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert {result["url"]: result["status"] for result in results} == {
+        "https://www.asos.com/prd/1": "subscribed", "https://www.asos.com/prd/2": "subscribed",
+        "https://www.asos.com/prd/3": "failed"}
+    mock_get_stock_prices.assert_called_once_with([22])
+    assert mock_insert_bulk_subscriptions.call_args[0][1] == 7
+    mock_checkout_connection.return_value.commit.assert_called()
+    assert mock_checkout_connection.call_count == 2
+    assert mock_return_connection.call_count == 2
+
+
+@patch("app.get_database_connection")
+def test_api_subscriptions_next_page(mock_get_database_connection, api_client):
+    """
+    Tests a full page of subscriptions returns the cursor of the next page.
+    """
+    rows = [{"product_id": product_id, "product_name": "test", "product_url": "test_url",
+             "image_url": "test_url", "product_availability": True, "price": 10,
+             "price_updated_at": None, "last_modified": datetime(2024, 1, 1)}
+            for product_id in (3, 5, 8)]
+    mock_get_database_connection.return_value.cursor().fetchall.return_value = rows
+
+    response = api_client.get("/api/v1/subscriptions?email=test@email.com&limit=2")
+
+    assert response.status_code == 200
+    assert [product["product_id"] for product in response.get_json()["subscriptions"]] == [3, 5]
+    assert response.get_json()["next_after"] == 5
+    assert response.headers["ETag"]
+
+
+@patch("app.get_database_connection")
+def test_api_subscriptions_not_modified(mock_get_database_connection, api_client):
+    """
+    Tests a client with the current ETag gets a 304 without the page of products
+    and their prices being read.
+    """
+    rows = [{"product_id": product_id, "product_name": "test", "product_url": "test_url",
+             "image_url": "test_url", "product_availability": True, "price": 10,
+             "price_updated_at": None, "last_modified": datetime(2024, 1, 1)}
+            for product_id in (3, 5, 8)]
+    mock_cursor = mock_get_database_connection.return_value.cursor()
+    mock_cursor.fetchall.return_value = rows
+    etag = api_client.get("/api/v1/subscriptions?email=test@email.com&limit=2").headers["ETag"]
+    mock_cursor.execute.reset_mock()
+
+    response = api_client.get("/api/v1/subscriptions?email=test@email.com&limit=2",
+                              headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert mock_cursor.execute.call_count == 1
+    assert "LATERAL" not in mock_cursor.execute.call_args[0][0]
+
+
+def test_subscriptions_etag_includes_next_page():
+    """
+    Tests that the same page gets a new ETag when the page after it starts elsewhere.
+    """
+    rows = [{"product_id": product_id, "last_modified": datetime(2024, 1, 1)}
+            for product_id in (3, 5, 8)]
+
+    assert get_subscriptions_etag(rows, 2) != get_subscriptions_etag(rows[:2], 2)
+
+
+@patch("app.get_database_connection")
+def test_api_price_history_not_modified(mock_get_database_connection, api_client):
+    """
+    Tests a client with the current ETag gets a 304 without the history being read.
+    """
+    mock_cursor = mock_get_database_connection.return_value.cursor()
+    mock_cursor.fetchone.return_value = {"last_modified": datetime(2024, 1, 1)}
+    etag = f'W/"5-{datetime(2024, 1, 1).timestamp()}"'
+
+    response = api_client.get("/api/v1/products/5/prices", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert mock_cursor.execute.call_count == 1
+
+
+def test_api_price_history_invalid_time(api_client):
+    """
+    Tests an invalid time range is rejected.
+    """
+    response = api_client.get("/api/v1/products/5/prices?from=yesterday")
+
+    assert response.status_code == 400
+
+
+def test_metrics_records_request_latency(api_client):
+    """
+    Tests that handled requests are counted by route and shown on the metrics endpoint.
+    """
+    api_client.get("/api/v1/products/5/prices?from=yesterday")
+
+    response = api_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert ('http_request_duration_seconds_count{method="GET",'
+            'route="/api/v1/products/<int:product_id>/prices",status="400"}'
+            in response.get_data(as_text=True))
+
+
+@patch.dict("app.environ", {"SLOW_REQUEST_MS": "0"})
+def test_slow_request_logged(api_client, caplog):
+    """
+    Tests that requests slower than SLOW_REQUEST_MS are logged with a breakdown.
+    """
+    api_client.get("/api/v1/products/5/prices?from=yesterday")
+
+    assert "Slow request GET /api/v1/products/5/prices" in caplog.text
+
+
+@patch("app.REQUEST_DURATION")
+@patch("app.import_products")
+def test_streamed_request_timed_to_last_byte(mock_import_products, mock_request_duration,
+                                            api_client):
+    """
+    Tests that a streamed response is timed once its body has been sent, not when
+    the view returns.
+    """
+    def import_products(_user_data, _product_urls, _sizes):
+        sleep(0.05)
+        yield "{}\n"
+    mock_import_products.side_effect = import_products
+
+    response = api_client.post("/products/bulk", json={
+        "first_name": "test", "last_name": "user", "email": "test@email.com",
+        "urls": ["https://www.asos.com/prd/1"]})
+    mock_request_duration.observe.assert_not_called()
+
+    response.get_data()
+    response.close()
+
+    labels, elapsed = mock_request_duration.observe.call_args[0]
+    assert labels == ("POST", "/products/bulk", "200")
+    assert elapsed >= 0.05
+
+
+@patch("app.get_database_connection")
+def test_api_search_products(mock_get_database_connection, api_client):
+    """
+    Tests that search terms are escaped for LIKE patterns and matches are returned.
+    """
+    mock_cursor = mock_get_database_connection.return_value.cursor.return_value
+    mock_cursor.fetchall.return_value = [{"product_id": 3, "product_name": "100% Cotton Tee",
+                                          "product_url": "https://www.asos.com/tee",
+                                          "image_url": "https://images.asos.com/tee"}]
+
+    response = api_client.get("/api/v1/products/search?q=100%25 cot&limit=5")
+
+    assert response.status_code == 200
+    assert response.get_json()["products"][0]["product_id"] == 3
+    assert mock_cursor.execute.call_args.args[1] == (
+        "%100\\% cot%", "100% cot", "100\\% cot%", "100% cot", 5)
+
+
+@patch("app.get_database_connection")
+def test_api_search_products_short_term(mock_get_database_connection, api_client):
+    """
+    Tests that a term too short to search matches nothing without querying the database.
+    """
+    response = api_client.get("/api/v1/products/search?q=a")
+
+    assert response.get_json() == {"products": []}
+    mock_get_database_connection.assert_not_called()
@@ -0,0 +1,82 @@
+"""
+Unit tests for the file cache.py.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+from unittest.mock import patch
+
+from cache import SingleFlight, TTLCache
+
+
+@patch("cache.monotonic")
+def test_entries_expire(mock_monotonic):
+    """
+    Tests that an entry is returned until its time to live has passed.
+    """
+    mock_monotonic.return_value = 100
+    cache = TTLCache(10, 60)
+    cache.set("key", "value")
+
+    mock_monotonic.return_value = 159
+    assert cache.get("key") == "value"
+
+    mock_monotonic.return_value = 160
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_dropped():
+    """
+    Tests that the least recently used entry is dropped once the cache is full.
+    """
+    cache = TTLCache(2, 60)
+    cache.set("first", 1)
+    cache.set("second", 2)
+    cache.get("first")
+    cache.set("third", 3)
+
+    assert cache.get("first") == 1
+    assert cache.get("second") is None
+    assert cache.get("third") == 3
+
+
+def test_invalidate():
+    """
+    Tests that an invalidated entry is no longer returned.
+    """
+    cache = TTLCache(2, 60)
+    cache.set("key", "value")
+    cache.invalidate("key")
+    cache.invalidate("missing")
+
+    assert cache.get("key", "default") == "default"
+
+
+def test_single_flight_shares_one_call():
+    """
+    Tests that callers arriving during an in-flight call share its result.
+    """
+    flights = SingleFlight()
+    started, release = Event(), Event()
+    calls = []
+
+    def slow_scrape(url):
+        calls.append(url)
+        started.set()
+        release.wait(5)
+        return {"product_url": url}
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        leader = executor.submit(flights.do, "url", slow_scrape, "url")
+        started.wait(5)
+        followers = [executor.submit(flights.do, "url", slow_scrape, "url")
+                     for _ in range(2)]
+        # Gives the followers time to join the in-flight call.
+        sleep(0.2)
+        release.set()
+
+        results = [leader.result()] + [follower.result() for follower in followers]
+
+    assert calls == ["url"]
+    assert all(result is results[0] for result in results)
+    assert not flights.calls
@@ -4,7 +4,7 @@ Tests the extraction file.
 import unittest
 from unittest.mock import patch, MagicMock
 
-from extract import get_domain_name, scrape_asos_page
+from extract import get_domain_name, scrape_asos_page, get_stock_bitmap, get_size_mask, canonicalise_url, scrape_product, scrape_cache, get_stock_prices
 
 EXAMPLE_HTML_TEXT = '''
 <html><head><script>{"product_name":"Black Coat"}</script></head></html>'''
@@ -89,3 +89,100 @@ class TestScrapeAsosPage(unittest.TestCase):
             EXAMPLE_ASOS_URL, {'HeaderKey': 'HeaderValue'})
 
         self.assertIsInstance(result, dict)
+
+
+class TestVariantStock(unittest.TestCase):
+    """
+    Test class for the per-size stock functions.
+    """
+
+    def test_get_stock_bitmap(self):
+        """
+        Tests that each in stock variant sets its own bit.
+        """
+        variants = [{"variantId": 1, "isInStock": True},
+                    {"variantId": 2, "isInStock": False},
+                    {"variantId": 3, "isInStock": True}]
+
+        variant_ids, bitmap = get_stock_bitmap(variants)
+
+        self.assertEqual(variant_ids, [1, 2, 3])
+        self.assertEqual(bitmap, 0b101)
+
+    def test_get_size_mask(self):
+        """
+        Tests that wanted sizes are matched case insensitively.
+        """
+        result = get_size_mask(["UK 6", "UK 8", "UK 10"], [" uk 8", "UK 10 "])
+
+        self.assertEqual(result, "011")
+
+    def test_get_size_mask_no_match(self):
+        """
+        Tests that a subscription covers every size when no size matches.
+        """
+        result = get_size_mask(["UK 6", "UK 8"], [""])
+
+        self.assertIsNone(result)
+
+
+class TestScrapeProduct(unittest.TestCase):
+    """
+    Test class for the cached scrape_product() function.
+    """
+
+    def setUp(self):
+        scrape_cache.clear()
+
+    def test_canonicalise_url(self):
+        """
+        Tests that links to the same product share one canonical url.
+        """
+        self.assertEqual(canonicalise_url(" HTTPS://WWW.ASOS.com/prd/123/?clr=black#reviews "),
+                         "https://www.asos.com/prd/123")
+
+    @patch('extract.scrape_asos_page')
+    def test_scrape_product_cached(self, mock_scrape_asos_page):
+        """
+        Tests that a product is only scraped once while its result is cached.
+        """
+        mock_scrape_asos_page.return_value = {"product_name": "Black Coat"}
+
+        first = scrape_product(EXAMPLE_ASOS_URL, {})
+        second = scrape_product(EXAMPLE_ASOS_URL, {})
+
+        self.assertEqual(first, second)
+        mock_scrape_asos_page.assert_called_once_with(EXAMPLE_ASOS_URL, {})
+
+    @patch('extract.scrape_asos_page')
+    def test_scrape_product_failure_not_cached(self, mock_scrape_asos_page):
+        """
+        Tests that a failed scrape is tried again on the next submission.
+        """
+        mock_scrape_asos_page.return_value = AttributeError("no product data")
+
+        scrape_product(EXAMPLE_ASOS_URL, {})
+        scrape_product(EXAMPLE_ASOS_URL, {})
+
+        self.assertEqual(mock_scrape_asos_page.call_count, 2)
+
+
+class TestGetStockPrices(unittest.TestCase):
+    """
+    Test class for the batched get_stock_prices() function.
+    """
+
+    @patch('extract.STOCKPRICE_BATCH_SIZE', 2)
+    @patch('extract.requests.get')
+    def test_get_stock_prices_batched(self, mock_requests_get):
+        """
+        Tests that ids are requested in batches and results are keyed by id.
+        """
+        mock_requests_get.return_value.json.side_effect = [
+            [{"productId": 1}, {"productId": 2}], [{"productId": 3}]]
+
+        stock_prices = get_stock_prices([1, 2, 3])
+
+        self.assertEqual(set(stock_prices), {"1", "2", "3"})
+        self.assertEqual(mock_requests_get.call_count, 2)
+        self.assertIn("productIds=1,2&", mock_requests_get.call_args_list[0][0][0])
@@ -0,0 +1,34 @@
+"""
+Unit tests for the file fake_asos.py.
+"""
+from unittest.mock import patch
+
+import requests
+
+from extract import scrape_asos_page
+from fake_asos import FakeAsosServer
+
+
+def test_recorded_pages_scrape_like_asos():
+    """
+    Tests that the scraper reads a product, its price and its sizes from the fake server.
+    """
+    with FakeAsosServer() as asos:
+        with patch("extract.STARTER_ASOS_API", asos.stockprice_api):
+            product = scrape_asos_page(asos.product_url(7), {"user-agent": "test"})
+
+    assert product["product_name"] == "Load Test Product 7"
+    assert product["asos_product_id"] == 7
+    assert product["price"] == 17.99
+    assert product["variant_sizes"] == ["UK 6", "UK 8", "UK 10", "UK 12"]
+    assert product["stock_bitmap"] == "1101"
+
+
+def test_unknown_path_not_found():
+    """
+    Tests that paths other than product pages and stockprice return a 404.
+    """
+    with FakeAsosServer() as asos:
+        response = requests.get(f"{asos.url}/search?q=coat", timeout=5)
+
+    assert response.status_code == 404
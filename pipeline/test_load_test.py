@@ -0,0 +1,55 @@
+"""
+Unit tests for the file load_test.py.
+"""
+import pytest
+
+from load_test import StubSESClient, check_database_is_local, get_load_test_email, summarise_latencies
+
+
+def test_summarise_latencies():
+    """
+    Tests that throughput and percentiles are worked out from the latencies in seconds.
+    """
+    latencies = [(millisecond + 1) / 1000 for millisecond in range(100)]
+
+    summary = summarise_latencies(latencies, 2)
+
+    assert summary["throughput"] == 50
+    assert summary["p50"] == pytest.approx(50.5)
+    assert summary["p95"] == pytest.approx(95.05)
+    assert summary["p99"] == pytest.approx(99.01)
+
+
+def test_summarise_single_latency():
+    """
+    Tests that a single request is every percentile.
+    """
+    assert summarise_latencies([0.25], 1)["p99"] == 250
+
+
+def test_stub_ses_counts_calls():
+    """
+    Tests that the SES stub records each verification email.
+    """
+    ses_client = StubSESClient(0)
+
+    ses_client.verify_email_address(EmailAddress=get_load_test_email(3))
+
+    assert ses_client.calls == 1
+    assert get_load_test_email(3) == "load-test-3@example.com"
+
+
+@pytest.mark.parametrize("host", ["localhost", "127.0.0.1", "/tmp/pgdata"])
+def test_local_database_allowed(host):
+    """
+    Tests that the load test runs against a database on this machine.
+    """
+    check_database_is_local(host)
+
+
+def test_remote_database_refused():
+    """
+    Tests that the load test refuses to run against a remote database.
+    """
+    with pytest.raises(ValueError):
+        check_database_is_local("c9-sale-tracker.abc123.eu-west-2.rds.amazonaws.com")
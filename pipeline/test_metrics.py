@@ -0,0 +1,75 @@
+"""
+Unit tests for the file metrics.py.
+"""
+from metrics import (Counter, Histogram, get_timed_cursor_class, request_breakdown,
+                     statement_label, time_outbound)
+
+
+def test_histogram_renders_cumulative_buckets():
+    """
+    Tests that each bucket counts every observation at or below its bound.
+    """
+    histogram = Histogram("test_seconds", "A test histogram.", ("route",), buckets=(0.1, 1))
+    histogram.observe(("/",), 0.05)
+    histogram.observe(("/",), 0.5)
+    histogram.observe(("/",), 5)
+
+    lines = histogram.render()
+
+    assert 'test_seconds_bucket{route="/",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/",le="1"} 2' in lines
+    assert 'test_seconds_bucket{route="/",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/"} 3' in lines
+
+
+def test_label_values_escaped():
+    """
+    Tests that quotes and backslashes in label values are escaped.
+    """
+    counter = Counter("test_total", "A test counter.", ("statement",))
+    counter.increment(('say "hi" \\',), 2)
+
+    assert 'test_total{statement="say \\"hi\\" \\\\"} 2' in counter.render()
+
+
+def test_statement_label():
+    """
+    Tests that statements are labelled by prepared name, or by verb and table.
+    """
+    assert statement_label("EXECUTE upsert_user (%s, %s)") == "upsert_user"
+    assert statement_label("PREPARE upsert_user AS INSERT INTO users") == "prepare upsert_user"
+    assert statement_label("\n  SELECT p.product_id FROM products AS p") == "select products"
+    assert statement_label(b"INSERT INTO prices (price) VALUES (1)") == "insert prices"
+    assert statement_label("UPDATE submission_jobs SET status = 'done'") == "update submission_jobs"
+
+
+def test_timed_cursor_adds_to_breakdown():
+    """
+    Tests that timed statements and outbound calls are added to the request's breakdown.
+    """
+    class FakeCursor:
+        """
+        Stands in for a database cursor.
+        """
+        rowcount = 3
+
+        def execute(self, query, params=None):
+            """
+            Pretends to run the query.
+            """
+            return query, params
+
+    token = request_breakdown.set({})
+
+    try:
+        get_timed_cursor_class(FakeCursor)().execute("SELECT 1 FROM products")
+        get_timed_cursor_class(FakeCursor)().execute("SELECT 2 FROM products")
+        with time_outbound("asos", "product_page"):
+            pass
+
+        breakdown = request_breakdown.get()
+    finally:
+        request_breakdown.reset(token)
+
+    assert breakdown["db"][1] == 2
+    assert breakdown["asos"][1] == 1
@@ -0,0 +1,105 @@
+"""
+Benchmarks the per-call latency of the updater's per-product queries when they are
+sent as plain SQL against when they are executed as prepared statements.
+Run against a local Postgres loaded with schema.sql, e.g.
+`python3 benchmark_query_catalog.py --calls 5000`.
+The rows it inserts are rolled back when it finishes.
+"""
+
+import argparse
+from statistics import median
+from time import perf_counter
+
+from dotenv import load_dotenv
+from psycopg2 import extras
+from psycopg2.extensions import connection
+
+from update_price_and_send_alerts import get_database_connection, QUERIES
+
+SEED_PRODUCTS_QUERY = """
+            INSERT INTO products (product_name, product_url, website_name, product_availability)
+            SELECT 'Benchmark product ' || n, 'https://www.asos.com/benchmark/' || n, 'www.asos.com', TRUE
+            FROM generate_series(1, %s) AS n
+            RETURNING product_id;
+            """
+
+SEED_PRICES_QUERY = """
+            INSERT INTO prices (updated_at, product_id, price)
+            SELECT CURRENT_TIMESTAMP - make_interval(hours => n), %s, 10 + n
+            FROM generate_series(1, %s) AS n;
+            """
+
+BENCHMARKED_QUERIES = ["latest_price", "subscriber_emails"]
+
+
+def seed_products(conn: connection, products: int, prices_per_product: int) -> list:
+    """
+    Inserts products with a price history and returns their ids.
+    """
+    with conn.cursor() as cur:
+        cur.execute(SEED_PRODUCTS_QUERY, (products,))
+        product_ids = [row[0] for row in cur.fetchall()]
+        for product_id in product_ids:
+            cur.execute(SEED_PRICES_QUERY, (product_id, prices_per_product))
+
+    return product_ids
+
+
+def time_calls(conn: connection, name: str, product_ids: list,
+               calls: int, prepared: bool) -> list:
+    """
+    Returns the latency in microseconds of each call of the named query.
+    """
+    timings = []
+
+    with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        for call in range(calls):
+            params = (product_ids[call % len(product_ids)],)
+            start = perf_counter()
+            if prepared:
+                QUERIES.execute(cur, name, params)
+            else:
+                cur.execute(QUERIES.queries[name], params)
+            cur.fetchall()
+            timings.append((perf_counter() - start) * 1_000_000)
+
+    return timings
+
+
+def run_benchmark(calls: int, products: int, prices_per_product: int) -> None:
+    """
+    Prints the median and mean per-call latency of each query, plain and prepared.
+    """
+    conn = get_database_connection()
+
+    try:
+        product_ids = seed_products(conn, products, prices_per_product)
+
+        print(f"{'query':<22}{'plain median':>14}{'prepared median':>17}"
+              f"{'plain mean':>12}{'prepared mean':>15}")
+        for name in BENCHMARKED_QUERIES:
+            # Warm up the connection and the catalog before timing.
+            time_calls(conn, name, product_ids, 50, True)
+            time_calls(conn, name, product_ids, 50, False)
+
+            plain = time_calls(conn, name, product_ids, calls, False)
+            prepared = time_calls(conn, name, product_ids, calls, True)
+
+            print(f"{name:<22}{median(plain):>12.1f}us{median(prepared):>15.1f}us"
+                  f"{sum(plain) / calls:>10.1f}us{sum(prepared) / calls:>13.1f}us")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--prices-per-product", type=int, default=50)
+    args = parser.parse_args()
+
+    run_benchmark(args.calls, args.products, args.prices_per_product)
@@ -0,0 +1,173 @@
+"""
+Local snapshot of what the updater knows about each product, kept in a SQLite file
+between runs. At startup only the products changed in RDS since the
+snapshot's watermark are read, so the time before scraping starts does not grow
+with the size of the catalogue.
+"""
+
+import json
+import sqlite3
+from datetime import datetime
+from typing import Iterable, Iterator, NamedTuple
+
+
+EPOCH = datetime(1970, 1, 1)
+
+CREATE_SNAPSHOT_TABLES = """
+            CREATE TABLE IF NOT EXISTS products (
+                product_id INTEGER PRIMARY KEY,
+                product_name TEXT,
+                product_url TEXT NOT NULL,
+                image_url TEXT,
+                product_availability INTEGER,
+                variant_ids TEXT NOT NULL,
+                variant_sizes TEXT NOT NULL,
+                stock_bitmap TEXT NOT NULL,
+                asos_product_id INTEGER,
+                last_price_id INTEGER,
+                last_price REAL,
+                last_modified TEXT,
+                last_checked TEXT
+            );
+            CREATE TABLE IF NOT EXISTS snapshot_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+
+UPSERT_PRODUCT_QUERY = """
+            INSERT INTO products (product_id, product_name, product_url, image_url,
+            product_availability, variant_ids, variant_sizes, stock_bitmap,
+            asos_product_id, last_price_id, last_price, last_modified, last_checked)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (product_id) DO UPDATE SET
+            product_name = excluded.product_name, product_url = excluded.product_url,
+            image_url = excluded.image_url, product_availability = excluded.product_availability,
+            variant_ids = excluded.variant_ids, variant_sizes = excluded.variant_sizes,
+            stock_bitmap = excluded.stock_bitmap, asos_product_id = excluded.asos_product_id,
+            last_price_id = excluded.last_price_id, last_price = excluded.last_price,
+            last_modified = excluded.last_modified,
+            last_checked = COALESCE(excluded.last_checked, products.last_checked);
+            """
+
+SELECT_PRODUCTS_AFTER_QUERY = """
+            SELECT product_id, product_name, product_url, image_url,
+            product_availability, variant_ids, variant_sizes, stock_bitmap,
+            asos_product_id, last_price_id, last_price, last_modified, last_checked
+            FROM products WHERE product_id > ? ORDER BY product_id LIMIT ?;
+            """
+
+SELECT_WATERMARK_QUERY = "SELECT value FROM snapshot_state WHERE key = 'watermark';"
+
+UPSERT_WATERMARK_QUERY = """
+            INSERT INTO snapshot_state (key, value) VALUES ('watermark', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+            """
+
+
+class Product(NamedTuple):
+    """
+    A product being tracked, with the last price and availability the updater saw.
+    Tuples keep no per-instance dict, so each record costs only its fields.
+    """
+    product_id: int
+    product_name: str
+    product_url: str
+    image_url: str
+    product_availability: bool
+    variant_ids: list
+    variant_sizes: list
+    stock_bitmap: str
+    asos_product_id: int | None = None
+    last_price_id: int | None = None
+    last_price: float | None = None
+    last_modified: datetime | None = None
+    last_checked: datetime | None = None
+
+
+def to_row(product: Product) -> tuple:
+    """
+    Returns a product as a row of the snapshot's products table.
+    """
+    return (product.product_id, product.product_name, product.product_url,
+            product.image_url, product.product_availability,
+            json.dumps(list(product.variant_ids or [])),
+            json.dumps(list(product.variant_sizes or [])),
+            product.stock_bitmap or "", product.asos_product_id,
+            product.last_price_id,
+            float(product.last_price) if product.last_price is not None else None,
+            product.last_modified.isoformat() if product.last_modified else None,
+            product.last_checked.isoformat() if product.last_checked else None)
+
+
+def from_row(row: tuple) -> Product:
+    """
+    Returns a row of the snapshot's products table as a product.
+    """
+    (product_id, product_name, product_url, image_url, availability, variant_ids,
+     variant_sizes, stock_bitmap, asos_product_id, last_price_id, last_price,
+     last_modified, last_checked) = row
+
+    return Product(product_id, product_name, product_url, image_url,
+                   None if availability is None else bool(availability),
+                   json.loads(variant_ids), json.loads(variant_sizes), stock_bitmap,
+                   asos_product_id, last_price_id, last_price,
+                   datetime.fromisoformat(last_modified) if last_modified else None,
+                   datetime.fromisoformat(last_checked) if last_checked else None)
+
+
+class ProductSnapshot:
+    """
+    A SQLite file holding one row per product, and the watermark of the latest
+    change in the database that the snapshot has seen.
+    """
+
+    def __init__(self, path: str):
+        # The file lives on EFS, where WAL's shared memory and memory-mapped reads
+        # are not safe, so the default rollback journal is kept and mmap is left off.
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(CREATE_SNAPSHOT_TABLES)
+
+    @property
+    def watermark(self) -> datetime:
+        """
+        The last modified time of the most recent database change in the snapshot.
+        """
+        row = self.conn.execute(SELECT_WATERMARK_QUERY).fetchone()
+        return datetime.fromisoformat(row[0]) if row else EPOCH
+
+    def save(self, products: Iterable[Product]) -> None:
+        """
+        Inserts or replaces products in the snapshot.
+        Products read from the database also move the watermark forward.
+        """
+        products = list(products)
+        with self.conn:
+            self.conn.executemany(UPSERT_PRODUCT_QUERY,
+                                  [to_row(product) for product in products])
+
+            latest_change = max((product.last_modified for product in products
+                                 if product.last_modified), default=None)
+            if latest_change and latest_change > self.watermark:
+                self.conn.execute(UPSERT_WATERMARK_QUERY,
+                                  (latest_change.isoformat(),))
+
+    def iter_product_chunks(self, chunk_size: int) -> Iterator[list[Product]]:
+        """
+        Yields every product in the snapshot in chunks, ordered by product id.
+        No cursor is held open between chunks, so products can be saved while iterating.
+        """
+        last_product_id = 0
+        while True:
+            rows = self.conn.execute(SELECT_PRODUCTS_AFTER_QUERY,
+                                     (last_product_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield [from_row(row) for row in rows]
+            last_product_id = rows[-1][0]
+
+    def close(self) -> None:
+        """
+        Closes the snapshot file.
+        """
+        self.conn.close()
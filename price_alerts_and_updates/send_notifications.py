@@ -0,0 +1,179 @@
+"""
+Script which drains the notifications outbox written by update_price_and_send_alerts.py
+and delivers the emails through SES in batches.
+Runs separately from the price updates so delivery throughput can be tuned on its own.
+"""
+
+import logging
+from os import environ
+
+import boto3
+from psycopg2 import connect, extras
+from psycopg2.extensions import connection
+from dotenv import load_dotenv
+
+
+logging.basicConfig(filename='price_alert_logs.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_LEASE_SECONDS = 300
+
+CLAIM_NOTIFICATIONS_QUERY = """
+            UPDATE notifications
+            SET status = 'sending', attempts = attempts + 1, claimed_at = CURRENT_TIMESTAMP
+            WHERE notification_id IN (
+                SELECT notification_id FROM notifications
+                WHERE status = 'pending'
+                OR (status = 'sending'
+                    AND claimed_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                ORDER BY notification_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING notification_id, idempotency_key, recipient, subject, body, attempts;
+            """
+
+MARK_SENT_QUERY = """
+            UPDATE notifications
+            SET status = 'sent', message_id = %s, sent_at = CURRENT_TIMESTAMP
+            WHERE notification_id = %s;
+            """
+
+MARK_FAILED_QUERY = """
+            UPDATE notifications
+            SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'sending' END,
+                last_error = %s
+            WHERE notification_id = %s;
+            """
+
+
+def get_database_connection() -> connection:
+    """
+    Return a connection of database.
+    """
+    try:
+        return connect(
+            user=environ["DB_USER"],
+            password=environ["DB_PASSWORD"],
+            host=environ["DB_HOST"],
+            port=environ["DB_PORT"],
+            database=environ["DB_NAME"]
+        )
+    except ConnectionError as error:
+        return error
+
+
+def create_ses_client() -> boto3.client:
+    """
+    Create and return a Boto3 client for AWS SES using AWS credentials.
+    """
+    ses_client = boto3.client(
+        'ses',
+        aws_access_key_id=environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=environ["AWS_SECRET_ACCESS_KEY"],
+        region_name="eu-west-2"
+    )
+    return ses_client
+
+
+def claim_notifications(rds_conn: connection, batch_size: int,
+                        lease_seconds: int) -> list[dict]:
+    """
+    Marks a batch of pending notifications as being sent and returns them.
+    Notifications left in 'sending' by a crashed sender are reclaimed once
+    their lease has expired, and SKIP LOCKED lets several senders run at once.
+    """
+    with rds_conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        cur.execute(CLAIM_NOTIFICATIONS_QUERY, (lease_seconds, batch_size))
+        notifications = cur.fetchall()
+
+    rds_conn.commit()
+
+    return notifications
+
+
+def send_notification(ses_client: boto3.client, notification: dict, sender: str) -> str:
+    """
+    Sends a single notification email and returns the SES message id.
+    """
+    response = ses_client.send_email(
+        Source=sender,
+        Destination={'ToAddresses': [notification['recipient']]},
+        Message={
+            'Subject': {'Data': notification['subject']},
+            'Body': {'Html': {'Data': notification['body']}}
+        }
+    )
+    return response['MessageId']
+
+
+def deliver_batch(rds_conn: connection, ses_client: boto3.client,
+                  notifications: list[dict], sender: str, max_attempts: int) -> int:
+    """
+    Sends every claimed notification and records its delivery status.
+    Each status is committed straight after its email is sent, so a crash
+    can only ever repeat the one email that was in flight.
+    Failed emails keep their lease and are retried once it expires.
+    Returns the number of emails sent.
+    """
+    sent = 0
+
+    for notification in notifications:
+        with rds_conn.cursor() as cur:
+            try:
+                message_id = send_notification(
+                    ses_client, notification, sender)
+            except Exception as error:  # pylint: disable=broad-except
+                cur.execute(MARK_FAILED_QUERY,
+                            (max_attempts, str(error), notification['notification_id']))
+                logging.warning(
+                    f"Notification {notification['idempotency_key']} failed "
+                    f"on attempt {notification['attempts']}: {error}")
+            else:
+                cur.execute(MARK_SENT_QUERY,
+                            (message_id, notification['notification_id']))
+                logging.info(
+                    f"Notification {notification['idempotency_key']} sent. "
+                    f"Message ID: {message_id}")
+                sent += 1
+
+        rds_conn.commit()
+
+    return sent
+
+
+def drain_outbox(rds_conn: connection, ses_client: boto3.client, sender: str,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 lease_seconds: int = DEFAULT_LEASE_SECONDS) -> int:
+    """
+    Delivers batches of notifications until the outbox has nothing left to claim.
+    Returns the total number of emails sent.
+    """
+    total_sent = 0
+
+    while True:
+        notifications = claim_notifications(
+            rds_conn, batch_size, lease_seconds)
+        if not notifications:
+            return total_sent
+
+        total_sent += deliver_batch(rds_conn, ses_client,
+                                    notifications, sender, max_attempts)
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    conn = get_database_connection()
+    email_client = create_ses_client()
+
+    drain_outbox(conn, email_client, environ['SENDER_EMAIL_ADDRESS'],
+                 int(environ.get('NOTIFICATION_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+                 int(environ.get('NOTIFICATION_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)),
+                 int(environ.get('NOTIFICATION_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)))
+
+    conn.close()
@@ -0,0 +1,75 @@
+"""
+Tests the local product snapshot.
+"""
+from datetime import datetime
+
+from product_snapshot import EPOCH, Product, ProductSnapshot
+
+
+def make_product(product_id: int, **fields) -> Product:
+    """
+    Returns a product record with placeholder details.
+    """
+    return Product(product_id, f"Product{product_id}", f"https://example.com/{product_id}",
+                   f"https://example.com/{product_id}.jpg", True, [11, 12],
+                   ["UK 8", "UK 10"], "10")._replace(**fields)
+
+
+def test_empty_snapshot_starts_at_epoch(tmp_path):
+    """
+    Testing that a new snapshot has no products and reads everything from the database.
+    """
+    snapshot = ProductSnapshot(str(tmp_path / "snapshot.sqlite3"))
+
+    assert snapshot.watermark == EPOCH
+    assert not list(snapshot.iter_product_chunks(10))
+
+
+def test_save_round_trips_and_advances_watermark(tmp_path):
+    """
+    Testing that saved products are read back unchanged, and the watermark is
+    the latest database change seen.
+    """
+    path = str(tmp_path / "snapshot.sqlite3")
+    products = [make_product(1, last_modified=datetime(2024, 1, 2), last_price_id=5,
+                             last_price=10.0, asos_product_id=123),
+                make_product(2, last_modified=datetime(2024, 1, 1))]
+
+    snapshot = ProductSnapshot(path)
+    snapshot.save(products)
+    snapshot.close()
+
+    snapshot = ProductSnapshot(path)
+    assert snapshot.watermark == datetime(2024, 1, 2)
+    assert list(snapshot.iter_product_chunks(10)) == [products]
+
+
+def test_save_keeps_last_checked_and_watermark(tmp_path):
+    """
+    Testing that a product re-read from the database keeps the time it was last
+    checked, and that scraped products do not move the watermark back.
+    """
+    snapshot = ProductSnapshot(str(tmp_path / "snapshot.sqlite3"))
+    snapshot.save([make_product(1, last_modified=datetime(2024, 1, 2),
+                                last_checked=datetime(2024, 1, 3))])
+    snapshot.save([make_product(1, product_name="Renamed",
+                                last_modified=datetime(2024, 1, 1))])
+
+    [[product]] = list(snapshot.iter_product_chunks(10))
+
+    assert product.product_name == "Renamed"
+    assert product.last_checked == datetime(2024, 1, 3)
+    assert snapshot.watermark == datetime(2024, 1, 2)
+
+
+def test_iter_product_chunks_pages_by_product_id(tmp_path):
+    """
+    Testing that every product is yielded once, in chunks of the requested size.
+    """
+    snapshot = ProductSnapshot(str(tmp_path / "snapshot.sqlite3"))
+    snapshot.save([make_product(product_id) for product_id in range(1, 6)])
+
+    chunks = list(snapshot.iter_product_chunks(2))
+
+    assert [[product.product_id for product in chunk] for chunk in chunks] == [
+        [1, 2], [3, 4], [5]]
@@ -0,0 +1,62 @@
+"""
+Tests the query catalog.
+"""
+from unittest.mock import MagicMock
+
+from query_catalog import QueryCatalog, to_positional_parameters
+
+
+def test_to_positional_parameters():
+    """
+    Test that psycopg2 placeholders are numbered as Postgres parameters.
+    """
+    query, count = to_positional_parameters(
+        "SELECT * FROM prices WHERE product_id = (%s) AND price < %s;")
+
+    assert query == "SELECT * FROM prices WHERE product_id = ($1) AND price < $2"
+    assert count == 2
+
+
+def test_to_positional_parameters_unescapes_percent():
+    """
+    Test that %% escapes become a literal % rather than a parameter.
+    """
+    query, count = to_positional_parameters(
+        "SELECT product_id FROM products WHERE %s <%% product_name AND product_name LIKE '%%s'")
+
+    assert query == "SELECT product_id FROM products WHERE $1 <% product_name AND product_name LIKE '%s'"
+    assert count == 1
+
+
+def test_execute_prepares_once_per_connection():
+    """
+    Test that a query is prepared on the first call only and executed by name each time.
+    """
+    catalog = QueryCatalog(
+        {"latest_price": "SELECT price FROM prices WHERE product_id = %s"})
+    mock_cursor = MagicMock()
+    mock_cursor.connection.prepared_statements = set()
+    mock_prepare_execute = mock_cursor.connection.cursor.return_value.__enter__.return_value.execute
+
+    catalog.execute(mock_cursor, "latest_price", (1,))
+    catalog.execute(mock_cursor, "latest_price", (2,))
+
+    mock_prepare_execute.assert_called_once_with(
+        "PREPARE latest_price AS SELECT price FROM prices WHERE product_id = $1")
+    mock_cursor.execute.assert_called_with("EXECUTE latest_price (%s)", (2,))
+    assert mock_cursor.execute.call_count == 2
+
+
+def test_execute_without_prepared_statements():
+    """
+    Test that the plain query is run on connections which cannot remember prepared statements.
+    """
+    catalog = QueryCatalog(
+        {"latest_price": "SELECT price FROM prices WHERE product_id = %s"})
+    mock_cursor = MagicMock()
+    mock_cursor.connection.prepared_statements = None
+
+    catalog.execute(mock_cursor, "latest_price", (1,))
+
+    mock_cursor.execute.assert_called_once_with(
+        "SELECT price FROM prices WHERE product_id = %s", (1,))
@@ -0,0 +1,61 @@
+"""
+Tests the send notifications script.
+"""
+from unittest.mock import patch, MagicMock
+
+from send_notifications import deliver_batch, drain_outbox, MARK_SENT_QUERY, MARK_FAILED_QUERY
+
+
+NOTIFICATIONS = [
+    {"notification_id": 1, "idempotency_key": "price-drop:1:1:user1@example.com",
+     "recipient": "user1@example.com", "subject": "Subject", "body": "Body", "attempts": 1},
+    {"notification_id": 2, "idempotency_key": "price-drop:1:1:user2@example.com",
+     "recipient": "user2@example.com", "subject": "Subject", "body": "Body", "attempts": 1}
+]
+
+
+def test_deliver_batch_marks_sent():
+    """
+    Test that every notification is emailed and marked as sent with its message id.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_ses = MagicMock()
+    mock_ses.send_email.return_value = {"MessageId": "message-1"}
+
+    sent = deliver_batch(mock_conn, mock_ses, NOTIFICATIONS, "test@email.com", 5)
+
+    assert sent == 2
+    assert mock_ses.send_email.call_count == 2
+    mock_cursor.execute.assert_called_with(MARK_SENT_QUERY, ("message-1", 2))
+    assert mock_conn.commit.call_count == 2
+
+
+def test_deliver_batch_records_failure():
+    """
+    Test that a failed email is recorded against the notification instead of being lost.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_ses = MagicMock()
+    mock_ses.send_email.side_effect = Exception("Throttled")
+
+    sent = deliver_batch(mock_conn, mock_ses, NOTIFICATIONS[:1], "test@email.com", 5)
+
+    assert sent == 0
+    mock_cursor.execute.assert_called_once_with(MARK_FAILED_QUERY, (5, "Throttled", 1))
+
+
+@patch("send_notifications.deliver_batch")
+@patch("send_notifications.claim_notifications")
+def test_drain_outbox_stops_when_empty(mock_claim_notifications, mock_deliver_batch):
+    """
+    Test that batches are delivered until there is nothing left to claim.
+    """
+    mock_claim_notifications.side_effect = [NOTIFICATIONS, NOTIFICATIONS, []]
+    mock_deliver_batch.return_value = 2
+
+    total = drain_outbox(MagicMock(), MagicMock(), "test@email.com", batch_size=2)
+
+    assert total == 4
+    assert mock_claim_notifications.call_count == 3
@@ -3,9 +3,12 @@ Tests the update price and send alerts script.
 """
 import pytest
 import unittest
+from datetime import datetime
 from unittest.mock import patch, MagicMock
 
-from update_price_and_send_alerts import get_database_connection, get_all_product_data, get_user_data, get_discount_amount, send_price_update_email
+from product_snapshot import EPOCH
+
+from update_price_and_send_alerts import Product, get_database_connection, iter_product_chunks, get_user_data, get_discount_amount, queue_price_update_emails, update_product_availability, update_variant_stock, try_run_lock, get_stock_bitmap, bits_to_bitmap, bitmap_to_bits
 
 
 @patch.dict("os.environ", {
@@ -42,24 +45,28 @@ def test_get_database_connection_connection_error(mock_rds_conn):
     assert isinstance(result, ConnectionError)
 
 
-@patch("update_price_and_send_alerts.connect")
-def test_get_all_product_data(mock_rds_conn):
+def test_iter_product_chunks():
     """
-    Testing that function is able to retrieve all product information from database.
+    Testing that changed products are streamed from a server-side cursor as product records in chunks.
     """
-    mock_cursor = MagicMock()
-    mock_fetchall = MagicMock(
-        return_value=[{'id': 1, 'name': 'Product1'}, {'id': 2, 'name': 'Product2'}])
-    mock_cursor.fetchall = mock_fetchall
+    changed_at = datetime(2024, 1, 1)
+    row_1 = (1, 'Product1', 'https://example.com/1', 'https://example.com/1.jpg',
+             True, [11], ['UK 8'], '1', 123, 7, 10.0, changed_at)
+    row_2 = (2, 'Product2', 'https://example.com/2', 'https://example.com/2.jpg',
+             False, [], [], '', None, None, None, changed_at)
 
-    mock_rds_conn.cursor.return_value = mock_cursor
+    mock_rds_conn = MagicMock()
+    mock_cursor = mock_rds_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchmany.side_effect = [[row_1, row_2], [row_1], []]
 
-    # Call the function under test
-    result = get_all_product_data(mock_rds_conn)
+    chunks = list(iter_product_chunks(mock_rds_conn, EPOCH, 2))
 
-    expected_result = [{'id': 1, 'name': 'Product1'},
-                       {'id': 2, 'name': 'Product2'}]
-    assert result == expected_result
+    mock_rds_conn.cursor.assert_called_once_with(name="changed_products")
+    assert mock_cursor.execute.call_args[0][1] == (EPOCH,)
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert chunks[0][1] == Product(*row_2)
+    assert chunks[0][0].product_name == 'Product1'
+    assert chunks[0][0].last_price_id == 7
 
 
 @patch("update_price_and_send_alerts.connect")
@@ -100,42 +107,194 @@ def test_get_discount_amount_invalid_input():
                                            'percentage_discount': 'Unknown'}
 
 
-@pytest.fixture
-def mock_ses_client():
-    with patch("update_price_and_send_alerts.boto3.client") as mock_ses:
-        yield mock_ses
-
-
+@patch("update_price_and_send_alerts.extras.execute_values")
 @patch("update_price_and_send_alerts.get_discount_amount")
-def test_send_price_update_email(mock_get_discount_amount, mock_ses_client):
+def test_queue_price_update_emails(mock_get_discount_amount, mock_execute_values):
     """
     Test that the calculate discount function is called once and that an 
-    email is sent to every user subscribed to a given product.
+    email is queued for every user subscribed to a given product.
     """
 
-    test_sender = "test@email.com"
-
     mock_get_discount_amount.return_value = {
         "percentage_discount": 10.0,
         "new_price": 90.0,
         "previous_price": 100.0,
     }
 
-    mock_ses = MagicMock()
-    mock_ses_client.return_value = MagicMock()
+    mock_conn = MagicMock()
 
-    product_data = {
-        "product_name": "Product123",
-        "product_url": "https://example.com/product/123",
-        "image_url": "https://example.com/image/123.jpg",
-    }
+    product_data = Product(123, "Product123", "https://example.com/product/123",
+                           "https://example.com/image/123.jpg", True, [], [], "")
 
     recipients = ["user1@example.com", "user2@example.com"]
-    old_price = 100.0
+    previous_price = {"price_id": 7, "price": 100.0}
     new_price = 90.0
-    send_price_update_email(mock_ses, product_data,
-                            recipients, old_price, new_price, test_sender)
+    queue_price_update_emails(mock_conn, product_data,
+                              recipients, previous_price, new_price)
+
+    mock_get_discount_amount.assert_called_once_with(100.0, new_price)
+
+    rows = mock_execute_values.call_args[0][2]
+    assert len(rows) == 2
+    assert rows[0][0] == "price-drop:123:7:user1@example.com"
+
+
+@patch("update_price_and_send_alerts.extras.execute_values")
+@patch("update_price_and_send_alerts.get_user_data")
+def test_update_product_availability_already_recorded(mock_get_user_data, mock_execute_values):
+    """
+    Test that no emails are queued when another run has already
+    recorded the change in availability.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.rowcount = 0
 
-    mock_get_discount_amount.assert_called_once_with(old_price, new_price)
+    product = Product(1, "Product1", "https://example.com", "https://example.com/img",
+                      False, [], [], "")
 
-    assert mock_ses.send_email.call_count == 2
+    update_product_availability(mock_conn, product, True)
+
+    mock_get_user_data.assert_not_called()
+    mock_execute_values.assert_not_called()
+    mock_conn.commit.assert_called_once()
+
+
+@patch("update_price_and_send_alerts.extras.execute_values")
+@patch("update_price_and_send_alerts.get_subscribers")
+def test_update_product_availability_key_is_stable(mock_get_subscribers, mock_execute_values):
+    """
+    Test that the idempotency key comes from the recorded change, so a retried
+    run queues the same keys rather than a second email.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.rowcount = 1
+    mock_cursor.fetchone.return_value = {"last_modified": datetime(2024, 1, 2, 3, 4, 5)}
+    mock_get_subscribers.return_value = [{"email": "user1@example.com", "size_mask": None},
+                                         {"email": "user2@example.com", "size_mask": 0b1}]
+
+    product = Product(1, "Product1", "https://example.com", "https://example.com/img",
+                      False, [], [], "")
+
+    update_product_availability(mock_conn, product, True)
+    update_product_availability(mock_conn, product, True)
+
+    first_rows = mock_execute_values.call_args_list[0][0][2]
+    second_rows = mock_execute_values.call_args_list[1][0][2]
+    assert first_rows == second_rows
+    assert [row[0] for row in first_rows] == [
+        "availability:1:in:2024-01-02T03:04:05:user1@example.com"]
+
+
+def make_stock_connection(rowcount: int) -> MagicMock:
+    """
+    Returns a mock connection whose stock bitmap update affects the given number of rows.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.rowcount = rowcount
+    mock_cursor.fetchone.return_value = {"snapshot_id": 42}
+    return mock_conn
+
+
+@patch("update_price_and_send_alerts.extras.execute_values")
+@patch("update_price_and_send_alerts.get_subscribers")
+def test_update_variant_stock_followed_size_back_in_stock(mock_get_subscribers,
+                                                          mock_execute_values):
+    """
+    Test that a user following a size that comes back into stock is emailed
+    about that size, keyed on the stock snapshot.
+    """
+    mock_conn = make_stock_connection(1)
+    mock_get_subscribers.return_value = [{"email": "user1@example.com", "size_mask": 0b010}]
+
+    product = Product(1, "Product1", "https://example.com", "https://example.com/img",
+                      True, [11, 12, 13], ["S", "M", "L"], "100")
+
+    update_variant_stock(mock_conn, product, [11, 12, 13], ["S", "M", "L"], 0b011)
+
+    rows = mock_execute_values.call_args[0][2]
+    assert len(rows) == 1
+    assert rows[0][0] == "sizes:1:42:user1@example.com"
+    assert "back in stock in M" in rows[0][4]
+    mock_conn.commit.assert_called_once()
+
+
+@patch("update_price_and_send_alerts.extras.execute_values")
+@patch("update_price_and_send_alerts.get_subscribers")
+def test_update_variant_stock_unfollowed_size_sends_no_email(mock_get_subscribers,
+                                                             mock_execute_values):
+    """
+    Test that a change to sizes nobody follows records a snapshot but queues no emails.
+    """
+    mock_conn = make_stock_connection(1)
+    mock_get_subscribers.return_value = [{"email": "user1@example.com", "size_mask": 0b001},
+                                         {"email": "user2@example.com", "size_mask": None}]
+
+    product = Product(1, "Product1", "https://example.com", "https://example.com/img",
+                      True, [11, 12, 13], ["S", "M", "L"], "100")
+
+    update_variant_stock(mock_conn, product, [11, 12, 13], ["S", "M", "L"], 0b011)
+
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.assert_called_once()
+    mock_execute_values.assert_not_called()
+    mock_conn.commit.assert_called_once()
+
+
+@patch("update_price_and_send_alerts.extras.execute_values")
+@patch("update_price_and_send_alerts.get_subscribers")
+def test_update_variant_stock_already_recorded(mock_get_subscribers, mock_execute_values):
+    """
+    Test that nothing is snapshotted or queued when another run has already
+    recorded the change in stock.
+    """
+    mock_conn = make_stock_connection(0)
+
+    product = Product(1, "Product1", "https://example.com", "https://example.com/img",
+                      True, [11, 12, 13], ["S", "M", "L"], "100")
+
+    update_variant_stock(mock_conn, product, [11, 12, 13], ["S", "M", "L"], 0b011)
+
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.assert_not_called()
+    mock_get_subscribers.assert_not_called()
+    mock_execute_values.assert_not_called()
+    mock_conn.commit.assert_called_once()
+
+
+@pytest.mark.parametrize("locked", [True, False])
+def test_try_run_lock(locked):
+    """
+    Test that the run lock reports whether this run took the advisory lock.
+    """
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.return_value = {"locked": locked}
+
+    assert try_run_lock(mock_conn) is locked
+    mock_conn.commit.assert_called_once()
+
+
+def test_get_stock_bitmap_keeps_known_positions():
+    """
+    Test that known variants keep their bit and new variants are appended.
+    """
+    variants = [{"variantId": 13, "isInStock": True},
+                {"variantId": 11, "isInStock": False},
+                {"variantId": 14, "isInStock": True}]
+
+    variant_ids, bitmap = get_stock_bitmap(variants, [11, 12, 13])
+
+    assert variant_ids == [11, 12, 13, 14]
+    assert bitmap == 0b1100
+
+
+def test_bitmap_round_trip():
+    """
+    Test that bitmaps survive conversion to and from Postgres bit strings.
+    """
+    assert bitmap_to_bits(0b1101, 6) == "101100"
+    assert bits_to_bitmap("101100") == 0b1101
+    assert bits_to_bitmap(None) == 0
@@ -1,56 +1,111 @@
 """
 Script which scrapes webpages and inserts updated price data into prices table in RDS.
 Users are updated if their product has gone down in price, or if its stock status
-has changed. 
+has changed. Emails are not sent from here; they are written to the notifications
+outbox in the same transaction as the change and delivered by send_notifications.py.
 Triggered every three minutes.
 """
 
 import logging
 import json
 from os import environ
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Iterator
 
 import concurrent.futures
 import requests
-import boto3
-from psycopg2 import connect, extras
-from psycopg2.extensions import connection
+from psycopg2 import connect, extras, pool
+from psycopg2.extensions import connection, cursor
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+from product_snapshot import Product, ProductSnapshot
+from query_catalog import PreparingConnection, QueryCatalog
+
 
 logging.basicConfig(filename='price_alert_logs.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 STARTER_ASOS_API = "https://www.asos.com/api/product/catalogue/v3/stockprice?"
+MAX_WORKERS = 16
+PRODUCT_CHUNK_SIZE = 500
+# Changes committed late can carry a slightly older timestamp than the watermark.
+RECONCILE_OVERLAP = timedelta(minutes=10)
+RUN_LOCK_KEY = 7243
 
 UPDATE_AVAILABILITY_QUERY = """
             UPDATE products 
             SET product_availability = %s
-            WHERE product_id = %s
+            WHERE product_id = %s AND product_availability IS DISTINCT FROM %s
+            RETURNING last_modified
             """
 
-CHECK_AVAILABILITY_QUERY = """
-            SELECT product_availability FROM products WHERE product_id = %s
+SET_ASOS_PRODUCT_ID_QUERY = """
+            UPDATE products SET asos_product_id = %s WHERE product_id = %s
             """
 
 EMAIL_QUERY = """
-            SELECT users.email FROM users 
+            SELECT users.email, subscriptions.size_mask FROM users 
             FULL OUTER JOIN subscriptions ON users.user_id = subscriptions.user_id 
             WHERE subscriptions.product_id = %s
             """
 
+UPDATE_STOCK_BITMAP_QUERY = """
+            UPDATE products
+            SET variant_ids = %s, variant_sizes = %s, stock_bitmap = %s::varbit
+            WHERE product_id = %s AND stock_bitmap IS DISTINCT FROM %s::varbit
+            """
+
+INSERT_STOCK_SNAPSHOT_QUERY = """
+            INSERT INTO stock_snapshots (product_id, stock_bitmap)
+            VALUES (%s, %s::varbit)
+            RETURNING snapshot_id;
+            """
+
+# Held for the whole run, so only one updater uses the snapshot at a time.
+# The lock is released when the connection that took it is closed.
+TRY_RUN_LOCK_QUERY = "SELECT pg_try_advisory_lock(%s) AS locked;"
+
 INSERT_PRICE_QUERY = """
-            INSERT INTO prices (updated_at, product_id, price) VALUES (%s, %s, %s);
+            INSERT INTO prices (updated_at, product_id, price) VALUES (%s, %s, %s)
+            RETURNING price_id;
+            """
+
+INSERT_NOTIFICATIONS_QUERY = """
+            INSERT INTO notifications (idempotency_key, product_id, recipient, subject, body)
+            VALUES %s
+            ON CONFLICT (idempotency_key) DO NOTHING;
             """
 
-GET_ALL_PRODUCTS_QUERY = "SELECT * FROM products;"
+GET_CHANGED_PRODUCTS_QUERY = """
+            SELECT products.product_id, product_name, product_url, image_url,
+            product_availability, variant_ids, variant_sizes, stock_bitmap,
+            asos_product_id, latest_price.price_id, latest_price.price, last_modified
+            FROM products
+            LEFT JOIN LATERAL (
+                SELECT price_id, price FROM prices
+                WHERE prices.product_id = products.product_id
+                ORDER BY updated_at DESC LIMIT 1
+            ) AS latest_price ON TRUE
+            WHERE last_modified > %s;
+            """
 
 GET_LATEST_PRICE_QUERY = """
-            SELECT price FROM prices WHERE product_id = (%s) 
+            SELECT price_id, price FROM prices WHERE product_id = (%s) 
             ORDER BY updated_at DESC LIMIT 1;
             """
 
+QUERIES = QueryCatalog({
+    "update_availability": UPDATE_AVAILABILITY_QUERY,
+    "set_asos_product_id": SET_ASOS_PRODUCT_ID_QUERY,
+    "subscriber_emails": EMAIL_QUERY,
+    "update_stock_bitmap": UPDATE_STOCK_BITMAP_QUERY,
+    "insert_stock_snapshot": INSERT_STOCK_SNAPSHOT_QUERY,
+    "insert_price": INSERT_PRICE_QUERY,
+    "latest_price": GET_LATEST_PRICE_QUERY,
+    "try_run_lock": TRY_RUN_LOCK_QUERY
+})
+
 
 def get_database_connection() -> connection:
     """
@@ -62,36 +117,76 @@ def get_database_connection() -> connection:
             password=environ["DB_PASSWORD"],
             host=environ["DB_HOST"],
             port=environ["DB_PORT"],
-            database=environ["DB_NAME"]
+            database=environ["DB_NAME"],
+            connection_factory=PreparingConnection
         )
     except ConnectionError as error:
         return error
 
 
-def create_ses_client() -> boto3.client:
+def get_connection_pool(max_connections: int) -> pool.ThreadedConnectionPool:
     """
-    Create and return a Boto3 client for AWS SES using AWS credentials.
+    Return a pool of database connections so that every scraping thread
+    runs its changes and notifications in a transaction of its own.
     """
-    ses_client = boto3.client(
-        'ses',
-        aws_access_key_id=environ["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=environ["AWS_SECRET_ACCESS_KEY"],
-        region_name="eu-west-2"
+    return pool.ThreadedConnectionPool(
+        1, max_connections,
+        user=environ["DB_USER"],
+        password=environ["DB_PASSWORD"],
+        host=environ["DB_HOST"],
+        port=environ["DB_PORT"],
+        database=environ["DB_NAME"],
+        connection_factory=PreparingConnection
     )
-    return ses_client
 
 
-def get_all_product_data(rds_conn: connection) -> extras.RealDictRow:
+def try_run_lock(rds_conn: connection) -> bool:
     """
-    Query database for data on all products.
+    Takes the updater's run lock on the connection, returning False if another
+    run still holds it.
     """
-    cur = rds_conn.cursor(cursor_factory=extras.RealDictCursor)
-    cur.execute(GET_ALL_PRODUCTS_QUERY)
-    rows = cur.fetchall()
-    cur.close()
+    with rds_conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+        QUERIES.execute(cur, "try_run_lock", (RUN_LOCK_KEY,))
+        locked = cur.fetchone()['locked']
+    rds_conn.commit()
 
-    new_rows = [dict(row) for row in rows]
-    return new_rows
+    return locked
+
+
+def iter_product_chunks(rds_conn: connection, since: datetime,
+                        chunk_size: int = PRODUCT_CHUNK_SIZE) -> Iterator[list[Product]]:
+    """
+    Streams the products changed since the given time from a server-side cursor
+    in chunks, so that only one chunk is held in memory at a time.
+    The connection should not be used for anything else until the stream is finished.
+    """
+    with rds_conn.cursor(name="changed_products") as cur:
+        cur.itersize = chunk_size
+        cur.execute(GET_CHANGED_PRODUCTS_QUERY, (since,))
+
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield [Product(*row) for row in rows]
+
+
+def reconcile_snapshot(rds_conn: connection, snapshot: ProductSnapshot,
+                       chunk_size: int = PRODUCT_CHUNK_SIZE) -> int:
+    """
+    Saves the products changed in the database since the snapshot's watermark
+    to the snapshot, and returns how many there were.
+    """
+    reconciled = 0
+
+    for products in iter_product_chunks(rds_conn, snapshot.watermark - RECONCILE_OVERLAP,
+                                        chunk_size):
+        snapshot.save(products)
+        reconciled += len(products)
+
+    rds_conn.commit()
+
+    return reconciled
 
 
 def get_user_data(rds_conn: connection, product_id: int) -> list:
@@ -99,120 +194,270 @@ def get_user_data(rds_conn: connection, product_id: int) -> list:
     Query database for users which are subscribed to given product.
     """
     cur = rds_conn.cursor(cursor_factory=extras.RealDictCursor)
-    cur.execute(EMAIL_QUERY, (product_id,))
+    QUERIES.execute(cur, "subscriber_emails", (product_id,))
     rows = cur.fetchall()
     cur.close()
 
     return [entry['email'] for entry in rows]
 
 
-def update_product_availability(rds_conn: connection, product,
-                                availability: bool,
-                                ses_client: boto3.client) -> None:
+def get_subscribers(rds_conn: connection, product_id: int) -> list[dict]:
+    """
+    Query database for users subscribed to given product, along with the
+    bitmap of sizes they follow (None if they follow every size).
+    """
+    cur = rds_conn.cursor(cursor_factory=extras.RealDictCursor)
+    QUERIES.execute(cur, "subscriber_emails", (product_id,))
+    rows = cur.fetchall()
+    cur.close()
+
+    return [{'email': entry['email'],
+             'size_mask': bits_to_bitmap(entry['size_mask']) if entry['size_mask'] else None}
+            for entry in rows]
+
+
+def get_variant_id(variant: dict) -> int:
+    """
+    Returns the ASOS id of a size variant from the stockprice API.
+    """
+    return variant.get("variantId", variant.get("id"))
+
+
+def get_variant_sizes(asos_item_json: dict) -> dict:
+    """
+    Returns the size label of each variant listed on the product page, keyed by variant id.
+    """
+    if "hasVariant" not in asos_item_json.keys() and "@graph" in asos_item_json.keys():
+        asos_item_json = asos_item_json['@graph'][0]
+
+    return {str(variant["sku"]): variant["size"]
+            for variant in asos_item_json.get("hasVariant", [])
+            if "sku" in variant and "size" in variant}
+
+
+def bits_to_bitmap(bits: str | None) -> int:
+    """
+    Returns a Postgres bit string as an integer bitmap, with the leftmost bit as bit 0.
+    """
+    if not bits:
+        return 0
+    return int(bits[::-1], 2)
+
+
+def bitmap_to_bits(bitmap: int, width: int) -> str:
+    """
+    Returns an integer bitmap as a Postgres bit string, with bit 0 as the leftmost bit.
+    """
+    if width == 0:
+        return ""
+    return format(bitmap, f"0{width}b")[::-1]
+
+
+def get_stock_bitmap(variants: list, known_variant_ids: list) -> tuple[list, int]:
+    """
+    Returns the variant ids in bit order and a bitmap with bit i set when variant i is in stock.
+    Known variants keep their bit position so that bitmaps from different runs can be
+    compared directly; variants seen for the first time are appended.
+    """
+    variant_ids = list(known_variant_ids or [])
+    positions = {variant_id: position for position,
+                 variant_id in enumerate(variant_ids)}
+    bitmap = 0
+
+    for variant in variants:
+        variant_id = get_variant_id(variant)
+        if variant_id not in positions:
+            positions[variant_id] = len(variant_ids)
+            variant_ids.append(variant_id)
+        if variant["isInStock"]:
+            bitmap |= 1 << positions[variant_id]
+
+    return variant_ids, bitmap
+
+
+def get_size_names(variant_sizes: list, bitmap: int) -> list:
+    """
+    Returns the size labels of the variants set in a bitmap.
+    """
+    return [size for position, size in enumerate(variant_sizes)
+            if bitmap >> position & 1]
+
+
+def build_availability_email(product: Product, availability: bool) -> tuple[str, str]:
+    """
+    Returns the subject and HTML body of an email about a change in availability.
+    """
+    status = "is now back in stock!" if availability else "is out of stock!"
+
+    body = f"""<meta charset="UTF-8">
+                <center>
+                <h1 font-family="Ariel">
+                Your item <a href={product.product_url}>
+                {product.product_name}</a> {status}
+                </h1>
+                <br></br>
+                <img src="{product.image_url}" alt="img">
+                </center>"""
+
+    return "Update of product availability", body
+
+
+def queue_notifications(cur: cursor, product_id: int, recipients: list,
+                        subject: str, body: str, event_key: str) -> None:
+    """
+    Writes one outbox row per recipient using the open cursor, so the emails
+    are committed in the same transaction as the change they describe.
+    The idempotency key stops the same event being queued twice for a recipient.
+    """
+    rows = [(f"{event_key}:{recipient}", product_id, recipient, subject, body)
+            for recipient in recipients]
+
+    if rows:
+        extras.execute_values(cur, INSERT_NOTIFICATIONS_QUERY, rows)
+
+
+def update_product_availability(rds_conn: connection, product: Product,
+                                availability: bool) -> None:
     """
     Update product table to reflect availability of item as shown on webpage.
-    Emails users about a change in availability. 
+    Queues emails to users about a change in availability.
     """
 
     with rds_conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
-        cur.execute(UPDATE_AVAILABILITY_QUERY,
-                    (availability, product['product_id']))
+        QUERIES.execute(cur, "update_availability",
+                        (availability, product.product_id, availability))
+
+        # Another run has already recorded this change.
+        if cur.rowcount == 0:
+            rds_conn.commit()
+            return
+        # The time this change was recorded, so a retried send reuses the same key.
+        changed_at = cur.fetchone()['last_modified']
+
+        # Users following particular sizes are told about those sizes instead.
+        recipients = [subscriber['email']
+                      for subscriber in get_subscribers(rds_conn, product.product_id)
+                      if subscriber['size_mask'] is None]
+        subject, body = build_availability_email(product, availability)
+        event_key = (f"availability:{product.product_id}:"
+                     f"{'in' if availability else 'out'}:{changed_at.isoformat()}")
+        queue_notifications(cur, product.product_id, recipients,
+                            subject, body, event_key)
 
     rds_conn.commit()
 
-    recipients = get_user_data(rds_conn, product['product_id'])
-
-    if availability == True and len(recipients) >= 1:
-        for recipient in recipients:
-            response = ses_client.send_email(
-                Source=EMAIL_SENDER,
-                Destination={'ToAddresses': [recipient]},
-                Message={
-                    'Subject': {'Data': "Update of product availability"},
-                    'Body': {'Html': {'Data': f"""<meta charset="UTF-8">
-                                <center>
-                                <h1 font-family="Ariel">
-                                Your item <a href={product['product_url']}>
-                                {product['product_name']}</a> is now back in stock!
-                                </h1>
-                                <br></br>
-                                <img src="{product["image_url"]}" alt="img">
-                                </center>"""
-                                      }}
-                }
-            )
+    if recipients:
         logging.info(
             f"""
-            Product {product['product_name']} back in stock. 
-            User Notified. Message ID: {response['MessageId']}"""
+            Product {product.product_name} {'back in' if availability else 'out of'} stock. 
+            {len(recipients)} notification(s) queued."""
         )
 
-    elif availability == False and len(recipients) >= 1:
-        for recipient in recipients:
-            response = ses_client.send_email(
-                Source=EMAIL_SENDER,
-                Destination={'ToAddresses': [recipient]},
-                Message={
-                    'Subject': {'Data': "Update of product availability"},
-                    'Body': {'Html': {'Data': f"""<meta charset="UTF-8">
-                                <center>
-                                <h1 font-family="Ariel">
-                                Your item <a href={product['product_url']}>
-                                {product['product_name']}</a> is out of stock!
-                                </h1>
-                                <br></br>
-                                <img src="{product["image_url"]}" alt="img">
-                                </center>"""
-                                      }}
-                }
-            )
-        logging.info(
-            f"""
-            Product {product['product_name']} out of stock. 
-            User Notified. Message ID: {response['MessageId']}"""
-        )
 
+def build_size_availability_email(product: Product, sizes: list,
+                                  availability: bool) -> tuple[str, str]:
+    """
+    Returns the subject and HTML body of an email about a change in availability
+    of the sizes a user follows.
+    """
+    size_names = ", ".join(sizes)
+    status = (f"is now back in stock in {size_names}!" if availability
+              else f"is out of stock in {size_names}!")
+
+    body = f"""<meta charset="UTF-8">
+                <center>
+                <h1 font-family="Ariel">
+                Your item <a href={product.product_url}>
+                {product.product_name}</a> {status}
+                </h1>
+                <br></br>
+                <img src="{product.image_url}" alt="img">
+                </center>"""
 
-def check_product_availability(rds_conn: connection, product_id: int) -> bool:
+    return "Update of product availability in your size", body
+
+
+def update_variant_stock(rds_conn: connection, product: Product, variant_ids: list,
+                         variant_sizes: list, stock_bitmap: int) -> None:
     """
-    Checks what the current product availability is
+    Stores the per-size stock bitmap of a product and a snapshot of it if it has changed.
+    Users following particular sizes are emailed when none of their sizes were
+    in stock and some now are, or the other way round.
     """
+    previous_bitmap = bits_to_bitmap(product.stock_bitmap)
+    previous_bits = product.stock_bitmap or ""
+    stock_bits = bitmap_to_bits(stock_bitmap, len(variant_ids))
+
+    if stock_bits == previous_bits:
+        return
+
     with rds_conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
-        cur.execute(CHECK_AVAILABILITY_QUERY,
-                    (product_id,))
-        return cur.fetchone()['product_availability']
+        QUERIES.execute(cur, "update_stock_bitmap",
+                        (variant_ids, variant_sizes, stock_bits,
+                         product.product_id, stock_bits))
+
+        # Another run has already recorded this change.
+        if cur.rowcount == 0:
+            rds_conn.commit()
+            return
+
+        QUERIES.execute(cur, "insert_stock_snapshot",
+                        (product.product_id, stock_bits))
+        snapshot_id = cur.fetchone()['snapshot_id']
+
+        for subscriber in get_subscribers(rds_conn, product.product_id):
+            if subscriber['size_mask'] is None:
+                continue
+
+            was_in_stock = previous_bitmap & subscriber['size_mask']
+            now_in_stock = stock_bitmap & subscriber['size_mask']
+            if bool(was_in_stock) == bool(now_in_stock):
+                continue
+
+            sizes = get_size_names(variant_sizes,
+                                   now_in_stock or subscriber['size_mask'])
+            subject, body = build_size_availability_email(
+                product, sizes, bool(now_in_stock))
+            queue_notifications(cur, product.product_id, [subscriber['email']],
+                                subject, body, f"sizes:{product.product_id}:{snapshot_id}")
+
+    rds_conn.commit()
 
 
-def get_latest_price_data(rds_conn: connection, product_id: dict) -> float:
+def get_latest_price_data(rds_conn: connection, product_id: int) -> dict | None:
     """
-    Gets latest price from database.
+    Gets latest price and the id of its price reading from database.
     """
 
     cur = rds_conn.cursor(cursor_factory=extras.RealDictCursor)
 
-    cur.execute(GET_LATEST_PRICE_QUERY,
-                (product_id,))
+    QUERIES.execute(cur, "latest_price",
+                    (product_id,))
     rows = cur.fetchall()
     cur.close()
 
-    latest_price = [float(entry['price']) for entry in rows if entry['price']]
+    latest_price = [{'price_id': entry['price_id'], 'price': float(entry['price'])}
+                    for entry in rows if entry['price']]
 
     if len(latest_price) >= 1:
         return latest_price[0]
 
+    return None
+
 
 def insert_new_price_data(rds_conn: connection,
-                          product_id: int, new_price: float) -> None:
+                          product_id: int, new_price: float) -> int:
     """
     Insert product_id, current product price, and timestamp into prices table in database.
+    Returns the id of the new price reading.
+    The caller is responsible for committing the transaction.
     """
     current_timestamp = datetime.now()
 
     with rds_conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
-        cur.execute(INSERT_PRICE_QUERY,
-                    (current_timestamp, product_id, new_price))
-
-    rds_conn.commit()
+        QUERIES.execute(cur, "insert_price",
+                        (current_timestamp, product_id, new_price))
+        return cur.fetchone()['price_id']
 
 
 def get_discount_amount(previous_price: float, new_price: float) -> dict:
@@ -235,130 +480,185 @@ def get_discount_amount(previous_price: float, new_price: float) -> dict:
             'percentage_discount': 'Unknown'}
 
 
-def send_price_update_email(ses_client: boto3.client,
-                            product_data: dict, recipients: list,
-                            old_price: float, new_price: float, sender: str) -> None:
+def build_price_drop_email(product_data: Product,
+                           old_price: float, new_price: float) -> tuple[str, str]:
     """
-    Send email to user if product price decreases in price. 
+    Returns the subject and HTML body of an email about a decrease in price.
     """
 
     discount = get_discount_amount(old_price, new_price)
 
-    for recipient in recipients:
-        response = ses_client.send_email(
-            Source=sender,
-            Destination={'ToAddresses': [recipient]},
-            Message={
-                'Subject': {'Data': "Your item has decreased in price!"},
-                'Body': {'Html': {'Data': f"""<meta charset="UTF-8">
-                            <center>
-                            <h1 font-family="Ariel">
-                            Your item <a href={product_data['product_url']}>
-                            {product_data['product_name']}</a> has gone down 
-                            by {discount['percentage_discount']:.1f}%
-                            </h1>
-                            <body class="New price" font-family="Ariel">
-                            <b>
-                            New price = £{discount['new_price']:.2f}
-                            </body><br></br>
-                            <body class="Previous price" font-family="Ariel">
-                            <b>Previous price = £{discount['previous_price']:.2f}
-                            </b>
-                            </body><br></br>
-                            <img src="{product_data["image_url"]}" alt="img">
-                            </center>"""}}
-            }
-        )
-        logging.info(
-            f"""
-            Product {product_data['product_name']} price reduced. 
-            User notified. Message ID: {response['MessageId']}"""
-        )
+    body = f"""<meta charset="UTF-8">
+                <center>
+                <h1 font-family="Ariel">
+                Your item <a href={product_data.product_url}>
+                {product_data.product_name}</a> has gone down 
+                by {discount['percentage_discount']:.1f}%
+                </h1>
+                <body class="New price" font-family="Ariel">
+                <b>
+                New price = £{discount['new_price']:.2f}
+                </body><br></br>
+                <body class="Previous price" font-family="Ariel">
+                <b>Previous price = £{discount['previous_price']:.2f}
+                </b>
+                </body><br></br>
+                <img src="{product_data.image_url}" alt="img">
+                </center>"""
+
+    return "Your item has decreased in price!", body
+
+
+def queue_price_update_emails(rds_conn: connection, product_data: Product,
+                              recipients: list, previous_price: dict,
+                              new_price: float) -> None:
+    """
+    Queues an email to every user subscribed to a product which has decreased in price.
+    The previous price reading identifies the drop, so overlapping runs
+    which see the same drop queue each email only once.
+    """
+
+    subject, body = build_price_drop_email(
+        product_data, previous_price['price'], new_price)
+    event_key = f"price-drop:{product_data.product_id}:{previous_price['price_id']}"
+
+    with rds_conn.cursor() as cur:
+        queue_notifications(cur, product_data.product_id, recipients,
+                            subject, body, event_key)
+
+    logging.info(
+        f"""
+        Product {product_data.product_name} price reduced. 
+        {len(recipients)} notification(s) queued."""
+    )
+
+
+def get_asos_product_id(asos_item_json: dict) -> int:
+    """
+    Returns the ASOS product id from the JSON on a product page.
+    """
+    if "productID" in asos_item_json.keys():
+        return asos_item_json['productID']
+    return asos_item_json['@graph'][0]['productID']
 
 
-def scrape_asos_page(rds_conn: connection, item: dict,
-                     header: dict, ses_client: boto3.client, page_session) -> None:
+def save_asos_product_id(rds_conn: connection, product_id: int, asos_product_id: int) -> None:
     """
-    Takes in one item as a dictionary.
-    Scrapes webpage and gets the new price.
+    Stores the ASOS product id of a product so its page does not need to be scraped again.
+    """
+    with rds_conn.cursor() as cur:
+        QUERIES.execute(cur, "set_asos_product_id",
+                        (asos_product_id, product_id))
+
+    rds_conn.commit()
+
+
+def scrape_asos_page(rds_conn: connection, item: Product,
+                     header: dict, page_session) -> Product:
+    """
+    Takes in one product record.
+    Gets the new price and stock from the ASOS API, scraping the product page
+    only if the product has not been matched to an API entry before.
     Updates the availability of product.
-    Emails users if there is a change in availability or a decrease in price.
+    Queues emails to users if there is a change in availability or a decrease in price.
+    Returns the product as it now stands, to be saved to the local snapshot.
     """
+    asos_product_id = item.asos_product_id
+    size_labels = {}
 
-    page = page_session.get(
-        item["product_url"], headers=header, timeout=5)
-    soup = BeautifulSoup(page.text, "html.parser").find(
-        "script", type="application/ld+json")
-    asos_item_json = json.loads(soup.string)
+    if asos_product_id is None:
+        page = page_session.get(
+            item.product_url, headers=header, timeout=5)
+        soup = BeautifulSoup(page.text, "html.parser").find(
+            "script", type="application/ld+json")
+        asos_item_json = json.loads(soup.string)
 
-    # Matching to an API entry.
-    if "productID" in asos_item_json.keys():
-        price_endpoint = f"""{STARTER_ASOS_API}productIds={
-            asos_item_json['productID']
-            }&store=COM&currency=GBP"""
-    else:
-        price_endpoint = f"""{STARTER_ASOS_API}productIds={
-            asos_item_json['@graph'][0]['productID']
-            }&store=COM&currency=GBP"""
+        # Matching to an API entry.
+        asos_product_id = get_asos_product_id(asos_item_json)
+        size_labels = get_variant_sizes(asos_item_json)
+        save_asos_product_id(rds_conn, item.product_id, asos_product_id)
+
+    price_endpoint = f"""{STARTER_ASOS_API}productIds={
+        asos_product_id
+        }&store=COM&currency=GBP"""
 
     product_api_result = requests.get(price_endpoint, timeout=5).json()
 
     new_scraped_price = product_api_result[0]["productPrice"]["current"]["value"]
-    product_id_db = item['product_id']
+    product_id_db = item.product_id
 
-    # Updating the availability.
+    # Updating the stock of each size, then the availability.
     sizes = product_api_result[0]['variants']
-    availabilities = []
-    for size in sizes:
-        if size["isInStock"] == True:
-            availabilities.append(size["isInStock"])
-        else:
-            availabilities.append(size["isInStock"])
+    variant_ids, stock_bitmap = get_stock_bitmap(sizes, item.variant_ids)
+    variant_sizes = list(item.variant_sizes or [])
+    variant_sizes += [size_labels.get(str(variant_id), str(variant_id))
+                      for variant_id in variant_ids[len(variant_sizes):]]
+
+    update_variant_stock(rds_conn, item, variant_ids,
+                         variant_sizes, stock_bitmap)
 
-    if True in availabilities:
-        asos_item_json["is_in_stock"] = True
-        prev_availability = check_product_availability(
-            rds_conn, product_id_db)
+    availability = stock_bitmap != 0
+    if item.product_availability != availability:
+        # Updating database and alerting users of the change in availability.
+        update_product_availability(rds_conn, item, availability)
 
-        if prev_availability != True:
-            # Updating database and alerting users if item now in stock.
-            update_product_availability(conn, item, True, ses_client)
+    last_price_id, last_price = item.last_price_id, item.last_price
 
-        prev_price = get_latest_price_data(rds_conn, product_id_db)
+    if availability:
+        if last_price is not None:
+            prev_price = {'price_id': last_price_id,
+                          'price': float(last_price)}
+        else:
+            prev_price = get_latest_price_data(rds_conn, product_id_db)
         new_price = new_scraped_price
 
-        if new_price and prev_price and new_price != prev_price:
+        if new_price and prev_price and new_price != prev_price['price']:
             # Adding new price to database if it has changed.
-            insert_new_price_data(
+            last_price_id = insert_new_price_data(
                 rds_conn, product_id_db, new_scraped_price)
+            last_price = new_price
 
-            if new_price < prev_price:
+            if new_price < prev_price['price']:
                 recipients = get_user_data(rds_conn, product_id_db)
                 if len(recipients) >= 1:
-                    send_price_update_email(
-                        ses_client, item, recipients, prev_price, new_price, EMAIL_SENDER)
+                    queue_price_update_emails(
+                        rds_conn, item, recipients, prev_price, new_price)
 
-    else:
-        asos_item_json["is_in_stock"] = False
-        prev_availability = check_product_availability(
-            rds_conn, product_id_db)
+            # The new price and its emails are committed together.
+            rds_conn.commit()
 
-        if prev_availability != False:
-            update_product_availability(conn, item, False, ses_client)
+    return item._replace(asos_product_id=asos_product_id,
+                         product_availability=availability,
+                         variant_ids=variant_ids, variant_sizes=variant_sizes,
+                         stock_bitmap=bitmap_to_bits(
+                             stock_bitmap, len(variant_ids)),
+                         last_price_id=last_price_id, last_price=last_price,
+                         last_checked=datetime.now())
 
 
 if __name__ == "__main__":
 
     load_dotenv()
-    EMAIL_SENDER = environ['SENDER_EMAIL_ADDRESS']
 
     conn = get_database_connection()
-    email_client = create_ses_client()
     headers = {'user-agent': environ["USER_AGENT"]}
-    products = get_all_product_data(conn)
-    # session = requests.Session()
+    chunk_size = int(environ.get("PRODUCT_CHUNK_SIZE", PRODUCT_CHUNK_SIZE))
+
+    # A run can outlast the three minute schedule; the next one then skips.
+    if not try_run_lock(conn):
+        logging.info("The previous run is still going, so this run was skipped.")
+        conn.close()
+        raise SystemExit(0)
 
-    with concurrent.futures.ThreadPoolExecutor() as multiprocessor:
+    # Only products changed since the last run are read from the database.
+    snapshot = ProductSnapshot(environ.get(
+        "SNAPSHOT_PATH", "product_snapshot.sqlite3"))
+    reconciled = reconcile_snapshot(conn, snapshot, chunk_size)
+    logging.info(f"Reconciled {reconciled} changed product(s) with the local snapshot.")
+
+    connection_pool = get_connection_pool(MAX_WORKERS)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as multiprocessor:
 
         session = requests.Session()
         adapter = requests.adapters.HTTPAdapter(
@@ -369,7 +669,30 @@ if __name__ == "__main__":
         def partial_fetch_product_data(item):
             """
             Multiprocessing scrape asos function.
+            Each thread borrows its own connection from the pool.
             """
-            return scrape_asos_page(conn, item, headers, email_client, session)
-
-        multiprocessor.map(partial_fetch_product_data, products)
+            rds_conn = connection_pool.getconn()
+            try:
+                return scrape_asos_page(rds_conn, item, headers, session)
+            finally:
+                connection_pool.putconn(rds_conn)
+
+        # Each chunk is finished before the next is read, which bounds memory use.
+        for products in snapshot.iter_product_chunks(chunk_size):
+            futures = {multiprocessor.submit(partial_fetch_product_data, item): item
+                       for item in products}
+            concurrent.futures.wait(futures)
+
+            checked = []
+            for future, item in futures.items():
+                if future.exception():
+                    logging.error(
+                        f"Product {item.product_id} could not be updated: {future.exception()}")
+                else:
+                    checked.append(future.result())
+            snapshot.save(checked)
+
+    snapshot.close()
+    connection_pool.closeall()
+    # Closing the connection releases the run lock.
+    conn.close()
@@ -95,6 +95,50 @@ resource "aws_security_group" "c9-sale-tracker-dashboard-sg" {
   }
 }
 
+# Price updates snapshot storage
+resource "aws_security_group" "c9-sale-tracker-snapshot-sg" {
+  name        = "c9-sale-tracker-snapshot-sg"
+  description = "Allow NFS from the price updates task"
+  vpc_id      = "vpc-04423dbb18410aece"
+
+  ingress {
+    description      = "NFS from VPC"
+    from_port        = 2049
+    to_port          = 2049
+    protocol         = "tcp"
+    self             = true
+  }
+  egress {
+    from_port        = 0
+    to_port          = 0
+    protocol         = "-1"
+    cidr_blocks      = ["0.0.0.0/0"]
+    ipv6_cidr_blocks = ["::/0"]
+  }
+
+  tags = {
+    Name = "c9-sale-tracker-snapshot-sg"
+  }
+}
+
+## Price Updates Snapshot
+
+# Keeps the updater's local product snapshot between scheduled runs.
+resource "aws_efs_file_system" "c9-sale-tracker-snapshot" {
+  creation_token = "c9-sale-tracker-snapshot"
+
+  tags = {
+    Name = "c9-sale-tracker-snapshot"
+  }
+}
+
+resource "aws_efs_mount_target" "c9-sale-tracker-snapshot-mount" {
+  for_each        = toset(["subnet-0d0b16e76e68cf51b","subnet-081c7c419697dec52","subnet-02a00c7be52b00368"])
+  file_system_id  = aws_efs_file_system.c9-sale-tracker-snapshot.id
+  subnet_id       = each.value
+  security_groups = [aws_security_group.c9-sale-tracker-snapshot-sg.id]
+}
+
 ## ECS Task Definitions
 
 # Website/API
@@ -155,7 +199,8 @@ resource "aws_ecs_task_definition" "c9-sale-tracker-dashboard-task-def" {
       {"name": "DB_NAME", "value": "${var.DB_NAME}"},
       {"name": "DB_PASSWORD", "value": "${var.DB_PASSWORD}"},
       {"name": "DB_PORT", "value": "${var.DB_PORT}"},
-      {"name": "DB_USER", "value": "${var.DB_USER}"}
+      {"name": "DB_USER", "value": "${var.DB_USER}"},
+      {"name": "SESSION_SECRET", "value": "${var.SESSION_SECRET}"}
     ],
     "name": "c9-sale-tracker-dashboard",
     "image": "129033205317.dkr.ecr.eu-west-2.amazonaws.com/c9-sale-tracker-dashboard:latest",
@@ -197,7 +242,11 @@ resource "aws_ecs_task_definition" "c9-sale-tracker-price-updates-task-def" {
       {"name": "SENDER_EMAIL_ADDRESS", "value": "${var.SENDER_EMAIL_ADDRESS}"},
       {"name": "AWS_ACCESS_KEY_ID", "value": "${var.AWS_ACCESS_KEY}"},
       {"name": "AWS_SECRET_ACCESS_KEY", "value": "${var.AWS_SECRET_ACCESS_KEY}"},
-      {"name": "USER_AGENT", "value": "${var.USER_AGENT}"}
+      {"name": "USER_AGENT", "value": "${var.USER_AGENT}"},
+      {"name": "SNAPSHOT_PATH", "value": "/snapshot/product_snapshot.sqlite3"}
+    ],
+    "mountPoints": [
+      {"sourceVolume": "snapshot", "containerPath": "/snapshot"}
     ],
     "name": "c9-sale-tracker-update-prices",
     "image": "129033205317.dkr.ecr.eu-west-2.amazonaws.com/c9-sale-tracker-price-updates:latest",
@@ -210,6 +259,51 @@ resource "aws_ecs_task_definition" "c9-sale-tracker-price-updates-task-def" {
     ]
   }
 ]
+TASK_DEFINITION
+
+  volume {
+    name = "snapshot"
+
+    efs_volume_configuration {
+      file_system_id = aws_efs_file_system.c9-sale-tracker-snapshot.id
+    }
+  }
+
+  runtime_platform {
+    operating_system_family = "LINUX"
+    cpu_architecture        = "X86_64"
+  }
+}
+
+
+# Notification Sender
+resource "aws_ecs_task_definition" "c9-sale-tracker-notifications-task-def" {
+  family = "c9-sale-tracker-notifications-task-def"
+  requires_compatibilities = ["FARGATE"]
+  network_mode             = "awsvpc"
+  cpu                      = 256
+  memory                   = 512
+  execution_role_arn       = "${data.aws_iam_role.ecs_task_execution_role.arn}"
+  container_definitions    = <<TASK_DEFINITION
+[
+  {
+    "environment": [
+      {"name": "DB_HOST", "value": "${var.DB_HOST}"},
+      {"name": "DB_NAME", "value": "${var.DB_NAME}"},
+      {"name": "DB_PASSWORD", "value": "${var.DB_PASSWORD}"},
+      {"name": "DB_PORT", "value": "${var.DB_PORT}"},
+      {"name": "DB_USER", "value": "${var.DB_USER}"},
+      {"name": "SENDER_EMAIL_ADDRESS", "value": "${var.SENDER_EMAIL_ADDRESS}"},
+      {"name": "AWS_ACCESS_KEY_ID", "value": "${var.AWS_ACCESS_KEY}"},
+      {"name": "AWS_SECRET_ACCESS_KEY", "value": "${var.AWS_SECRET_ACCESS_KEY}"},
+      {"name": "NOTIFICATION_BATCH_SIZE", "value": "${var.NOTIFICATION_BATCH_SIZE}"}
+    ],
+    "name": "c9-sale-tracker-send-notifications",
+    "image": "129033205317.dkr.ecr.eu-west-2.amazonaws.com/c9-sale-tracker-price-updates:latest",
+    "command": ["python3", "send_notifications.py"],
+    "essential": true
+  }
+]
 TASK_DEFINITION
 
   runtime_platform {
@@ -270,7 +364,8 @@ resource "aws_iam_policy" "ecs-schedule-permissions" {
                 "ecs:RunTask"
             ],
             "Resource": [
-                "${aws_ecs_task_definition.c9-sale-tracker-price-updates-task-def.arn}"
+                "${aws_ecs_task_definition.c9-sale-tracker-price-updates-task-def.arn}",
+                "${aws_ecs_task_definition.c9-sale-tracker-notifications-task-def.arn}"
             ],
             "Condition": {
                 "ArnLike": {
@@ -349,6 +444,35 @@ resource "aws_scheduler_schedule" "c9-sale-tracker-price-updates-schedule" {
       task_definition_arn = aws_ecs_task_definition.c9-sale-tracker-price-updates-task-def.arn
       launch_type         = "FARGATE"
 
+    network_configuration {
+        subnets         = ["subnet-0d0b16e76e68cf51b","subnet-081c7c419697dec52","subnet-02a00c7be52b00368"]
+        security_groups = [aws_security_group.c9-sale-tracker-snapshot-sg.id]
+        assign_public_ip = true
+      }
+    }
+  }
+}
+
+
+# EventBridge Schedule for draining the notifications outbox
+resource "aws_scheduler_schedule" "c9-sale-tracker-notifications-schedule" {
+  name        = "c9-sale-tracker-notifications-schedule"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "rate(1 minute)"
+
+  target {
+    arn      = "arn:aws:ecs:eu-west-2:129033205317:cluster/c9-ecs-cluster"
+
+    role_arn = aws_iam_role.iam_for_ecs.arn
+
+    ecs_parameters {
+      task_definition_arn = aws_ecs_task_definition.c9-sale-tracker-notifications-task-def.arn
+      launch_type         = "FARGATE"
+
     network_configuration {
         subnets         = ["subnet-0d0b16e76e68cf51b","subnet-081c7c419697dec52","subnet-02a00c7be52b00368"]
         assign_public_ip = true
@@ -54,4 +54,16 @@ variable "SENDER_EMAIL_ADDRESS" {
   description = "Value of sender email"
   type        = string
   default = "value"
-}
\ No newline at end of file
+}
+
+variable "NOTIFICATION_BATCH_SIZE" {
+  description = "Number of queued emails the notification sender claims at a time"
+  type        = string
+  default = "50"
+}
+
+variable "SESSION_SECRET" {
+  description = "Key the dashboard signs login cookies with"
+  type        = string
+  default = "value"
+}